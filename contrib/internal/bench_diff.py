@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Compares the speed of the built-in diff against GNU diff, as used when
+# generating Perforce, ClearCase and Plastic diffs.
+#
+# Usage: bench_diff.py [num_files [num_lines]]
+#
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from rbtools import postreview
+
+
+def write_file(filename, lines):
+    fp = open(filename, 'wb')
+    fp.write(''.join(lines))
+    fp.close()
+
+
+def make_file_pairs(tmpdir, num_files, num_lines):
+    """Writes out pairs of files with a handful of edits between them."""
+    pairs = []
+
+    for i in range(num_files):
+        old_lines = ['%s line %d of file %d\n' % (random.choice('abcdef'), j, i)
+                     for j in range(num_lines)]
+        new_lines = old_lines[:]
+
+        for j in range(random.randint(1, 10)):
+            pos = random.randint(0, len(new_lines))
+            new_lines[pos:pos + random.randint(0, 5)] = \
+                ['new line %d\n' % k for k in range(random.randint(0, 5))]
+
+        old_file = os.path.join(tmpdir, '%d.old' % i)
+        new_file = os.path.join(tmpdir, '%d.new' % i)
+        write_file(old_file, old_lines)
+        write_file(new_file, new_lines)
+        pairs.append((old_file, new_file))
+
+    return pairs
+
+
+def run(pairs, use_gnu_diff):
+    postreview.options.use_gnu_diff = use_gnu_diff
+    start = time.time()
+    num_lines = 0
+
+    for old_file, new_file in pairs:
+        num_lines += len(postreview.diff_files(old_file, new_file,
+                                               show_c_function=True))
+
+    return time.time() - start, num_lines
+
+
+def main():
+    num_files = 500
+    num_lines = 1000
+
+    if len(sys.argv) > 1:
+        num_files = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        num_lines = int(sys.argv[2])
+
+    random.seed(0)
+    postreview.parse_options([])
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        pairs = make_file_pairs(tmpdir, num_files, num_lines)
+        print 'Diffing %d files of %d lines each' % (num_files, num_lines)
+
+        for name, use_gnu_diff in (('built-in', False), ('GNU diff', True)):
+            elapsed, output_lines = run(pairs, use_gnu_diff)
+            print '%-10s %8.3fs (%d lines of output)' % (name, elapsed,
+                                                         output_lines)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
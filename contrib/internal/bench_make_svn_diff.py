@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Measures how the time taken to convert a git-svn diff to an svn diff
+# scales with the size of the diff.
+#
+# Usage: bench_make_svn_diff.py [num_lines ...]
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from rbtools import postreview
+
+
+def make_diff(num_lines):
+    """Builds a synthetic git diff with roughly num_lines lines."""
+    lines = []
+    i = 0
+
+    while len(lines) < num_lines:
+        filename = 'dir/file%d.c' % i
+
+        if i % 50 == 0:
+            lines += [
+                'diff --git %s %s\n' % (filename, filename),
+                'new file mode 100644\n',
+                'index 0000000..e619c13\n',
+                '--- /dev/null\n',
+                '+++ %s\n' % filename,
+            ]
+        elif i % 50 == 1:
+            lines += [
+                'diff --git %s %s\n' % (filename, filename),
+                'index 5e98e95..e619c13 100644\n',
+                'Binary files %s and %s differ\n' % (filename, filename),
+            ]
+            i += 1
+            continue
+        else:
+            lines += [
+                'diff --git %s %s\n' % (filename, filename),
+                'index 5e98e95..e619c13 100644\n',
+                '--- %s\n' % filename,
+                '+++ %s\n' % filename,
+            ]
+
+        lines.append('@@ -1,20 +1,20 @@\n')
+
+        for j in range(20):
+            lines.append(' context line %d of %s\n' % (j, filename))
+            lines.append('+added line %d of %s\n' % (j, filename))
+
+        i += 1
+
+    return lines[:num_lines]
+
+
+def main():
+    sizes = [10000, 100000, 1000000]
+
+    if len(sys.argv) > 1:
+        sizes = [int(size) for size in sys.argv[1:]]
+
+    client = postreview.GitClient()
+
+    for num_lines in sizes:
+        diff_lines = make_diff(num_lines)
+
+        start = time.time()
+        diff = ''.join(client._convert_to_svn_diff(diff_lines, '1234'))
+        elapsed = time.time() - start
+
+        print '%8d lines %8.3fs %8.3f us/line (%d bytes of output)' % (
+            num_lines, elapsed, 1000000 * elapsed / num_lines, len(diff))
+
+
+if __name__ == "__main__":
+    main()
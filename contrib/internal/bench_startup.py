@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Measures how long post-review takes to start, by running
+# "post-review --help" and "post-review -n" against a fixture git
+# repository, and reports which of the slower modules were imported.
+#
+# Usage: bench_startup.py [num_runs]
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+SCRIPT = os.path.join(ROOT_DIR, "scripts", "post-review")
+
+# The modules that post-review should only load when it talks to a server.
+SLOW_MODULES = ('cookielib', 'httplib', 'mimetools', 'pkg_resources',
+                'urllib2')
+
+# Runs post-review in-process, and then prints the slow modules that
+# were imported, so the benchmark can report them.
+CHECK_MODULES_SCRIPT = """\
+import sys
+sys.argv = %r
+from rbtools.postreview import main
+try:
+    main()
+except SystemExit:
+    pass
+sys.stderr.write('\\nLoaded: %%s\\n' %% ' '.join(
+    [name for name in %r if name in sys.modules]))
+"""
+
+
+def git(repo_dir, env, *args):
+    p = subprocess.Popen(['git'] + list(args), cwd=repo_dir, env=env,
+                         stdout=subprocess.PIPE)
+    p.communicate()
+
+    if p.returncode != 0:
+        sys.stderr.write('git %s failed\n' % ' '.join(args))
+        sys.exit(1)
+
+
+def make_fixture_repo(tmpdir, env):
+    """Creates a git repository with two commits to diff between."""
+    repo_dir = os.path.join(tmpdir, 'repo')
+    os.mkdir(repo_dir)
+
+    git(repo_dir, env, 'init', '-q')
+    git(repo_dir, env, 'config', 'reviewboard.url',
+        'http://reviewboard.example.com')
+
+    for i in range(2):
+        fp = open(os.path.join(repo_dir, 'README'), 'a')
+        fp.write('Line %d\n' % i)
+        fp.close()
+
+        git(repo_dir, env, 'add', 'README')
+        git(repo_dir, env, 'commit', '-q', '-m', 'Commit %d' % i)
+
+    return repo_dir
+
+
+def make_env(tmpdir):
+    env = os.environ.copy()
+    env['HOME'] = tmpdir
+    env['PYTHONPATH'] = ROOT_DIR
+
+    for name in ('AUTHOR', 'COMMITTER'):
+        env.setdefault('GIT_%s_NAME' % name, 'Benchmark')
+        env.setdefault('GIT_%s_EMAIL' % name, 'benchmark@example.com')
+
+    return env
+
+
+def run(args, repo_dir, env, num_runs):
+    """Returns the fastest time taken to run post-review with args."""
+    best = None
+
+    for i in range(num_runs):
+        start = time.time()
+        p = subprocess.Popen([sys.executable, SCRIPT] + args, cwd=repo_dir,
+                             env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        p.communicate()
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def run_python(env, num_runs):
+    """Returns the fastest time taken to start the interpreter alone."""
+    best = None
+
+    for i in range(num_runs):
+        start = time.time()
+        subprocess.Popen([sys.executable, '-c', 'pass'], env=env).wait()
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def get_loaded_modules(args, repo_dir, env):
+    script = CHECK_MODULES_SCRIPT % (['post-review'] + args, SLOW_MODULES)
+    p = subprocess.Popen([sys.executable, '-c', script], cwd=repo_dir,
+                         env=env, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    errors = p.communicate()[1]
+    loaded = errors[errors.rindex('Loaded:') + len('Loaded:'):]
+
+    return loaded.split()
+
+
+def main():
+    num_runs = 10
+
+    if len(sys.argv) > 1:
+        num_runs = int(sys.argv[1])
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        env = make_env(tmpdir)
+        repo_dir = make_fixture_repo(tmpdir, env)
+
+        print 'Best of %d runs' % num_runs
+        print '%-10s %8.3fs' % ('python', run_python(env, num_runs))
+
+        for args in (['--help'],
+                     ['-n', '--revision-range=HEAD~1:HEAD']):
+            elapsed = run(args, repo_dir, env, num_runs)
+            loaded = get_loaded_modules(args, repo_dir, env)
+            print '%-10s %8.3fs (slow modules loaded: %s)' % (
+                args[0], elapsed, ', '.join(loaded) or 'none')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,29 @@
 #!/usr/bin/env python
-import base64
-import cookielib
-import getpass
+import atexit
+import imp
 import marshal
-import mimetools
 import os
 import re
-import socket
+import shutil
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import urllib
-import urllib2
 from datetime import datetime
-from optparse import OptionParser
-from pkg_resources import parse_version
+from optparse import OptionParser, Values
 from tempfile import mkstemp
 from urlparse import urljoin, urlparse
+from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 
 try:
     from hashlib import md5
@@ -28,9 +34,9 @@ except ImportError:
 try:
     # Specifically import json_loads, to work around some issues with
     # installations containing incompatible modules named "json".
-    from json import loads as json_loads
+    from json import loads as json_loads, dumps as json_dumps
 except ImportError:
-    from simplejson import loads as json_loads
+    from simplejson import loads as json_loads, dumps as json_dumps
 
 # This specific import is necessary to handle the paths for
 # cygwin enabled machines.
@@ -43,6 +49,31 @@ else:
 from rbtools import get_package_version, get_version_string
 
 
+class LazyModule(object):
+    """
+    A stand-in for a module that's only imported once it's first used.
+
+    Most runs never contact a server (for instance, with --output-diff), so
+    the networking and authentication modules are loaded this way to keep
+    them from slowing down startup.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        __import__(self._name)
+        return getattr(sys.modules[self._name], attr)
+
+
+cookielib = LazyModule('cookielib')
+getpass = LazyModule('getpass')
+httplib = LazyModule('httplib')
+mimetools = LazyModule('mimetools')
+socket = LazyModule('socket')
+transport = LazyModule('rbtools.transport')
+urllib2 = LazyModule('urllib2')
+
+
 ###
 # Default configuration -- user-settable variables follow.
 ###
@@ -113,13 +144,315 @@ DEBUG           = False
 
 user_config = None
 tempfiles = []
+tempdirs = []
+
+# The executables found by find_executable in this run.
+_tools = {}
+_tools_lock = threading.RLock()
+
+# The persistent command sessions started in this run, by session class.
+# A session that couldn't be started is stored as False.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Held while a PostReviewSession has its settings in place of the options.
+_post_review_lock = threading.RLock()
 options = None
 configs = []
 
+# The server index built from user_config and configs, along with the
+# configs it was built from.
+_config_server_index = None
+
 ADD_REPOSITORY_DOCS_URL = \
     'http://www.reviewboard.org/docs/manual/dev/admin/management/repositories/'
 GNU_DIFF_WIN32_URL = 'http://gnuwin32.sourceforge.net/packages/diffutils.htm'
 
+# The number of seconds that cached server resources are used as-is before
+# they're revalidated against the server.
+SERVER_CACHE_TTL = 24 * 60 * 60
+
+# The number of seconds that the cached repository index is used before
+# checking the server for new repositories.
+REPOSITORY_CACHE_TTL = 60 * 60
+
+# The number of seconds before the repository index is fetched again in
+# full, picking up changes to the repositories already in it.
+REPOSITORY_FULL_REFRESH_TTL = 24 * 60 * 60
+
+# The maximum number of repositories whose info is fetched from the server
+# at once when looking for a matching repository.
+REPOSITORY_PROBE_WORKERS = 8
+
+# The order of the pre-release tags understood by parse_version(). Unknown
+# tags sort first.
+PRE_RELEASE_TAGS = {
+    'dev': 1,
+    'a': 2,
+    'alpha': 2,
+    'b': 3,
+    'beta': 3,
+    'c': 4,
+    'pre': 4,
+    'preview': 4,
+    'rc': 4,
+}
+
+# The number of lines at the end of a streamed command's output that are
+# shown if the command fails.
+EXECUTE_ERROR_TAIL = 100
+
+# The number of the slowest commands listed at exit with --trace-commands.
+TRACE_SUMMARY_COMMANDS = 10
+
+# Command line options whose values are passwords, and are hidden in the
+# commands recorded by the profiler, along with any option ending in
+# "passwd" or "password".
+SECRET_COMMAND_OPTIONS = ('-P',)
+SECRET_COMMAND_OPTION_RE = re.compile(r'^--?[\w-]*pass(wd|word)$',
+                                      re.IGNORECASE)
+REDACTED_ARGUMENT = '**************'
+
+
+class Profiler(object):
+    """Records where time is spent during a run of post-review.
+
+    Each phase of the run is timed with run_phase(), recording its wall
+    and CPU time. Each command started through execute() or for Perforce
+    is recorded with add_command(), and the HTTP requests made to the
+    server are counted along the way.
+
+    The results are reported with --profile and --profile-json, and the
+    commands with --trace-commands. Nothing is recorded unless the
+    profiler is enabled, which post-review does when one of those is
+    given, so the results don't build up in long-running processes.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start_time = time.time()
+        self.start_cpu = self._get_cpu_time()
+        self.phases = []
+        self.subprocesses = 0
+        self.subprocess_time = 0.0
+        self.commands = []
+        self.http_requests = 0
+        self.http_bytes_sent = 0
+        self.http_bytes_received = 0
+        self._lock = threading.Lock()
+
+    def run_phase(self, name, func, *args, **kwargs):
+        """Calls func, recording the time taken under the given name."""
+        if not self.enabled:
+            return func(*args, **kwargs)
+
+        start_time = time.time()
+        start_cpu = self._get_cpu_time()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.phases.append({
+                'name': name,
+                'start': start_time - self.start_time,
+                'wall': time.time() - start_time,
+                'cpu': self._get_cpu_time() - start_cpu,
+            })
+
+    def add_command(self, command, start_time, exit_code, output_bytes):
+        """Records a command that was started at start_time and has exited."""
+        if not self.enabled:
+            return
+
+        duration = time.time() - start_time
+
+        if not isinstance(command, list):
+            command = [command]
+
+        command = self._redact_command(command)
+
+        self._lock.acquire()
+
+        try:
+            self.subprocesses += 1
+            self.subprocess_time += duration
+            self.commands.append({
+                'argv': command,
+                'cwd': os.getcwd(),
+                'start': start_time - self.start_time,
+                'duration': duration,
+                'exit_code': exit_code,
+                'output_bytes': output_bytes,
+                'thread': threading.currentThread().getName(),
+            })
+        finally:
+            self._lock.release()
+
+    def _redact_command(self, command):
+        """Returns the command with any passwords in it hidden."""
+        redacted = []
+        hide_next = False
+
+        for arg in command:
+            name = arg.split('=', 1)[0]
+
+            if hide_next:
+                redacted.append(REDACTED_ARGUMENT)
+                hide_next = False
+            elif (name in SECRET_COMMAND_OPTIONS or
+                  SECRET_COMMAND_OPTION_RE.match(name)):
+                if name != arg:
+                    # The password is part of the argument, as in
+                    # --password=secret.
+                    redacted.append('%s=%s' % (name, REDACTED_ARGUMENT))
+                else:
+                    redacted.append(arg)
+                    hide_next = True
+            else:
+                redacted.append(arg)
+
+        return redacted
+
+    def add_http_request(self, bytes_sent):
+        """Records an HTTP request with a body of bytes_sent bytes."""
+        if not self.enabled:
+            return
+
+        self._lock.acquire()
+
+        try:
+            self.http_requests += 1
+            self.http_bytes_sent += bytes_sent
+        finally:
+            self._lock.release()
+
+    def add_http_bytes_received(self, bytes_received):
+        """Records data read from an HTTP response."""
+        if not self.enabled:
+            return
+
+        self._lock.acquire()
+
+        try:
+            self.http_bytes_received += bytes_received
+        finally:
+            self._lock.release()
+
+    def get_report(self):
+        """Returns the results as a dictionary, suitable for JSON."""
+        return {
+            'rbtools_version': get_version_string(),
+            'python_version': sys.version.split()[0],
+            'platform': sys.platform,
+            'wall': time.time() - self.start_time,
+            'cpu': self._get_cpu_time() - self.start_cpu,
+            'phases': self.phases,
+            'subprocesses': {
+                'count': self.subprocesses,
+                'time': self.subprocess_time,
+            },
+            'http': {
+                'requests': self.http_requests,
+                'bytes_sent': self.http_bytes_sent,
+                'bytes_received': self.http_bytes_received,
+            },
+        }
+
+    def format_report(self):
+        """Returns the results as a human-readable table."""
+        report = self.get_report()
+        lines = ['%-20s %10s %10s' % ('Phase', 'Wall (s)', 'CPU (s)')]
+
+        for phase in report['phases']:
+            lines.append('%-20s %10.3f %10.3f' % (phase['name'], phase['wall'],
+                                                  phase['cpu']))
+
+        lines.append('%-20s %10.3f %10.3f' % ('total', report['wall'],
+                                              report['cpu']))
+        lines.append('')
+        lines.append('Commands run:  %d, taking %.3fs' %
+                     (self.subprocesses, self.subprocess_time))
+        lines.append('HTTP requests: %d, %d bytes sent, %d bytes received' %
+                     (self.http_requests, self.http_bytes_sent,
+                      self.http_bytes_received))
+
+        return '\n'.join(lines) + '\n'
+
+    def get_trace(self):
+        """Returns the phases and commands as Chrome trace events.
+
+        The result can be written out as JSON and loaded into a trace
+        viewer, such as chrome://tracing. Phases are shown on the first
+        row, and the commands run from each thread on the rows after it.
+        """
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+
+        for phase in self.phases:
+            events.append({
+                'name': phase['name'],
+                'cat': 'phase',
+                'ph': 'X',
+                'ts': int(phase['start'] * 1000000),
+                'dur': int(phase['wall'] * 1000000),
+                'pid': pid,
+                'tid': 0,
+            })
+
+        for command in self.commands:
+            tid = thread_ids.setdefault(command['thread'],
+                                        len(thread_ids) + 1)
+            events.append({
+                'name': subprocess.list2cmdline(command['argv'][:2]),
+                'cat': 'command',
+                'ph': 'X',
+                'ts': int(command['start'] * 1000000),
+                'dur': int(command['duration'] * 1000000),
+                'pid': pid,
+                'tid': tid,
+                'args': {
+                    'argv': subprocess.list2cmdline(command['argv']),
+                    'cwd': command['cwd'],
+                    'exit_code': command['exit_code'],
+                    'output_bytes': command['output_bytes'],
+                },
+            })
+
+        for name, tid in [('phases', 0)] + thread_ids.items():
+            events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': tid,
+                'args': {'name': name},
+            })
+
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+        }
+
+    def format_slowest_commands(self, count=TRACE_SUMMARY_COMMANDS):
+        """Returns a summary of the slowest commands that were run."""
+        commands = self.commands[:]
+        commands.sort(key=lambda command: command['duration'], reverse=True)
+        lines = ['Slowest commands:']
+
+        for command in commands[:count]:
+            lines.append('%8.3fs  exit %-3s %9d bytes  %s' %
+                         (command['duration'], command['exit_code'],
+                          command['output_bytes'],
+                          subprocess.list2cmdline(command['argv'])))
+
+        return '\n'.join(lines) + '\n'
+
+    def _get_cpu_time(self):
+        times = os.times()
+        return times[0] + times[1]
+
+
+profiler = Profiler()
+
 
 class APIError(Exception):
     def __init__(self, http_status, error_code, rsp=None, *args, **kwargs):
@@ -140,13 +473,19 @@ class APIError(Exception):
             return code_str
 
 
-class HTTPRequest(urllib2.Request):
-    def __init__(self, url, body='', headers={}, method="PUT"):
-        urllib2.Request.__init__(self, url, body, headers)
-        self.method = method
+class PostReviewError(Exception):
+    """
+    Raised by die() when post-review can't continue.
+
+    The message, if any, has already been cleaned up for showing to the
+    user. The post-review command prints it and exits.
+    """
+    def __init__(self, msg=None):
+        Exception.__init__(self, msg)
+        self.msg = msg
 
-    def get_method(self):
-        return self.method
+    def __str__(self):
+        return self.msg or ''
 
 
 class RepositoryInfo:
@@ -180,6 +519,60 @@ class RepositoryInfo:
         """
         return self
 
+    def _find_matching_repository(self, server, tool, uuid, match_key,
+                                  match_func):
+        """
+        Finds a repository on the server with the given tool and UUID.
+
+        The info for each candidate repository is fetched in parallel, and
+        match_func is called with the repository and its info for each one
+        with a matching UUID. It returns None, or a tuple of the
+        RepositoryInfo to use and the match to remember under match_key
+        for later runs. The first match in the server's repository order is
+        remembered and its RepositoryInfo returned. Repositories whose UUID
+        is already known not to match are skipped.
+        """
+        candidates = [
+            repository
+            for repository in server.get_repositories()
+            if (repository['tool'] == tool and
+                repository['uuid'] in (None, uuid))
+        ]
+
+        def probe(repository):
+            info = self._get_repository_info(server, repository)
+
+            if not info or info['uuid'] != uuid:
+                return None
+
+            return match_func(repository, info)
+
+        debug('Checking %d %s repositories for UUID %s' %
+              (len(candidates), tool, uuid))
+
+        for result in run_parallel(probe, candidates,
+                                   REPOSITORY_PROBE_WORKERS,
+                                   lambda result: result is not None):
+            if result is not None:
+                repository_info, match = result
+                server.set_repository_match(match_key, match)
+
+                return repository_info
+
+        return None
+
+    def _get_repository_info(self, server, repository):
+        try:
+            return server.get_repository_info(repository['id'])
+        except APIError, e:
+            # If the server couldn't fetch the repository info, it will return
+            # code 210. Ignore those.
+            # Other more serious errors should still be raised, though.
+            if e.error_code == 210:
+                return None
+
+            raise e
+
 
 class SvnRepositoryInfo(RepositoryInfo):
     """
@@ -200,38 +593,40 @@ class SvnRepositoryInfo(RepositoryInfo):
         repositories use the same path, you'll get back self, otherwise you'll
         get a different SvnRepositoryInfo object (with a different path).
         """
-        repositories = server.get_repositories()
-
-        for repository in repositories:
-            if repository['tool'] != 'Subversion':
-                continue
+        match_key = 'svn:%s' % self.uuid
+        match = server.get_repository_match(match_key)
 
-            info = self._get_repository_info(server, repository)
+        if match:
+            relpath = self._get_relative_path(self.base_path,
+                                              match['base_path'])
 
-            if not info or self.uuid != info['uuid']:
-                continue
+            if relpath:
+                debug('Using cached repository match for UUID %s' % self.uuid)
+                return SvnRepositoryInfo(match['url'], relpath, self.uuid)
 
+        def match_func(repository, info):
             repos_base_path = info['url'][len(info['root_url']):]
             relpath = self._get_relative_path(self.base_path, repos_base_path)
-            if relpath:
-                return SvnRepositoryInfo(info['url'], relpath, self.uuid)
+
+            if not relpath:
+                return None
+
+            return (SvnRepositoryInfo(info['url'], relpath, self.uuid), {
+                'id': repository['id'],
+                'url': info['url'],
+                'base_path': repos_base_path,
+            })
+
+        repository_info = self._find_matching_repository(
+            server, 'Subversion', self.uuid, match_key, match_func)
+
+        if repository_info:
+            return repository_info
 
         # We didn't find a matching repository on the server. We'll just return
         # self and hope for the best.
         return self
 
-    def _get_repository_info(self, server, repository):
-        try:
-            return server.get_repository_info(repository['id'])
-        except APIError, e:
-            # If the server couldn't fetch the repository info, it will return
-            # code 210. Ignore those.
-            # Other more serious errors should still be raised, though.
-            if e.error_code == 210:
-                return None
-
-            raise e
-
     def _get_relative_path(self, path, root):
         pathdirs = self._split_on_slash(path)
         rootdirs = self._split_on_slash(root)
@@ -286,20 +681,29 @@ class ClearCaseRepositoryInfo(RepositoryInfo):
         uuid = self._get_vobs_uuid(self.vobstag)
         debug("Repositorie's %s uuid is %r" % (self.vobstag, uuid))
 
-        repositories = server.get_repositories()
-        for repository in repositories:
-            if repository['tool'] != 'ClearCase':
-                continue
-
-            info = self._get_repository_info(server, repository)
+        match_key = 'clearcase:%s' % uuid
+        match = server.get_repository_match(match_key)
 
-            if not info or uuid != info['uuid']:
-                continue
+        if match:
+            debug('Using cached repository match for uuid:%s with path:%s' %
+                  (uuid, match['repopath']))
+            return ClearCaseRepositoryInfo(match['repopath'],
+                    match['repopath'], uuid)
 
+        def match_func(repository, info):
             debug('Matching repository uuid:%s with path:%s' %(uuid,
                   info['repopath']))
-            return ClearCaseRepositoryInfo(info['repopath'],
-                    info['repopath'], uuid)
+            return (ClearCaseRepositoryInfo(info['repopath'],
+                                            info['repopath'], uuid), {
+                'id': repository['id'],
+                'repopath': info['repopath'],
+            })
+
+        repository_info = self._find_matching_repository(
+            server, 'ClearCase', uuid, match_key, match_func)
+
+        if repository_info:
+            return repository_info
 
         # We didn't found uuid but if version is >= 1.5.3
         # we can try to use VOB's name hoping it is better
@@ -314,162 +718,225 @@ class ClearCaseRepositoryInfo(RepositoryInfo):
     def _get_vobs_uuid(self, vobstag):
         """Return family uuid of VOB."""
 
-        property_lines = execute(["cleartool", "lsvob", "-long", vobstag],
-                                 split_lines=True)
+        property_lines = run_cleartool(["lsvob", "-long", vobstag],
+                                       split_lines=True)
         for line  in property_lines:
             if line.startswith('Vob family uuid:'):
                 return  line.split(' ')[-1].rstrip()
 
-    def _get_repository_info(self, server, repository):
+
+class HTTPConnectionPool(object):
+    """A pool of persistent HTTP connections, keyed by scheme and host.
+
+    Review Board servers support HTTP/1.1 keep-alive, so rather than paying
+    for a new TCP (and possibly SSL) handshake on every API call, we keep
+    idle connections around and hand them back out for the next request to
+    the same host. This also keeps some statistics on how often connections
+    were reused, which are shown with --debug.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self.num_requests = 0
+        self.num_connections = 0
+
+    def get_connection(self, key, factory):
+        """Returns a tuple of (connection, reused) for the given key.
+
+        If an idle connection is available, it is removed from the pool and
+        returned. Otherwise, a new one is created using the factory.
+        """
+        self._lock.acquire()
+
         try:
-            return server.get_repository_info(repository['id'])
-        except APIError, e:
-            # If the server couldn't fetch the repository info, it will return
-            # code 210. Ignore those.
-            # Other more serious errors should still be raised, though.
-            if e.error_code == 210:
-                return None
+            self.num_requests += 1
+            idle = self._idle.get(key)
 
-            raise e
+            if idle:
+                return idle.pop(), True
 
+            self.num_connections += 1
+        finally:
+            self._lock.release()
 
-class PresetHTTPAuthHandler(urllib2.BaseHandler):
-    """urllib2 handler that conditionally presets the use of HTTP Basic Auth.
+        debug('Opening new HTTP connection to %s' % key[1])
+        return factory(), False
 
-    This is used when specifying --username= on the command line. It will
-    force an HTTP_AUTHORIZATION header with the user info, asking the user
-    for any missing info beforehand. It will then try this header for that
-    first request.
+    def new_connection(self, key, factory):
+        """Creates a new connection, replacing one that has gone stale."""
+        self._lock.acquire()
 
-    It will only do this once.
-    """
-    handler_order = 480 # After Basic auth
+        try:
+            self.num_connections += 1
+        finally:
+            self._lock.release()
 
-    def __init__(self, url, password_mgr):
-        self.url = url
-        self.password_mgr = password_mgr
-        self.used = False
+        debug('Reopening HTTP connection to %s' % key[1])
+        return factory()
+
+    def release_connection(self, key, conn):
+        """Returns a connection to the pool so it can be reused."""
+        self._lock.acquire()
+
+        try:
+            self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
 
-    def reset(self):
-        self.password_mgr.rb_user = options.http_username
-        self.password_mgr.rb_pass = options.http_password
-        self.used = False
+    def close(self):
+        """Closes all idle connections in the pool."""
+        self._lock.acquire()
 
-    def http_request(self, request):
-        if options.username and not self.used:
-            # Note that we call password_mgr.find_user_password to get the
-            # username and password we're working with. This allows us to
-            # prompt if, say, --username was specified but --password was not.
-            username, password = \
-                self.password_mgr.find_user_password('Web API', self.url)
-            raw = '%s:%s' % (username, password)
-            request.add_header(
-                urllib2.HTTPBasicAuthHandler.auth_header,
-                'Basic %s' % base64.b64encode(raw).strip())
-            self.used = True
+        try:
+            for conns in self._idle.itervalues():
+                for conn in conns:
+                    conn.close()
+
+            self._idle = {}
+        finally:
+            self._lock.release()
 
-        return request
+    def get_stats(self):
+        return "%d HTTP requests over %d connections (%d reused)" % \
+            (self.num_requests, self.num_connections,
+             self.num_requests - self.num_connections)
 
-    https_request = http_request
 
+class MultipartFormData(object):
+    """A multipart/form-data request body that is produced in chunks.
 
-class ReviewBoardHTTPErrorProcessor(urllib2.HTTPErrorProcessor):
-    """Processes HTTP error codes.
+    The body is never assembled into a single string. Instead, iterating
+    over it yields the boundaries, part headers and field/file contents a
+    chunk at a time, so that large diffs can be written straight to the
+    socket. The total length is computed up front for the Content-Length
+    header.
 
-    Python 2.6 gets HTTP error code processing right, but 2.4 and 2.5 only
-    accepts HTTP 200 and 206 as success codes. This handler ensures that
-    anything in the 200 range is a success.
+    The body can be iterated over more than once, which is needed when a
+    request has to be resent (for instance, after HTTP authentication).
     """
-    def http_response(self, request, response):
-        if not (200 <= response.code < 300):
-            response = self.parent.error('http', request, response,
-                                         response.code, response.msg,
-                                         response.info())
+    CHUNK_SIZE = 64 * 1024
 
-        return response
+    def __init__(self, fields=None, files=None, boundary=None):
+        self.boundary = boundary or mimetools.choose_boundary()
+        self.content_type = \
+            "multipart/form-data; boundary=%s" % self.boundary
+        self._parts = []
 
-    https_response = http_response
+        fields = fields or {}
+        files = files or {}
 
+        for key in fields:
+            self._parts.append(
+                "--%s\r\n"
+                "Content-Disposition: form-data; name=\"%s\"\r\n"
+                "\r\n"
+                "%s\r\n" % (self.boundary, key, str(fields[key])))
 
-class ReviewBoardHTTPBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
-    """Custom Basic Auth handler that doesn't retry excessively.
+        for key in files:
+            self._parts.append(
+                "--%s\r\n"
+                "Content-Disposition: form-data; name=\"%s\"; "
+                "filename=\"%s\"\r\n"
+                "\r\n" % (self.boundary, key, files[key]['filename']))
+            self._parts.append(files[key]['content'])
+            self._parts.append("\r\n")
 
-    urllib2's HTTPBasicAuthHandler retries over and over, which is useless.
-    This subclass only retries once to make sure we've attempted with a
-    valid username and password. It will then fail so we can use
-    tempt_fate's retry handler.
-    """
-    def __init__(self, *args, **kwargs):
-        urllib2.HTTPBasicAuthHandler.__init__(self, *args, **kwargs)
-        self._retried = False
-        self._lasturl = ""
+        self._parts.append("--%s--\r\n\r\n" % self.boundary)
 
-    def retry_http_basic_auth(self, *args, **kwargs):
-        if self._lasturl != args[0]:
-            self._retried = False
+        self._length = 0
 
-        self._lasturl = args[0]
+        for part in self._parts:
+            self._length += len(part)
 
-        if not self._retried:
-            self._retried = True
-            self.retried = 0
-            response = urllib2.HTTPBasicAuthHandler.retry_http_basic_auth(
-                self, *args, **kwargs)
+    def __len__(self):
+        return self._length
 
-            if response.code != 401:
-                self._retried = False
+    def __iter__(self):
+        chunk_size = self.CHUNK_SIZE
 
-            return response
-        else:
-            return None
+        for part in self._parts:
+            if len(part) <= chunk_size:
+                yield part
+            else:
+                for i in xrange(0, len(part), chunk_size):
+                    yield part[i:i + chunk_size]
 
 
-class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
-    """
-    Adds HTTP authentication support for URLs.
+class DataCache(object):
+    """A persistent cache of data kept between runs.
 
-    Python 2.4's password manager has a bug in http authentication when the
-    target server uses a non-standard port.  This works around that bug on
-    Python 2.4 installs. This also allows post-review to prompt for passwords
-    in a consistent way.
+    This is stored as a JSON file in the user's cache directory, such as
+    one file per server. Each entry is stored under a key along with the
+    time it was stored, so callers can decide when it's too old to use.
 
-    See: http://bugs.python.org/issue974757
+    Failing to read or write the cache is never fatal. It's treated as
+    empty and the data is just looked up again instead.
     """
-    def __init__(self, reviewboard_url, rb_user=None, rb_pass=None):
-        self.passwd  = {}
-        self.rb_url  = reviewboard_url
-        self.rb_user = rb_user
-        self.rb_pass = rb_pass
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = {}
+
+        try:
+            fp = open(self.filename, 'r')
+
+            try:
+                self._data = json_loads(fp.read())
+            finally:
+                fp.close()
+        except (IOError, ValueError), e:
+            debug('Unable to load cache file %s: %s' % (self.filename, e))
 
-    def find_user_password(self, realm, uri):
-        if uri.startswith(self.rb_url):
-            if self.rb_user is None or self.rb_pass is None:
-                if options.diff_filename == '-':
-                    die('HTTP authentication is required, but cannot be '
-                        'used with --diff-filename=-')
+    def get(self, key):
+        """Returns the entry stored under key, or None."""
+        return self._data.get(key)
 
-                print "==> HTTP Authentication Required"
-                print 'Enter authorization information for "%s" at %s' % \
-                    (realm, urlparse(uri)[1])
+    def set(self, key, value, timestamp=None):
+        """Stores an entry under key and writes the cache to disk.
 
-                if not self.rb_user:
-                    self.rb_user = raw_input('Username: ')
+        The entry is marked as being stored now, unless an explicit
+        timestamp is given.
+        """
+        self._lock.acquire()
+
+        try:
+            value['timestamp'] = timestamp or time.time()
+            self._data[key] = value
+            self._save()
+        finally:
+            self._lock.release()
 
-                if not self.rb_pass:
-                    self.rb_pass = getpass.getpass('Password: ')
+    def is_fresh(self, entry, max_age=SERVER_CACHE_TTL):
+        """Returns whether an entry was stored less than max_age ago."""
+        return (entry is not None and
+                0 <= time.time() - entry.get('timestamp', 0) < max_age)
 
-            return self.rb_user, self.rb_pass
-        else:
-            # If this is an auth request for some other domain (since HTTP
-            # handlers are global), fall back to standard password management.
-            return urllib2.HTTPPasswordMgr.find_user_password(self, realm, uri)
+    def _save(self):
+        dirname = os.path.dirname(self.filename)
+
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0700)
+
+            # Write to a temporary file first, so that an interrupted run
+            # or a concurrent post-review never leaves a truncated file.
+            fd, tmpfile = mkstemp(dir=dirname)
+            os.write(fd, json_dumps(self._data))
+            os.close(fd)
+
+            if os.path.exists(self.filename):
+                os.unlink(self.filename)
+
+            os.rename(tmpfile, self.filename)
+        except (IOError, OSError), e:
+            debug('Unable to write cache file %s: %s' % (self.filename, e))
 
 
 class ReviewBoardServer(object):
     """
     An instance of a Review Board server.
     """
-    def __init__(self, url, info, cookie_file):
+    def __init__(self, url, info, cookie_file, cache_dir=None):
         self.url = url
         if self.url[-1] != '/':
             self.url += '/'
@@ -486,29 +953,54 @@ class ReviewBoardServer(object):
             except IOError:
                 pass
 
+        # Guards the cookie file and the repository index, which may be
+        # updated from several threads at once. The cookie jar has its own
+        # lock, and the password manager and Basic Auth handler serialize
+        # their own prompts and retries.
+        self._lock = threading.Lock()
+
+        if cache_dir:
+            self.cache = DataCache(os.path.join(
+                cache_dir, 'server-%s.json' % md5(self.url).hexdigest()))
+        else:
+            self.cache = None
+
         # Set up the HTTP libraries to support all of the features we need.
         cookie_handler      = urllib2.HTTPCookieProcessor(self.cookie_jar)
-        password_mgr        = ReviewBoardHTTPPasswordMgr(self.url,
-                                                         options.username,
-                                                         options.password)
-        basic_auth_handler  = ReviewBoardHTTPBasicAuthHandler(password_mgr)
+        password_mgr        = transport.ReviewBoardHTTPPasswordMgr(
+                                  self.url, options.username, options.password)
+        basic_auth_handler  = transport.ReviewBoardHTTPBasicAuthHandler(
+                                  password_mgr)
         digest_auth_handler = urllib2.HTTPDigestAuthHandler(password_mgr)
-        self.preset_auth_handler = PresetHTTPAuthHandler(self.url, password_mgr)
-        http_error_processor = ReviewBoardHTTPErrorProcessor()
-
-        opener = urllib2.build_opener(cookie_handler,
-                                      basic_auth_handler,
-                                      digest_auth_handler,
-                                      self.preset_auth_handler,
-                                      http_error_processor)
-        opener.addheaders = [('User-agent', 'RBTools/' + get_package_version())]
-        urllib2.install_opener(opener)
+        self.preset_auth_handler = transport.PresetHTTPAuthHandler(
+                                       self.url, password_mgr)
+        http_error_processor = transport.ReviewBoardHTTPErrorProcessor()
+
+        # All requests to the server go over persistent connections from
+        # this pool, rather than opening a new connection for each one.
+        self.connection_pool = HTTPConnectionPool()
+        handlers = [cookie_handler,
+                    basic_auth_handler,
+                    digest_auth_handler,
+                    self.preset_auth_handler,
+                    http_error_processor,
+                    transport.ProfilingHandler(profiler),
+                    transport.KeepAliveHTTPHandler(self.connection_pool)]
+
+        if hasattr(httplib, 'HTTPS'):
+            handlers.append(
+                transport.KeepAliveHTTPSHandler(self.connection_pool))
+
+        self.opener = urllib2.build_opener(*handlers)
+        self.opener.addheaders = [('User-agent',
+                                   'RBTools/' + get_package_version())]
 
     def check_api_version(self):
         """Checks the API version on the server to determine which to use."""
         try:
-            root_resource = self.api_get('api/')
-            rsp = self.api_get(root_resource['links']['info']['href'])
+            root_resource = self.api_get_cached('api/', 'root')
+            rsp = self.api_get_cached(root_resource['links']['info']['href'],
+                                      'info')
 
             self.rb_version = rsp['info']['product']['package_version']
 
@@ -647,6 +1139,17 @@ class ReviewBoardServer(object):
                     self.info.path = repository['path']
                     break
 
+            if isinstance(self.info.path, list) and self.cache:
+                # The repository may have been added since the index was
+                # last refreshed.
+                debug("No match in the repository index. Refreshing it.")
+                repositories = self.get_repositories(force_refresh=True)
+
+                for repository in repositories:
+                    if repository['path'] in self.info.path:
+                        self.info.path = repository['path']
+                        break
+
             if isinstance(self.info.path, list):
                 sys.stderr.write('\n')
                 sys.stderr.write('There was an error creating this review '
@@ -745,19 +1248,27 @@ class ReviewBoardServer(object):
         """
         Sets a field in a review request to the specified value.
         """
+        self.set_review_request_fields(review_request, {
+            field: value,
+        })
+
+    def set_review_request_fields(self, review_request, fields):
+        """
+        Sets several fields in a review request's draft at once.
+
+        fields is a dictionary mapping field names to values. All of them
+        are sent to the server in a single request.
+        """
         rid = review_request['id']
 
-        debug("Attempting to set field '%s' to '%s' for review request '%s'" %
-              (field, value, rid))
+        debug("Attempting to set fields %r for review request '%s'" %
+              (fields, rid))
 
         if self.deprecated_api:
-            self.api_post('api/json/reviewrequests/%s/draft/set/' % rid, {
-                field: value,
-            })
+            self.api_post('api/json/reviewrequests/%s/draft/set/' % rid,
+                          fields)
         else:
-            self.api_put(review_request['links']['draft']['href'], {
-                field: value,
-            })
+            self.api_put(review_request['links']['draft']['href'], fields)
 
     def get_review_request(self, rid):
         """
@@ -773,23 +1284,148 @@ class ReviewBoardServer(object):
 
         return rsp['review_request']
 
-    def get_repositories(self):
+    def get_repositories(self, force_refresh=False):
         """
         Returns the list of repositories on this server.
+
+        Each repository is a dictionary containing the id, tool, path,
+        mirror_path and, once known, the uuid of the repository.
+
+        When caching is enabled, this is served from a local repository
+        index. The index is brought up to date once it's older than
+        REPOSITORY_CACHE_TTL, fetching only the repositories added since
+        the last refresh where possible. It's fetched again in full once
+        the last full fetch is older than REPOSITORY_FULL_REFRESH_TTL, or
+        when force_refresh is set, so changes to existing repositories
+        are picked up.
+        """
+        if not self.cache:
+            return self._fetch_repositories()
+
+        entry = self.cache.get('repositories')
+
+        if entry and entry.get('deprecated_api') != self.deprecated_api:
+            entry = None
+
+        if (entry and not force_refresh and
+            self.cache.is_fresh(entry, REPOSITORY_CACHE_TTL)):
+            debug('Using cached repository index')
+            return entry['repositories']
+
+        repositories = None
+
+        if (entry and not force_refresh and not self.deprecated_api and
+            0 <= time.time() - entry.get('fetched', 0) <
+                 REPOSITORY_FULL_REFRESH_TTL):
+            repositories = self._refresh_repositories(entry['repositories'])
+
+        if repositories is None:
+            repositories = self._fetch_repositories()
+            fetched = time.time()
+
+            # The repositories may have changed in ways the matches can't
+            # be checked against, such as their URLs, so find them again.
+            self._clear_repository_matches()
+        else:
+            fetched = entry['fetched']
+
+        if entry:
+            # Hold on to any UUIDs we've already looked up.
+            uuids = {}
+
+            for repository in entry['repositories']:
+                uuids[(repository['id'], repository['path'])] = \
+                    repository['uuid']
+
+            for repository in repositories:
+                if repository['uuid'] is None:
+                    repository['uuid'] = uuids.get((repository['id'],
+                                                    repository['path']))
+
+        self.cache.set('repositories', {
+            'deprecated_api': self.deprecated_api,
+            'fetched': fetched,
+            'repositories': repositories,
+        })
+
+        return repositories
+
+    def _fetch_repositories(self, start=0):
+        """
+        Fetches the list of repositories from the server, optionally
+        skipping the first start entries.
         """
         if self.deprecated_api:
             rsp = self.api_get('api/json/repositories/')
             repositories = rsp['repositories']
         else:
-            rsp = self.api_get(
-                self.root_resource['links']['repositories']['href'])
+            href = self.root_resource['links']['repositories']['href']
+
+            if start:
+                href += '?start=%s' % start
+
+            rsp = self.api_get(href)
             repositories = rsp['repositories']
 
             while 'next' in rsp['links']:
                 rsp = self.api_get(rsp['links']['next']['href'])
                 repositories.extend(rsp['repositories'])
 
-        return repositories
+        return [self._make_repository_entry(repository)
+                for repository in repositories]
+
+    def _refresh_repositories(self, repositories):
+        """
+        Brings a previously fetched list of repositories up to date.
+
+        This asks the server for the current number of repositories, along
+        with the repository at the position of the last one we know about.
+        If that's still the same repository, nothing before it was removed.
+        Then if the count is unchanged, the list is kept, and if it grew,
+        just the new repositories are fetched. Anything else returns None,
+        meaning the list needs to be fetched in full.
+        """
+        href = self.root_resource['links']['repositories']['href']
+        count = len(repositories)
+        rsp = self.api_get('%s?start=%s&max-results=1'
+                           % (href, max(count - 1, 0)))
+        total_results = rsp.get('total_results')
+        last_ids = [repository['id'] for repository in rsp['repositories']]
+
+        if count and last_ids != [repositories[-1]['id']]:
+            total_results = None
+
+        if total_results == count:
+            debug('Repository index is up to date')
+            return repositories
+        elif total_results > count:
+            debug('Fetching %s new repositories' % (total_results - count))
+            known_ids = {}
+
+            for repository in repositories:
+                known_ids[repository['id']] = True
+
+            repositories = repositories + [
+                repository
+                for repository in self._fetch_repositories(count)
+                if repository['id'] not in known_ids
+            ]
+
+            if len(repositories) == total_results:
+                return repositories
+
+        debug('Repository list has changed. Fetching all repositories')
+        return None
+
+    def _make_repository_entry(self, repository):
+        """Returns the repository index entry for a repository resource."""
+        return {
+            'id': repository['id'],
+            'tool': repository['tool'],
+            'path': repository['path'],
+            'mirror_path': repository.get('mirror_path', ''),
+            'uuid': None,
+        }
 
     def get_repository_info(self, rid):
         """
@@ -804,8 +1440,84 @@ class ReviewBoardServer(object):
             url = rsp['repository']['links']['info']['href']
 
         rsp = self.api_get(url)
+        info = rsp['info']
+
+        if self.cache and 'uuid' in info:
+            self._set_repository_uuid(rid, info['uuid'])
 
-        return rsp['info']
+        return info
+
+    def _set_repository_uuid(self, rid, uuid):
+        """Records the UUID of a repository in the repository index."""
+        self._lock.acquire()
+
+        try:
+            entry = self.cache.get('repositories')
+
+            if not entry:
+                return
+
+            for repository in entry['repositories']:
+                if repository['id'] == rid and repository['uuid'] != uuid:
+                    repository['uuid'] = uuid
+                    self.cache.set('repositories', entry, entry['timestamp'])
+                    break
+        finally:
+            self._lock.release()
+
+    def get_repository_match(self, key):
+        """
+        Returns the cached details of a repository previously matched
+        against a local repository, or None.
+
+        Matches for repositories that are no longer on the server are
+        ignored, and all matches are forgotten whenever the repository
+        index is fetched in full.
+        """
+        if not self.cache:
+            return None
+
+        # Bring the index up to date first, as that may drop the matches.
+        repositories = self.get_repositories()
+        entry = self.cache.get('repository-matches')
+
+        if not entry or key not in entry['matches']:
+            return None
+
+        match = entry['matches'][key]
+
+        for repository in repositories:
+            if repository['id'] == match['id']:
+                return match
+
+        return None
+
+    def set_repository_match(self, key, match):
+        """
+        Caches the details of a repository matched against a local
+        repository, so later runs don't need to search for it.
+        """
+        if not self.cache:
+            return
+
+        self._lock.acquire()
+
+        try:
+            entry = self.cache.get('repository-matches') or {'matches': {}}
+            entry['matches'][key] = match
+            self.cache.set('repository-matches', entry)
+        finally:
+            self._lock.release()
+
+    def _clear_repository_matches(self):
+        """Forgets all the cached repository matches."""
+        self._lock.acquire()
+
+        try:
+            if self.cache.get('repository-matches'):
+                self.cache.set('repository-matches', {'matches': {}})
+        finally:
+            self._lock.release()
 
     def save_draft(self, review_request):
         """
@@ -882,9 +1594,24 @@ class ReviewBoardServer(object):
                 'public': 1,
             })
 
-    def _get_server_info(self):
-        if not self._server_info:
-            self._server_info = self._info.find_server_repository_info(self)
+    def close(self):
+        """
+        Closes any open connections to the server.
+        """
+        debug('Connection usage: %s' % self.connection_pool.get_stats())
+        self.connection_pool.close()
+
+    def set_repository_info(self, info):
+        """
+        Sets the local repository that review requests are posted for,
+        when reusing the server for another change.
+        """
+        self._info = info
+        self._server_info = None
+
+    def _get_server_info(self):
+        if not self._server_info:
+            self._server_info = self._info.find_server_repository_info(self)
 
         return self._server_info
 
@@ -926,17 +1653,36 @@ class ReviewBoardServer(object):
         Performs an HTTP GET on the specified path, storing any cookies that
         were set.
         """
+        return self.http_get_response(path).read()
+
+    def http_get_response(self, path, headers={}):
+        """
+        Performs an HTTP GET on the specified path with any extra headers,
+        storing any cookies that were set.
+
+        This returns the response object, for callers that need to look at
+        the response headers.
+        """
         debug('HTTP GETting %s' % path)
 
         url = self._make_url(path)
-        rsp = urllib2.urlopen(url).read()
+        rsp = self.opener.open(urllib2.Request(url, headers=headers))
 
-        try:
-            self.cookie_jar.save(self.cookie_file)
-        except IOError, e:
-            debug('Failed to write cookie file: %s' % e)
+        self._save_cookies()
         return rsp
 
+    def _save_cookies(self):
+        """Saves the cookie jar to the cookie file."""
+        self._lock.acquire()
+
+        try:
+            try:
+                self.cookie_jar.save(self.cookie_file)
+            except IOError, e:
+                debug('Failed to write cookie file: %s' % e)
+        finally:
+            self._lock.release()
+
     def _make_url(self, path):
         """Given a path on the server returns a full http:// style url"""
         if path.startswith('http'):
@@ -963,6 +1709,56 @@ class ReviewBoardServer(object):
         except urllib2.HTTPError, e:
             self.process_error(e.code, e.read())
 
+    def api_get_cached(self, path, cache_key):
+        """
+        Performs an API call using HTTP GET, going through the server cache.
+
+        A cached copy of the resource is used without contacting the server
+        for up to SERVER_CACHE_TTL seconds. After that, the resource is
+        requested again with If-None-Match/If-Modified-Since headers, so
+        the server can tell us that our copy is still good.
+        """
+        if not self.cache:
+            return self.api_get(path)
+
+        entry = self.cache.get(cache_key)
+
+        if entry and entry.get('path') != path:
+            entry = None
+
+        if self.cache.is_fresh(entry):
+            debug('Using cached copy of %s' % path)
+            return entry['rsp']
+
+        headers = {}
+
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self.http_get_response(path, headers)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry:
+                debug('Cached copy of %s is still valid' % path)
+                self.cache.set(cache_key, entry)
+                return entry['rsp']
+
+            self.process_error(e.code, e.read())
+
+        rsp = self.process_json(response.read())
+        self.cache.set(cache_key, {
+            'path': path,
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified'),
+            'rsp': rsp,
+        })
+
+        return rsp
+
     def http_post(self, path, fields, files=None):
         """
         Performs an HTTP POST on the specified path, storing any cookies that
@@ -986,11 +1782,8 @@ class ReviewBoardServer(object):
 
         try:
             r = urllib2.Request(str(url), body, headers)
-            data = urllib2.urlopen(r).read()
-            try:
-                self.cookie_jar.save(self.cookie_file)
-            except IOError, e:
-                debug('Failed to write cookie file: %s' % e)
+            data = self.opener.open(r).read()
+            self._save_cookies()
             return data
         except urllib2.HTTPError, e:
             # Re-raise so callers can interpret it.
@@ -1019,9 +1812,9 @@ class ReviewBoardServer(object):
         }
 
         try:
-            r = HTTPRequest(url, body, headers, method='PUT')
-            data = urllib2.urlopen(r).read()
-            self.cookie_jar.save(self.cookie_file)
+            r = transport.HTTPRequest(url, body, headers, method='PUT')
+            data = self.opener.open(r).read()
+            self._save_cookies()
             return data
         except urllib2.HTTPError, e:
             # Re-raise so callers can interpret it.
@@ -1044,9 +1837,9 @@ class ReviewBoardServer(object):
         debug('HTTP DELETing %s' % url)
 
         try:
-            r = HTTPRequest(url, method='DELETE')
-            data = urllib2.urlopen(r).read()
-            self.cookie_jar.save(self.cookie_file)
+            r = transport.HTTPRequest(url, method='DELETE')
+            data = self.opener.open(r).read()
+            self._save_cookies()
             return data
         except urllib2.HTTPError, e:
             # Re-raise so callers can interpret it.
@@ -1090,34 +1883,13 @@ class ReviewBoardServer(object):
     def _encode_multipart_formdata(self, fields, files):
         """
         Encodes data for use in an HTTP POST.
-        """
-        BOUNDARY = mimetools.choose_boundary()
-        content = ""
-
-        fields = fields or {}
-        files = files or {}
-
-        for key in fields:
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"\r\n" % key
-            content += "\r\n"
-            content += str(fields[key]) + "\r\n"
 
-        for key in files:
-            filename = files[key]['filename']
-            value = files[key]['content']
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"; " % key
-            content += "filename=\"%s\"\r\n" % filename
-            content += "\r\n"
-            content += value + "\r\n"
-
-        content += "--" + BOUNDARY + "--\r\n"
-        content += "\r\n"
-
-        content_type = "multipart/form-data; boundary=%s" % BOUNDARY
+        The returned body is a MultipartFormData, which is streamed to the
+        server rather than built up in memory.
+        """
+        body = MultipartFormData(fields, files)
 
-        return content_type, content
+        return body.content_type, body
 
 
 class SCMClient(object):
@@ -1125,32 +1897,63 @@ class SCMClient(object):
     A base representation of an SCM tool for fetching repository information
     and generating diffs.
     """
+    # Files or directories whose presence in the current directory, or one of
+    # its parents, suggests a checkout for this client.
+    marker_files = ()
+
+    def get_marker_files(self):
+        """
+        Returns the marker files used to guess whether the current directory
+        is a checkout for this client, without running any commands.
+        """
+        return self.marker_files
+
+    def is_marker_required(self):
+        """
+        Returns whether this client only works where one of its marker
+        files is found. If so, it isn't probed anywhere else.
+        """
+        return bool(self.marker_files)
+
     def get_repository_info(self):
         return None
 
     def check_options(self):
         pass
 
+    def close(self):
+        """
+        Releases anything held by the client once it's no longer used,
+        such as server processes.
+        """
+        pass
+
     def scan_for_server(self, repository_info):
         """
         Scans the current directory on up to find a .reviewboard file
         containing the server path.
         """
-        server_url = None
+        default_url, tree_urls = get_config_server_index()
+
+        # If repository_info.path is a list, use the entry found in the
+        # earliest config.
+        if isinstance(repository_info.path, list):
+            paths = repository_info.path
+        else:
+            paths = [repository_info.path]
 
-        if user_config:
-            server_url = self._get_server_from_config(user_config,
-                                                      repository_info)
+        best = None
 
-        if not server_url:
-            for config in configs:
-                server_url = self._get_server_from_config(config,
-                                                          repository_info)
+        for path in paths:
+            entry = tree_urls.get(path)
 
-                if server_url:
-                    break
+            if entry and (best is None or entry[0] < best[0]):
+                best = entry
 
-        return server_url
+        if best:
+            return best[1]
+
+        return default_url
 
     def diff(self, args):
         """
@@ -1167,37 +1970,14 @@ class SCMClient(object):
         """
         return (None, None)
 
-    def _get_server_from_config(self, config, repository_info):
-        if 'REVIEWBOARD_URL' in config:
-            return config['REVIEWBOARD_URL']
-        elif 'TREES' in config:
-            trees = config['TREES']
-            if not isinstance(trees, dict):
-                die("Warning: 'TREES' in config file is not a dict!")
-
-            # If repository_info is a list, check if any one entry is in trees.
-            path = None
-
-            if isinstance(repository_info.path, list):
-                for path in repository_info.path:
-                    if path in trees:
-                        break
-                else:
-                    path = None
-            elif repository_info.path in trees:
-                path = repository_info.path
-
-            if path and 'REVIEWBOARD_URL' in trees[path]:
-                return trees[path]['REVIEWBOARD_URL']
-
-        return None
-
 
 class CVSClient(SCMClient):
     """
     A wrapper around the cvs tool that fetches repository
     information and generates compatible diffs.
     """
+    marker_files = (os.path.join("CVS", "Root"),)
+
     def get_repository_info(self):
         if not check_install("cvs"):
             return None
@@ -1258,6 +2038,193 @@ class CVSClient(SCMClient):
                         extra_ignore_errors=(1,))
 
 
+class CommandSession(object):
+    """
+    A persistent interactive process that commands are written to one at
+    a time, saving the cost of starting a new process for every command.
+
+    Subclasses say how to start the process and how to recognize the line
+    that ends each command's output, which carries the command's status.
+    """
+    # The name of the executable, run directly when there's no session.
+    executable = None
+
+    # The command that starts the session.
+    command = None
+
+    # A quick command run to check that the session works.
+    check_command = None
+
+    # The command that changes the session's working directory, if it has
+    # one. The session is then kept in the same directory as us.
+    cd_command = None
+
+    # The command that ends the session.
+    quit_command = None
+
+    # The prompt printed before each command's output, if any.
+    PROMPT = None
+
+    # Matches the end of a line that ends a command's output, capturing
+    # the status.
+    STATUS_RE = None
+
+    def __init__(self):
+        self.process = None
+        self.errors = None
+        self.cwd = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the process, returning whether it's ready to run commands.
+        """
+        # Errors are written to a file, rather than a pipe that could fill
+        # up, and read back after each command.
+        self.errors = tempfile.TemporaryFile()
+
+        try:
+            self.process = _start_process(self.command, None,
+                                          translate_newlines=True,
+                                          with_errors=False,
+                                          errors_output=self.errors)
+            self.run_command(self.check_command)
+        except (OSError, IOError), e:
+            debug('Unable to start %s: %s' %
+                  (subprocess.list2cmdline(self.command), e))
+            self.close()
+            return False
+
+        return True
+
+    def run_command(self, args):
+        """
+        Runs a command, returning its exit status, its output and its
+        errors.
+
+        Raises IOError if the process has gone away.
+        """
+        self.lock.acquire()
+
+        try:
+            self._prepare()
+
+            debug('%s session: %s' % (self.executable,
+                                      subprocess.list2cmdline(args)))
+            self._send(args)
+            status, output = self._read_response()
+
+            self.errors.seek(0)
+            errors = self.errors.read()
+            self.errors.seek(0)
+            self.errors.truncate()
+
+            return status, output, errors
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Shuts down the process."""
+        if self.process:
+            try:
+                self._send(self.quit_command)
+                self.process.stdin.close()
+                self.process.wait()
+            except (OSError, IOError):
+                pass
+
+            self.process = None
+
+        if self.errors:
+            self.errors.close()
+            self.errors = None
+
+    def _prepare(self):
+        """Brings the session up to date before running a command."""
+        # Commands work on the current directory, so keep the session's
+        # in step with ours.
+        if self.cd_command and self.cwd != os.getcwd():
+            self._send(self.cd_command + [os.getcwd()])
+            self._read_response()
+            self.cwd = os.getcwd()
+
+    def _send(self, args):
+        self.process.stdin.write(
+            ' '.join([self._quote(arg) for arg in args]) + '\n')
+        self.process.stdin.flush()
+
+    def _read_response(self):
+        output = []
+
+        while True:
+            line = self.process.stdout.readline()
+
+            if not line:
+                raise IOError('%s exited' % self.executable)
+
+            if not output and self.PROMPT:
+                # The prompt for the command is in front of its output.
+                while line.startswith(self.PROMPT):
+                    line = line[len(self.PROMPT):]
+
+            # Output that doesn't end in a newline has the status line
+            # directly after it.
+            m = self.STATUS_RE.search(line)
+
+            if m:
+                output.append(line[:m.start()])
+                return int(m.group(1)), ''.join(output)
+
+            output.append(line)
+
+    def _quote(self, arg):
+        """Quotes an argument for the session's command line."""
+        if arg and not re.search(r'\s', arg):
+            return arg
+
+        return '"%s"' % arg
+
+
+class CleartoolSession(CommandSession):
+    """
+    A persistent interactive cleartool process.
+
+    cleartool is run with -status, so it ends each command's output with
+    a "Command N returned status S" line.
+    """
+    executable = 'cleartool'
+    command = ['cleartool', '-status']
+    check_command = ['pwd']
+    cd_command = ['cd']
+    quit_command = ['quit']
+
+    PROMPT = 'cleartool> '
+    STATUS_RE = re.compile(r'Command \d+ returned status (\d+)\n?$')
+
+    def _quote(self, arg):
+        if arg and not re.search(r'[\s\'"\\]', arg):
+            return arg
+        elif "'" not in arg:
+            return "'%s'" % arg
+        else:
+            return '"%s"' % arg
+
+
+class CmShellSession(CommandSession):
+    """
+    A persistent "cm shell" process, for running Plastic commands.
+
+    cm shell ends each command's output with a "CommandResult N" line.
+    """
+    executable = 'cm'
+    command = ['cm', 'shell']
+    check_command = ['version']
+    cd_command = ['cd']
+    quit_command = ['exit']
+
+    STATUS_RE = re.compile(r'CommandResult (-?\d+)\n?$')
+
+
 class ClearCaseClient(SCMClient):
     """
     A wrapper around the clearcase tool that fetches repository
@@ -1266,6 +2233,10 @@ class ClearCaseClient(SCMClient):
     """
     viewtype = None
 
+    # The maximum length of the version paths passed to a single
+    # "cleartool describe", keeping well within command line limits.
+    DESCRIBE_MAX_ARGS_LENGTH = 16000
+
     def get_repository_info(self):
         """Returns information on the Clear Case repository.
 
@@ -1276,16 +2247,17 @@ class ClearCaseClient(SCMClient):
         if not check_install('cleartool help'):
             return None
 
-        viewname = execute(["cleartool", "pwv", "-short"]).strip()
+        viewname = run_cleartool(["pwv", "-short"]).strip()
         if viewname.startswith('** NONE'):
             return None
 
-        # Now that we know it's ClearCase, make sure we have GNU diff installed,
-        # and error out if we don't.
-        check_gnu_diff()
+        # Now that we know it's ClearCase, make sure we have GNU diff installed
+        # if it's going to be used, and error out if we don't.
+        if options.use_gnu_diff:
+            check_gnu_diff()
 
-        property_lines = execute(["cleartool", "lsview", "-full", "-properties",
-                                  "-cview"], split_lines=True)
+        property_lines = run_cleartool(["lsview", "-full", "-properties",
+                                        "-cview"], split_lines=True)
         for line in property_lines:
             properties = line.split(' ')
             if properties[0] == 'Properties:':
@@ -1305,8 +2277,8 @@ class ClearCaseClient(SCMClient):
                 break
 
         # Find current VOB's tag
-        vobstag = execute(["cleartool", "describe", "-short", "vob:."],
-                            ignore_errors=True).strip()
+        vobstag = run_cleartool(["describe", "-short", "vob:."],
+                                ignore_errors=True).strip()
         if "Error: " in vobstag:
             die("To generate diff run post-review inside vob.")
 
@@ -1423,8 +2395,7 @@ class ClearCaseClient(SCMClient):
         changeset = []
         # We ignore return code 1 in order to
         # omit files that Clear Case can't read.
-        output = execute([
-            "cleartool",
+        output = run_cleartool([
             "lscheckout",
             "-all",
             "-cview",
@@ -1447,31 +2418,72 @@ class ClearCaseClient(SCMClient):
         """
         changeset = []
 
+        # Rather than have "cleartool find" run a separate "cleartool
+        # describe" for every version it finds, list the versions and
+        # describe them in bulk.
+        #
         # We ignore return code 1 in order to
         # omit files that Clear Case can't read.
-        if sys.platform.startswith('win'):
-            CLEARCASE_XPN = '%CLEARCASE_XPN%'
-        else:
-            CLEARCASE_XPN = '$CLEARCASE_XPN'
-
-        output = execute([
-            "cleartool",
+        versions = run_cleartool([
             "find",
             "-all",
             "-version",
             "brtype(%s)" % branch,
-            "-exec",
-            'cleartool descr -fmt ' \
-            r'"%En\t%PVn\t%Vn\n" ' \
-            + CLEARCASE_XPN],
+            "-print"],
             extra_ignore_errors=(1,),
-            with_errors=False)
+            with_errors=False).splitlines()
+
+        output = self._describe_versions(versions)
 
         if output:
             changeset = self._construct_changeset(output)
 
         return self._sanitize_branch_changeset(changeset)
 
+    def _describe_versions(self, versions):
+        """
+        Returns the element, previous version and version of each version,
+        in the same format as get_checkedout_changeset() reads them.
+
+        Versions are described in batches, as many as will fit in a
+        command line at a time.
+        """
+        output = []
+
+        for batch in self._batch_args(versions, self.DESCRIBE_MAX_ARGS_LENGTH):
+            output.append(run_cleartool([
+                "describe",
+                "-fmt",
+                r"%En\t%PVn\t%Vn\n"] + batch,
+                extra_ignore_errors=(1,),
+                with_errors=False))
+
+        return ''.join(output)
+
+    def _batch_args(self, args, max_length):
+        """
+        Splits a list of arguments into batches whose total length is at
+        most max_length. An argument longer than that gets a batch to
+        itself.
+        """
+        batches = []
+        batch = []
+        length = 0
+
+        for arg in args:
+            if batch and length + len(arg) + 1 > max_length:
+                batches.append(batch)
+                batch = []
+                length = 0
+
+            batch.append(arg)
+            length += len(arg) + 1
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
     def diff(self, files):
         """Performs a diff of the specified file and its previous version."""
 
@@ -1493,29 +2505,12 @@ class ClearCaseClient(SCMClient):
         return (self.do_diff(changeset)[0], None)
 
     def diff_files(self, old_file, new_file):
-        """Return unified diff for file.
-
-        Most effective and reliable way is use gnu diff.
-        """
-        diff_cmd = ["diff", "-uN", old_file, new_file]
-        dl = execute(diff_cmd, extra_ignore_errors=(1,2),
-                     translate_newlines=False)
-
-        # If the input file has ^M characters at end of line, lets ignore them.
-        dl = dl.replace('\r\r\n', '\r\n')
-        dl = dl.splitlines(True)
-
-        # Special handling for the output of the diff tool on binary files:
-        #     diff outputs "Files a and b differ"
-        # and the code below expects the output to start with
-        #     "Binary files "
-        if (len(dl) == 1 and
-            dl[0].startswith('Files %s and %s differ' % (old_file, new_file))):
-            dl = ['Binary files %s and %s differ\n' % (old_file, new_file)]
+        """Return unified diff for file."""
+        dl = diff_files(old_file, new_file)
 
         # We need oids of files to translate them to paths on reviewboard repository
-        old_oid = execute(["cleartool", "describe", "-fmt", "%On", old_file])
-        new_oid = execute(["cleartool", "describe", "-fmt", "%On", new_file])
+        old_oid = run_cleartool(["describe", "-fmt", "%On", old_file])
+        new_oid = run_cleartool(["describe", "-fmt", "%On", new_file])
 
         if dl == [] or dl[0].startswith("Binary files "):
             if dl == []:
@@ -1540,19 +2535,15 @@ class ClearCaseClient(SCMClient):
         old_tmp = make_tempfile(content=old_content)
         new_tmp = make_tempfile(content=new_content)
 
-        diff_cmd = ["diff", "-uN", old_tmp, new_tmp]
-        dl = execute(diff_cmd,
-                     extra_ignore_errors=(1,2),
-                     translate_newlines=False,
-                     split_lines=True)
+        dl = diff_files(old_tmp, new_tmp)
 
         # Replacing temporary filenames to
         # real directory names and add ids
         if dl:
             dl[0] = dl[0].replace(old_tmp, old_dir)
             dl[1] = dl[1].replace(new_tmp, new_dir)
-            old_oid = execute(["cleartool", "describe", "-fmt", "%On", old_dir])
-            new_oid = execute(["cleartool", "describe", "-fmt", "%On", new_dir])
+            old_oid = run_cleartool(["describe", "-fmt", "%On", old_dir])
+            new_oid = run_cleartool(["describe", "-fmt", "%On", new_dir])
             dl.insert(2, "==== %s %s ====\n" % (old_oid, new_oid))
 
         return dl
@@ -1560,8 +2551,8 @@ class ClearCaseClient(SCMClient):
     def do_diff(self, changeset):
         """Generates a unified diff for all files in the changeset."""
 
-        diff = []
-        for old_file, new_file in changeset:
+        def diff_change(change):
+            old_file, new_file = change
             dl = []
             if cpath.isdir(new_file):
                 dl = self.diff_directories(old_file, new_file)
@@ -1569,10 +2560,12 @@ class ClearCaseClient(SCMClient):
                 dl = self.diff_files(old_file, new_file)
             else:
                 debug("File %s does not exist or access is denied." % new_file)
-                continue
 
-            if dl:
-                diff.append(''.join(dl))
+            return ''.join(dl)
+
+        # Files are diffed using up to --jobs threads, but the results are
+        # kept in the original order.
+        diff = run_parallel(diff_change, changeset, options.jobs)
 
         return (''.join(diff), None)
 
@@ -1582,10 +2575,23 @@ class SVNClient(SCMClient):
     DIFF_ORIG_FILE_LINE_RE = re.compile(r'^---\s+.*\s+\(.*\)')
     DIFF_NEW_FILE_LINE_RE = re.compile(r'^\+\+\+\s+.*\s+\(.*\)')
 
+    # The number of paths passed to each 'svn info' when looking up the
+    # files in a diff. This keeps the error output for unversioned paths
+    # small enough not to fill the pipe.
+    SVN_INFO_BATCH_SIZE = 200
+
     """
     A wrapper around the svn Subversion tool that fetches repository
     information and generates compatible diffs.
     """
+    marker_files = ('.svn',)
+
+    def __init__(self):
+        super(SVNClient, self).__init__()
+
+        # A map of paths to the results of 'svn info' on them.
+        self._svn_info_cache = {}
+
     def get_repository_info(self):
         if not check_install('svn help'):
             return None
@@ -1622,14 +2628,16 @@ class SVNClient(SCMClient):
 
         return SvnRepositoryInfo(path, base_path, m.group(1))
 
+    def is_marker_required(self):
+        # --repository-url works without a checkout.
+        return not options.repository_url
+
     def check_options(self):
         if (options.repository_url and
             not options.revision_range and
             not options.diff_filename):
-            sys.stderr.write("The --repository-url option requires either the "
-                             "--revision-range option or the --diff-filename "
-                             "option.\n")
-            sys.exit(1)
+            die("The --repository-url option requires either the "
+                "--revision-range option or the --diff-filename option.")
 
     def scan_for_server(self, repository_info):
         # Scan first for dot files, since it's faster and will cover the
@@ -1721,11 +2729,33 @@ class SVNClient(SCMClient):
         Performs the actual diff operation, handling renames and converting
         paths to absolute.
         """
-        diff = execute(cmd, split_lines=True)
+        diff = execute_stream(cmd)
+
+        if not options.repository_url:
+            # The paths in the diff need to be known up front so their
+            # info can be looked up in batches. Rather than holding the
+            # whole diff in memory, it's spooled to disk and read back.
+            spool = tempfile.TemporaryFile()
+
+            for line in diff:
+                spool.write(line)
+
+            spool.seek(0)
+            self.prefetch_svn_info(self._get_diff_paths(spool))
+            spool.seek(0)
+            diff = spool
+
         diff = self.handle_renames(diff)
         diff = self.convert_to_absolute_paths(diff, repository_info)
 
-        return ''.join(diff)
+        # Like GitClient.make_svn_diff(), write each line to a buffer
+        # rather than joining a list holding every line.
+        buf = StringIO()
+
+        for line in diff:
+            buf.write(line)
+
+        return buf.getvalue()
 
     def handle_renames(self, diff_content):
         """
@@ -1734,15 +2764,19 @@ class SVNClient(SCMClient):
         relative to its parent, the diff header doesn't reflect this.
         This function fixes the relevant section headers of the patch to
         portray this relationship.
+
+        This is a generator, so the diff can be passed through it a line at
+        a time.
         """
 
         # svn diff against a repository URL on two revisions appears to
         # handle moved files properly, so only adjust the diff file names
         # if they were created using a working copy.
         if options.repository_url:
-            return diff_content
+            for line in diff_content:
+                yield line
 
-        result = []
+            return
 
         from_line = ""
         for line in diff_content:
@@ -1758,15 +2792,13 @@ class SVNClient(SCMClient):
                     url       = info["Copied From URL"]
                     root      = info["Repository Root"]
                     from_file = urllib.unquote(url[len(root):])
-                    result.append(from_line.replace(to_file, from_file))
+                    yield from_line.replace(to_file, from_file)
                 else:
-                    result.append(from_line) #as is, no copy performed
+                    yield from_line #as is, no copy performed
 
             # We only mangle '---' lines. All others get added straight to
             # the output.
-            result.append(line)
-
-        return result
+            yield line
 
 
     def convert_to_absolute_paths(self, diff_content, repository_info):
@@ -1774,10 +2806,9 @@ class SVNClient(SCMClient):
         Converts relative paths in a diff output to absolute paths.
         This handles paths that have been svn switched to other parts of the
         repository.
-        """
-
-        result = []
 
+        Like handle_renames(), this is a generator.
+        """
         for line in diff_content:
             front = None
             if (self.DIFF_NEW_FILE_LINE_RE.match(line)
@@ -1807,12 +2838,13 @@ class SVNClient(SCMClient):
 
                     line = front + " " + path + rest
 
-            result.append(line)
-
-        return result
+            yield line
 
     def svn_info(self, path):
         """Return a dict which is the result of 'svn info' at a given path."""
+        if path in self._svn_info_cache:
+            return self._svn_info_cache[path]
+
         svninfo = {}
         for info in execute(["svn", "info", path],
                             split_lines=True):
@@ -1821,8 +2853,100 @@ class SVNClient(SCMClient):
                 key, value = parts
                 svninfo[key] = value
 
+        self._svn_info_cache[path] = svninfo
+
         return svninfo
 
+    def prefetch_svn_info(self, paths):
+        """
+        Looks up the 'svn info' for many paths at once, so that later calls
+        to svn_info() for them don't need to run svn.
+
+        Any paths that svn can't report on are left for svn_info() to look
+        up (and report errors for) individually.
+        """
+        paths = [path for path in paths if path not in self._svn_info_cache]
+
+        for i in range(0, len(paths), self.SVN_INFO_BATCH_SIZE):
+            targets = make_tempfile(
+                '\n'.join(paths[i:i + self.SVN_INFO_BATCH_SIZE]))
+            data = execute(["svn", "info", "--xml", "--targets", targets],
+                           ignore_errors=True, with_errors=False)
+            self._svn_info_cache.update(self._parse_svn_info_xml(data))
+
+    def _parse_svn_info_xml(self, data):
+        """
+        Parses the output of 'svn info --xml' into a map of paths to dicts
+        using the same keys as the plain 'svn info' output.
+        """
+        try:
+            dom = minidom.parseString(data)
+        except ExpatError, e:
+            debug('Unable to parse svn info output: %s' % e)
+            return {}
+
+        def get_text(parent, *names):
+            for name in names:
+                nodes = parent.getElementsByTagName(name)
+
+                if not nodes:
+                    return None
+
+                parent = nodes[0]
+
+            return ''.join([node.data for node in parent.childNodes
+                            if node.nodeType == node.TEXT_NODE]) \
+                     .encode('utf-8')
+
+        result = {}
+
+        for entry in dom.getElementsByTagName('entry'):
+            path = entry.getAttribute('path').encode('utf-8')
+            svninfo = {
+                'Path': path,
+                'Revision': entry.getAttribute('revision').encode('utf-8'),
+                'Node Kind': entry.getAttribute('kind').encode('utf-8'),
+            }
+
+            for key, names in (('URL', ('url',)),
+                               ('Repository Root', ('repository', 'root')),
+                               ('Repository UUID', ('repository', 'uuid')),
+                               ('Copied From URL', ('wc-info',
+                                                    'copy-from-url')),
+                               ('Copied From Rev', ('wc-info',
+                                                    'copy-from-rev'))):
+                value = get_text(entry, *names)
+
+                if value is not None:
+                    svninfo[key] = value
+
+            result[path] = svninfo
+
+        return result
+
+    def _get_diff_paths(self, diff_content):
+        """
+        Returns the relative paths of the files named in the headers of a
+        diff.
+        """
+        paths = []
+        seen = {}
+
+        for line in diff_content:
+            if (self.DIFF_NEW_FILE_LINE_RE.match(line)
+                or self.DIFF_ORIG_FILE_LINE_RE.match(line)
+                or line.startswith('Index: ')):
+                line = line.split(" ", 1)[1]
+
+                if not line.startswith('/'):
+                    path = self.parse_filename_header(line)[0]
+
+                    if path not in seen:
+                        seen[path] = True
+                        paths.append(path)
+
+        return paths
+
     # Adapted from server code parser.py
     def parse_filename_header(self, s):
         parts = None
@@ -1853,6 +2977,26 @@ class PerforceClient(SCMClient):
     A wrapper around the p4 Perforce tool that fetches repository information
     and generates compatible diffs.
     """
+    # The number of files whose contents are fetched from the depot at once
+    # when generating a diff.
+    FETCH_BATCH_SIZE = 1000
+
+    def get_marker_files(self):
+        if 'P4CONFIG' in os.environ:
+            return (os.environ['P4CONFIG'],)
+
+        return ()
+
+    def __init__(self):
+        super(PerforceClient, self).__init__()
+
+        # Maps of depot paths to local copies of their contents and to
+        # their paths in the client workspace, filled in by
+        # _fetch_files().
+        self._fetched_files = {}
+        self._local_paths = {}
+        self._fetch_dir = None
+
     def get_repository_info(self):
         if not check_install('p4 help'):
             return None
@@ -1993,8 +3137,6 @@ class PerforceClient(SCMClient):
                                       r'(?P<revision2>,[#@][^,]+)?$')
 
         empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
 
         diff_lines = []
 
@@ -2041,59 +3183,104 @@ class PerforceClient(SCMClient):
                         except KeyError:
                             files[record['depotFile']] = [None, record]
 
-            old_file = new_file = empty_filename
-            changetype_short = None
-
-            for depot_path, (first_record, second_record) in files.items():
-                old_file = new_file = empty_filename
-                if first_record is None:
-                    self._write_file(depot_path + '#' + second_record['rev'],
-                                     tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                    changetype_short = 'A'
-                    base_revision = 0
-                elif second_record is None:
-                    self._write_file(depot_path + '#' + first_record['rev'],
-                                     tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                    changetype_short = 'D'
-                    base_revision = int(first_record['rev'])
-                elif first_record['rev'] == second_record['rev']:
-                    # We when we know the revisions are the same, we don't need
-                    # to do any diffing. This speeds up large revision-range
-                    # diffs quite a bit.
-                    continue
-                else:
-                    self._write_file(depot_path + '#' + first_record['rev'],
-                                     tmp_diff_from_filename)
-                    self._write_file(depot_path + '#' + second_record['rev'],
-                                     tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                    old_file = tmp_diff_from_filename
-                    changetype_short = 'M'
-                    base_revision = int(first_record['rev'])
-
-                dl = self._do_diff(old_file, new_file, depot_path,
-                                   base_revision, changetype_short,
-                                   ignore_unmodified=True)
-                diff_lines += dl
+            # We when we know the revisions are the same, we don't need
+            # to do any diffing. This speeds up large revision-range
+            # diffs quite a bit.
+            files = [
+                (depot_path, first_record, second_record)
+                for depot_path, (first_record, second_record) in files.items()
+                if (first_record is None or second_record is None or
+                    first_record['rev'] != second_record['rev'])
+            ]
+
+            for i in range(0, len(files), self.FETCH_BATCH_SIZE):
+                batch = files[i:i + self.FETCH_BATCH_SIZE]
+                depot_paths = []
+
+                for depot_path, first_record, second_record in batch:
+                    if first_record:
+                        depot_paths.append(depot_path + '#' +
+                                           first_record['rev'])
+
+                    if second_record:
+                        depot_paths.append(depot_path + '#' +
+                                           second_record['rev'])
+
+                self._fetch_files(depot_paths)
+
+                for dl in run_parallel(
+                        lambda f: self._path_diff_file(f, empty_filename),
+                        batch, options.jobs):
+                    diff_lines += dl
+
+                self._clear_fetched_files()
 
         os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
         return (''.join(diff_lines), None)
 
-    def _run_p4(self, command):
-        """Execute a perforce command using the python marshal API.
-
-        - command: A list of strings of the command to execute.
+    def _path_diff_file(self, file_records, empty_filename):
+        """
+        Generates the diff for one file in a path-style diff.
 
-        The return type depends on the command being run.
+        file_records is a (depot_path, first_record, second_record) tuple,
+        where either record may be None if the file doesn't exist at that
+        revision.
         """
-        command = ['p4', '-G'] + command
-        p = subprocess.Popen(command, stdout=subprocess.PIPE)
-        result = []
-        has_error = False
+        depot_path, first_record, second_record = file_records
+        tmp_diff_from_filename = make_tempfile()
+        tmp_diff_to_filename = make_tempfile()
+
+        old_file = new_file = empty_filename
+        if first_record is None:
+            new_file = self._get_file(depot_path + '#' + second_record['rev'],
+                                      tmp_diff_to_filename)
+            changetype_short = 'A'
+            base_revision = 0
+        elif second_record is None:
+            old_file = self._get_file(depot_path + '#' + first_record['rev'],
+                                      tmp_diff_from_filename)
+            changetype_short = 'D'
+            base_revision = int(first_record['rev'])
+        else:
+            old_file = self._get_file(depot_path + '#' + first_record['rev'],
+                                      tmp_diff_from_filename)
+            new_file = self._get_file(depot_path + '#' + second_record['rev'],
+                                      tmp_diff_to_filename)
+            changetype_short = 'M'
+            base_revision = int(first_record['rev'])
+
+        dl = self._do_diff(old_file, new_file, depot_path, base_revision,
+                           changetype_short, ignore_unmodified=True)
+
+        remove_tempfile(tmp_diff_from_filename)
+        remove_tempfile(tmp_diff_to_filename)
+
+        return dl
+
+    def _run_p4(self, command):
+        """Execute a perforce command using the python marshal API.
+
+        - command: A list of strings of the command to execute.
+
+        The return type depends on the command being run.
+        """
+        return list(self._run_p4_records(command))
+
+    def _run_p4_records(self, command, ignore_errors=False):
+        """Execute a perforce command using the python marshal API, yielding
+        each record as it's read.
+
+        - command: A list of strings of the command to execute.
+        - ignore_errors: If True, errors are left for the caller to find in
+          the records, rather than exiting.
+        """
+        command = ['p4', '-G'] + command
+        debug(subprocess.list2cmdline(command))
+        start_time = time.time()
+        p = subprocess.Popen(command, stdout=subprocess.PIPE)
+        messages = []
+        has_error = False
+        output_bytes = 0
 
         while 1:
             try:
@@ -2101,19 +3288,45 @@ class PerforceClient(SCMClient):
             except EOFError:
                 break
             else:
-                result.append(data)
-                if data.get('code', None) == 'error':
+                code = data.get('code', None)
+
+                if code == 'error':
                     has_error = True
 
+                if 'data' in data:
+                    output_bytes += len(data['data'])
+
+                # File contents from 'p4 print' are never part of the
+                # error output, so don't hold on to them.
+                if 'data' in data and code not in ('text', 'binary',
+                                                   'utf16', 'unicode'):
+                    messages.append(data['data'])
+
+                yield data
+
         rc = p.wait()
+        profiler.add_command(command, start_time, rc, output_bytes)
 
-        if rc or has_error:
-            for record in result:
-                if 'data' in record:
-                    print record['data']
+        if (rc or has_error) and not ignore_errors:
+            for message in messages:
+                print message
             die('Failed to execute command: %s\n' % (command,))
 
-        return result
+    def _run_p4_batch(self, command, args):
+        """Execute a perforce command on many arguments at once, yielding
+        each record as it's read.
+
+        The arguments are passed in an argument file, so there's no limit
+        on how many there can be. Errors are left for the caller to find in
+        the records.
+        """
+        argfile = make_tempfile('\n'.join(args) + '\n')
+
+        for record in self._run_p4_records(['-x', argfile] + command,
+                                           ignore_errors=True):
+            yield record
+
+        remove_tempfile(argfile)
 
     """
     Return a "sanitized" change number for submission to the Review Board
@@ -2217,8 +3430,8 @@ class PerforceClient(SCMClient):
         diff_lines = []
 
         empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
+
+        changes = []
 
         for line in description:
             line = line.strip()
@@ -2240,59 +3453,118 @@ class PerforceClient(SCMClient):
                 # actually the revision prior to this one
                 base_revision -= 1
 
-            changetype = m.group(3)
+            changes.append((depot_path, base_revision, m.group(3)))
 
-            debug('Processing %s of %s' % (changetype, depot_path))
+        for i in range(0, len(changes), self.FETCH_BATCH_SIZE):
+            batch = changes[i:i + self.FETCH_BATCH_SIZE]
+            diff_lines += self._changenum_diff_batch(batch, cl_is_pending,
+                                                     empty_filename)
 
-            old_file = new_file = empty_filename
-            old_depot_path = new_depot_path = None
-            changetype_short = None
+        os.unlink(empty_filename)
+        return (''.join(diff_lines), None)
 
-            if changetype in ['edit', 'integrate']:
-                # A big assumption
-                new_revision = base_revision + 1
+    def _changenum_diff_batch(self, changes, cl_is_pending, empty_filename):
+        """
+        Generates the diff for a batch of files in a changelist.
+
+        All of the depot files and client paths needed for the batch are
+        fetched up front, so only the files that can't be fetched that way
+        cost a p4 call of their own. The files are then diffed using up to
+        --jobs threads.
 
-                # We have an old file, get p4 to take this old version from the
-                # depot and put it into a plain old temp file for us
-                old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
+        changes is a list of (depot_path, base_revision, changetype) tuples.
+        """
+        depot_paths = []
+        local_paths = []
+
+        for depot_path, base_revision, changetype in changes:
+            if changetype in ['edit', 'integrate']:
+                depot_paths.append("%s#%s" % (depot_path, base_revision))
 
-                # Also print out the new file into a tmpfile
                 if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
+                    local_paths.append(depot_path)
                 else:
-                    new_depot_path = "%s#%s" %(depot_path, new_revision)
-                    self._write_file(new_depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-
-                changetype_short = "M"
+                    depot_paths.append("%s#%s" % (depot_path,
+                                                  base_revision + 1))
             elif changetype in ['add', 'branch', 'move/add']:
-                # We have a new file, get p4 to put this new file into a pretty
-                # temp file for us. No old file to worry about here.
                 if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
+                    local_paths.append(depot_path)
                 else:
-                    self._write_file(depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                changetype_short = "A"
+                    depot_paths.append(depot_path)
             elif changetype in ['delete', 'move/delete']:
-                # We've deleted a file, get p4 to put the deleted file into  a temp
-                # file for us. The new file remains the empty file.
-                old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
-                changetype_short = "D"
-            else:
-                die("Unknown change type '%s' for %s" % (changetype, depot_path))
+                depot_paths.append("%s#%s" % (depot_path, base_revision))
+
+        self._fetch_files(depot_paths, local_paths)
+
+        diff_lines = []
 
-            dl = self._do_diff(old_file, new_file, depot_path, base_revision, changetype_short)
+        for dl in run_parallel(
+                lambda change: self._changenum_diff_file(
+                    change, cl_is_pending, empty_filename),
+                changes, options.jobs):
             diff_lines += dl
 
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
-        return (''.join(diff_lines), None)
+        self._clear_fetched_files()
+
+        return diff_lines
+
+    def _changenum_diff_file(self, change, cl_is_pending, empty_filename):
+        """
+        Generates the diff for one file in a changelist.
+
+        change is a (depot_path, base_revision, changetype) tuple.
+        """
+        depot_path, base_revision, changetype = change
+        debug('Processing %s of %s' % (changetype, depot_path))
+
+        tmp_diff_from_filename = make_tempfile()
+        tmp_diff_to_filename = make_tempfile()
+
+        old_file = new_file = empty_filename
+        old_depot_path = new_depot_path = None
+        changetype_short = None
+
+        if changetype in ['edit', 'integrate']:
+            # A big assumption
+            new_revision = base_revision + 1
+
+            # We have an old file, get p4 to take this old version from the
+            # depot and put it into a plain old temp file for us
+            old_depot_path = "%s#%s" % (depot_path, base_revision)
+            old_file = self._get_file(old_depot_path, tmp_diff_from_filename)
+
+            # Also print out the new file into a tmpfile
+            if cl_is_pending:
+                new_file = self._depot_to_local(depot_path)
+            else:
+                new_depot_path = "%s#%s" %(depot_path, new_revision)
+                new_file = self._get_file(new_depot_path,
+                                          tmp_diff_to_filename)
+
+            changetype_short = "M"
+        elif changetype in ['add', 'branch', 'move/add']:
+            # We have a new file, get p4 to put this new file into a pretty
+            # temp file for us. No old file to worry about here.
+            if cl_is_pending:
+                new_file = self._depot_to_local(depot_path)
+            else:
+                new_file = self._get_file(depot_path, tmp_diff_to_filename)
+            changetype_short = "A"
+        elif changetype in ['delete', 'move/delete']:
+            # We've deleted a file, get p4 to put the deleted file into  a temp
+            # file for us. The new file remains the empty file.
+            old_depot_path = "%s#%s" % (depot_path, base_revision)
+            old_file = self._get_file(old_depot_path, tmp_diff_from_filename)
+            changetype_short = "D"
+        else:
+            die("Unknown change type '%s' for %s" % (changetype, depot_path))
+
+        dl = self._do_diff(old_file, new_file, depot_path, base_revision, changetype_short)
+
+        remove_tempfile(tmp_diff_from_filename)
+        remove_tempfile(tmp_diff_to_filename)
+
+        return dl
 
     def _do_diff(self, old_file, new_file, depot_path, base_revision,
                  changetype_short, ignore_unmodified=False):
@@ -2310,32 +3582,17 @@ class PerforceClient(SCMClient):
 
         Returns a list of strings of diff lines.
         """
-        if hasattr(os, 'uname') and os.uname()[0] == 'SunOS':
-            diff_cmd = ["gdiff", "-urNp", old_file, new_file]
-        else:
-            diff_cmd = ["diff", "-urNp", old_file, new_file]
-        # Diff returns "1" if differences were found.
-        dl = execute(diff_cmd, extra_ignore_errors=(1,2),
-                     translate_newlines=False)
-
-        # If the input file has ^M characters at end of line, lets ignore them.
-        dl = dl.replace('\r\r\n', '\r\n')
-        dl = dl.splitlines(True)
-
         cwd = os.getcwd()
         if depot_path.startswith(cwd):
             local_path = depot_path[len(cwd) + 1:]
         else:
             local_path = depot_path
 
-        # Special handling for the output of the diff tool on binary files:
-        #     diff outputs "Files a and b differ"
-        # and the code below expects the output to start with
-        #     "Binary files "
-        if len(dl) == 1 and \
-           dl[0].startswith('Files %s and %s differ' %
-                            (old_file, new_file)):
-            dl = ['Binary files %s and %s differ\n' % (old_file, new_file)]
+        timestamp = format_diff_timestamp(_get_mtime(new_file))
+        dl = diff_files(old_file, new_file,
+                        "%s\t%s#%s" % (local_path, depot_path, base_revision),
+                        "%s\t%s" % (local_path, timestamp),
+                        show_c_function=True)
 
         if dl == [] or dl[0].startswith("Binary files "):
             if dl == []:
@@ -2349,39 +3606,6 @@ class PerforceClient(SCMClient):
                 (depot_path, base_revision, changetype_short, local_path))
             dl.append('\n')
         elif len(dl) > 1:
-            m = re.search(r'(\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)', dl[1])
-            if m:
-                timestamp = m.group(1)
-            else:
-                # Thu Sep  3 11:24:48 2007
-                m = re.search(r'(\w+)\s+(\w+)\s+(\d+)\s+(\d\d:\d\d:\d\d)\s+(\d\d\d\d)', dl[1])
-                if not m:
-                    die("Unable to parse diff header: %s" % dl[1])
-
-                month_map = {
-                    "Jan": "01",
-                    "Feb": "02",
-                    "Mar": "03",
-                    "Apr": "04",
-                    "May": "05",
-                    "Jun": "06",
-                    "Jul": "07",
-                    "Aug": "08",
-                    "Sep": "09",
-                    "Oct": "10",
-                    "Nov": "11",
-                    "Dec": "12",
-                }
-                month = month_map[m.group(2)]
-                day = m.group(3)
-                timestamp = m.group(4)
-                year = m.group(5)
-
-                timestamp = "%s-%s-%s %s" % (year, month, day, timestamp)
-
-            dl[0] = "--- %s\t%s#%s\n" % (local_path, depot_path, base_revision)
-            dl[1] = "+++ %s\t%s\n" % (local_path, timestamp)
-
             # Not everybody has files that end in a newline (ugh). This ensures
             # that the resulting diff file isn't broken.
             if dl[-1][-1] != '\n':
@@ -2401,12 +3625,112 @@ class PerforceClient(SCMClient):
         execute(["p4", "print", "-o", tmpfile, "-q", depot_path])
         os.chmod(tmpfile, stat.S_IREAD | stat.S_IWRITE)
 
+    def _fetch_files(self, depot_paths, local_paths=[]):
+        """
+        Fetches the contents of many depot files, and the client paths of
+        many others, with one p4 call each.
+
+        depot_paths are depot paths with an optional #rev, as passed to
+        _get_file(). local_paths are depot paths, as passed to
+        _depot_to_local(). Anything that can't be fetched here is left for
+        those functions to look up (and report errors for) on their own.
+        """
+        self._clear_fetched_files()
+
+        if depot_paths:
+            self._fetch_dir = make_tempdir()
+            self._print_files(depot_paths)
+
+        if local_paths:
+            for record in self._run_p4_batch(['where'], local_paths):
+                if 'depotFile' in record and 'path' in record:
+                    # Like _depot_to_local, the last mapping wins.
+                    self._local_paths[record['depotFile']] = record['path']
+
+    def _print_files(self, depot_paths):
+        """
+        Writes the contents of the given depot files into the fetch
+        directory using a single 'p4 print'.
+        """
+        # 'p4 print' reports the depot path and revision of each file, so
+        # map that back to what was asked for.
+        wanted = {}
+
+        for depot_path in depot_paths:
+            if '#' in depot_path:
+                path, rev = depot_path.rsplit('#', 1)
+                wanted[(path, rev)] = depot_path
+            else:
+                wanted[depot_path] = depot_path
+
+        fp = None
+        translate_newlines = (os.linesep != '\n')
+
+        for record in self._run_p4_batch(['print'], depot_paths):
+            code = record.get('code', None)
+
+            if code == 'stat':
+                if fp:
+                    fp.close()
+                    fp = None
+
+                depot_path = (wanted.get((record['depotFile'],
+                                          record['rev'])) or
+                              wanted.get(record['depotFile']))
+
+                if depot_path and depot_path not in self._fetched_files:
+                    filename = os.path.join(self._fetch_dir,
+                                            str(len(self._fetched_files)))
+                    fp = open(filename, 'wb')
+                    self._fetched_files[depot_path] = filename
+            elif code in ('text', 'binary', 'utf16', 'unicode'):
+                if fp:
+                    data = record['data']
+
+                    # 'p4 print -o' writes text files with local line
+                    # endings, so do the same.
+                    if code == 'text' and translate_newlines:
+                        data = data.replace('\n', os.linesep)
+
+                    fp.write(data)
+            elif code == 'error':
+                debug(record['data'])
+
+        if fp:
+            fp.close()
+
+    def _clear_fetched_files(self):
+        """Removes any files fetched by _fetch_files()."""
+        if self._fetch_dir:
+            shutil.rmtree(self._fetch_dir, ignore_errors=True)
+            tempdirs.remove(self._fetch_dir)
+            self._fetch_dir = None
+
+        self._fetched_files = {}
+        self._local_paths = {}
+
+    def _get_file(self, depot_path, tmpfile):
+        """
+        Returns the path to a local copy of a depot file's contents.
+
+        If the file was fetched by _fetch_files(), that copy is used.
+        Otherwise, the file is written to tmpfile.
+        """
+        if depot_path in self._fetched_files:
+            return self._fetched_files[depot_path]
+
+        self._write_file(depot_path, tmpfile)
+        return tmpfile
+
     def _depot_to_local(self, depot_path):
         """
         Given a path in the depot return the path on the local filesystem to
         the same file.  If there are multiple results, take only the last
         result from the where command.
         """
+        if depot_path in self._local_paths:
+            return self._local_paths[depot_path]
+
         where_output = self._run_p4(['where', depot_path])
 
         try:
@@ -2416,11 +3740,120 @@ class PerforceClient(SCMClient):
             return where_output[-1]['data'].split(' ')[2].strip()
 
 
+class HgCommandServer(object):
+    """
+    A persistent Mercurial command server, started with
+    ``hg serve --cmdserver pipe``.
+
+    Commands are sent to the server over its pipe, which saves starting a
+    new hg process (and loading the repository) for every command.
+    """
+    command = ['hg', 'serve', '--cmdserver', 'pipe']
+
+    def __init__(self, env):
+        self.env = env
+        self.process = None
+
+    def start(self):
+        """
+        Starts the server, returning whether it's ready to run commands.
+        """
+        try:
+            self.process = _start_process(self.command, self.env.copy(),
+                                          translate_newlines=False,
+                                          with_errors=False)
+            channel, hello = self._read_channel()
+        except (OSError, IOError, struct.error), e:
+            debug('Unable to start the Mercurial command server: %s' % e)
+            self.close()
+            return False
+
+        capabilities = []
+
+        for line in hello.splitlines():
+            if line.startswith('capabilities:'):
+                capabilities = line.split(':', 1)[1].split()
+
+        if channel != 'o' or 'runcommand' not in capabilities:
+            debug('The Mercurial command server is not usable: %r' % hello)
+            self.close()
+            return False
+
+        return True
+
+    def run_command(self, args):
+        """
+        Runs an hg command on the server, returning its exit code and its
+        output, with errors mixed in as they appear.
+
+        Raises IOError if the server has gone away.
+        """
+        debug('hg cmdserver: %s' % subprocess.list2cmdline(args))
+        data = '\0'.join(args)
+
+        try:
+            self.process.stdin.write('runcommand\n')
+            self.process.stdin.write(struct.pack('>I', len(data)) + data)
+            self.process.stdin.flush()
+
+            output = []
+
+            while True:
+                channel, data = self._read_channel()
+
+                if channel in ('o', 'e'):
+                    output.append(data)
+                elif channel == 'r':
+                    return struct.unpack('>i', data)[0], ''.join(output)
+                elif channel in ('I', 'L'):
+                    # Commands get no input, the same as when run with
+                    # execute().
+                    self.process.stdin.write(struct.pack('>I', 0))
+                    self.process.stdin.flush()
+                elif channel.isupper():
+                    raise IOError('Unexpected required channel %r' %
+                                  channel)
+        except struct.error, e:
+            raise IOError('Malformed command server response: %s' % e)
+
+    def close(self):
+        """Shuts down the server."""
+        if self.process:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (OSError, IOError):
+                pass
+
+            self.process = None
+
+    def _read_channel(self):
+        """
+        Reads the next message from the server, returning the channel and
+        the data. Input channels have no data, only the length wanted.
+        """
+        header = self.process.stdout.read(5)
+
+        if len(header) < 5:
+            raise IOError('The Mercurial command server exited')
+
+        channel = header[0]
+        length = struct.unpack('>I', header[1:])[0]
+
+        if channel in ('I', 'L'):
+            return channel, ''
+
+        return channel, self.process.stdout.read(length)
+
+
 class MercurialClient(SCMClient):
     """
     A wrapper around the hg Mercurial tool that fetches repository
     information and generates compatible diffs.
     """
+    marker_files = ('.hg',)
+
+    NODE_RE = re.compile(r'^[0-9a-f]{40}$')
 
     def __init__(self):
         self.hgrc = {}
@@ -2431,6 +3864,7 @@ class MercurialClient(SCMClient):
             'HGRCPATH': os.devnull,
             'HGPLAIN': '1',
         }
+        self._hg_server = None
 
         # `self._remote_path_candidates` is an ordered set of hgrc
         # paths that are checked if `parent_branch` option is not given
@@ -2507,8 +3941,7 @@ class MercurialClient(SCMClient):
     @property
     def hg_root(self):
         if not self._hg_root:
-            root = execute(['hg', 'root'], env=self._hg_env,
-                           ignore_errors=True)
+            root = self._run_hg(['root'], ignore_errors=True)
 
             if not root.startswith('abort:'):
                 self._hg_root = root.strip()
@@ -2517,6 +3950,61 @@ class MercurialClient(SCMClient):
 
         return self._hg_root
 
+    def _run_hg(self, args, split_lines=False, ignore_errors=False):
+        """
+        Runs an hg command with the plain, isolated hg environment.
+
+        If the command server was requested, the command is sent to it,
+        falling back on running hg directly if the server isn't available.
+        """
+        server = self._get_hg_server()
+
+        if server:
+            try:
+                rc, data = server.run_command(args)
+            except IOError, e:
+                debug('Lost the Mercurial command server: %s' % e)
+                server.close()
+                self._hg_server = False
+            else:
+                data = data.replace('\r\n', '\n').replace('\r', '\n')
+
+                if rc and not ignore_errors:
+                    die('Failed to execute command: %s\n%s' %
+                        (['hg'] + args, data))
+
+                if split_lines:
+                    return data.splitlines(True)
+
+                return data
+
+        return execute(['hg'] + args, env=self._hg_env,
+                       split_lines=split_lines, ignore_errors=ignore_errors)
+
+    def _get_hg_server(self):
+        """
+        Returns the command server, starting it if needed, or None if it
+        wasn't requested or couldn't be started.
+
+        The server is only started once the repository has been found.
+        """
+        if (self._hg_server is None and self._hg_root and
+            getattr(options, 'hg_command_server', False)):
+            server = HgCommandServer(self._hg_env)
+
+            if server.start():
+                self._hg_server = server
+            else:
+                self._hg_server = False
+
+        return self._hg_server or None
+
+    def close(self):
+        if self._hg_server:
+            self._hg_server.close()
+
+        self._hg_server = None
+
     def _load_hgrc(self):
         for line in execute(['hg', 'showconfig'], split_lines=True):
             key, value = line.split('=', 1)
@@ -2526,23 +4014,23 @@ class MercurialClient(SCMClient):
         """
         Extracts the first line from the description of the given changeset.
         """
-        return execute(['hg', 'log', '-r%s' % revision, '--template',
-                        r'{desc|firstline}\n'], env=self._hg_env)
+        return self._run_hg(['log', '-r%s' % revision, '--template',
+                             r'{desc|firstline}\n'])
 
     def extract_description(self, rev1, rev2):
         """
         Extracts all descriptions in the given revision range and concatenates
         them, most recent ones going first.
         """
-        numrevs = len(execute([
-            'hg', 'log', '-r%s:%s' % (rev2, rev1),
-            '--follow', '--template', r'{rev}\n'], env=self._hg_env
+        numrevs = len(self._run_hg([
+            'log', '-r%s:%s' % (rev2, rev1),
+            '--follow', '--template', r'{rev}\n']
         ).strip().split('\n'))
 
-        return execute(['hg', 'log', '-r%s:%s' % (rev2, rev1),
-                        '--follow', '--template',
-                        r'{desc}\n\n', '--limit',
-                        str(numrevs - 1)], env=self._hg_env).strip()
+        return self._run_hg(['log', '-r%s:%s' % (rev2, rev1),
+                             '--follow', '--template',
+                             r'{desc}\n\n', '--limit',
+                             str(numrevs - 1)]).strip()
 
     def diff(self, files):
         """
@@ -2604,7 +4092,7 @@ class MercurialClient(SCMClient):
         if not remote and options.parent_branch:
             remote = options.parent_branch
 
-        current_branch = execute(['hg', 'branch'], env=self._hg_env).strip()
+        current_branch = self._run_hg(['branch']).strip()
 
         outgoing_changesets = \
             self._get_outgoing_changesets(current_branch, remote)
@@ -2618,20 +4106,28 @@ class MercurialClient(SCMClient):
         if options.guess_description and not options.description:
             options.description = self.extract_description(bottom_rev, top_rev)
 
-        full_command = ['hg', 'diff', '-r', str(bottom_rev), '-r',
+        full_command = ['diff', '-r', str(bottom_rev), '-r',
                         str(top_rev)] + files
 
-        return (execute(full_command, env=self._hg_env), None)
+        return (self._run_hg(full_command), None)
 
     def _get_outgoing_changesets(self, current_branch, remote):
         """
         Given the current branch name and a remote path, return a list
         of outgoing changeset numbers.
         """
+        if options.local_outgoing:
+            outgoing_changesets = self._get_local_outgoing_changesets(remote)
+
+            if outgoing_changesets is not None:
+                return outgoing_changesets
+
+            debug('Unable to find outgoing changesets locally. Falling back '
+                  'on hg outgoing')
+
         outgoing_changesets = []
-        raw_outgoing = execute(['hg', '-q', 'outgoing', '--template',
-                                'b:{branches}\nr:{rev}\n\n', remote],
-                               env=self._hg_env)
+        raw_outgoing = self._run_hg(['-q', 'outgoing', '--template',
+                                     'b:{branches}\nr:{rev}\n\n', remote])
 
         for pair in raw_outgoing.split('\n\n'):
             if not pair.strip():
@@ -2650,15 +4146,106 @@ class MercurialClient(SCMClient):
 
         return outgoing_changesets
 
+    def _get_local_outgoing_changesets(self, remote):
+        """
+        Works out the outgoing changesets on the current branch without
+        contacting the remote, returning None if that isn't possible.
+
+        If the repository has phases, the outgoing changesets are the draft
+        ones. Otherwise, they're the ones that aren't ancestors of the
+        remote's heads as of the last time they were looked up. The heads
+        are only looked up again if there are none cached yet, or if
+        --refresh-remote is passed.
+        """
+        if not options.refresh_remote:
+            revs = self._get_revset_revs('draft() and branch(.)')
+
+            if revs is not None:
+                debug('Using draft changesets as the outgoing changesets')
+                return revs
+
+        cache = None
+        cache_key = '%s:%s' % (self.hg_root, remote)
+        remote_heads = None
+        cache_dir = get_cache_dir()
+
+        if cache_dir:
+            cache = DataCache(os.path.join(cache_dir, 'hg-remotes.json'))
+
+            entry = cache.get(cache_key)
+
+            if entry and not options.refresh_remote:
+                remote_heads = entry['heads']
+
+        if remote_heads is None:
+            remote_heads = self._get_remote_heads(remote)
+
+            if remote_heads is None:
+                return None
+
+            if cache:
+                cache.set(cache_key, {'heads': remote_heads})
+
+        if remote_heads:
+            revset = 'branch(.) - ::(%s)' % ' or '.join(remote_heads)
+        else:
+            revset = 'branch(.)'
+
+        return self._get_revset_revs(revset)
+
+    def _get_remote_heads(self, remote):
+        """
+        Returns the nodes of the local heads that the remote also has, or
+        None if they can't be determined.
+
+        This contacts the remote, through a single hg outgoing.
+        """
+        data = self._run_hg(['-q', 'outgoing', '--template', '{node}\n',
+                             remote], ignore_errors=True)
+        outgoing = data.split()
+
+        for node in outgoing:
+            if not self.NODE_RE.match(node):
+                return None
+
+        if outgoing:
+            revset = 'heads(all() - (%s))' % ' or '.join(outgoing)
+        else:
+            revset = 'heads(all())'
+
+        data = self._run_hg(['log', '-r', revset, '--template', '{node}\n'],
+                            ignore_errors=True)
+        heads = data.split()
+
+        for node in heads:
+            if not self.NODE_RE.match(node):
+                return None
+
+        return heads
+
+    def _get_revset_revs(self, revset):
+        """
+        Returns the revision numbers matching a revset, or None if hg
+        couldn't evaluate it.
+        """
+        data = self._run_hg(['log', '-r', revset, '--template', '{rev}\n'],
+                            ignore_errors=True)
+        revs = data.split()
+
+        for rev in revs:
+            if not rev.isdigit():
+                return None
+
+        return [int(rev) for rev in revs]
+
     def _get_top_and_bottom_outgoing_revs(self, outgoing_changesets):
         # This is a classmethod rather than a func mostly just to keep the
         # module namespace clean.  Pylint told me to do it.
         top_rev = max(outgoing_changesets)
         bottom_rev = min(outgoing_changesets)
 
-        parents = execute(["hg", "log", "-r", str(bottom_rev),
-                           "--template", "{parents}"],
-                          env=self._hg_env)
+        parents = self._run_hg(["log", "-r", str(bottom_rev),
+                                "--template", "{parents}"])
         parents = parents.rstrip("\n").split(":")
 
         if len(parents) > 1:
@@ -2695,8 +4282,7 @@ class MercurialClient(SCMClient):
         if options.guess_description and not options.description:
             options.description = self.extract_description(r1, r2)
 
-        return (execute(["hg", "diff", "-r", r1, "-r", r2],
-                        env=self._hg_env), None)
+        return (self._run_hg(["diff", "-r", r1, "-r", r2]), None)
 
     def scan_for_server(self, repository_info):
         # Scan first for dot files, since it's faster and will cover the
@@ -2724,10 +4310,17 @@ class GitClient(SCMClient):
     compatible diffs. This will attempt to generate a diff suitable for the
     remote repository, whether git, SVN or Perforce.
     """
+    marker_files = ('.git',)
+
     def __init__(self):
         SCMClient.__init__(self)
         # Store the 'correct' way to invoke git, just plain old 'git' by default
         self.git = 'git'
+        self._config = None
+
+    def is_marker_required(self):
+        # GIT_DIR can point at a repository from anywhere.
+        return 'GIT_DIR' not in os.environ
 
     def _strip_heads_prefix(self, ref):
         """ Strips prefix from ref name, if possible """
@@ -2743,20 +4336,33 @@ class GitClient(SCMClient):
             else:
                 return None
 
-        git_dir = execute([self.git, "rev-parse", "--git-dir"],
-                          ignore_errors=True).rstrip("\n")
+        # Look up the git directory and the current branch in one go.
+        data = execute([self.git, "rev-parse", "--git-dir",
+                        "--symbolic-full-name", "HEAD"],
+                       ignore_errors=True, with_errors=False).splitlines()
 
-        if git_dir.startswith("fatal:") or not os.path.isdir(git_dir):
+        if not data or not os.path.isdir(data[0]):
             return None
-        self.bare = execute([self.git, "config", "core.bare"]).strip() == 'true'
+
+        git_dir = data[0]
+
+        if len(data) > 1 and data[1] != 'HEAD':
+            self.head_ref = data[1]
+        else:
+            # rev-parse prints HEAD as-is both for a detached HEAD and for
+            # a branch with no commits yet, where it fails. Only the latter
+            # has a branch to ask for.
+            self.head_ref = execute([self.git, "symbolic-ref", "-q", "HEAD"],
+                                    ignore_errors=True).strip() or 'HEAD'
+
+        self._load_config()
+        self.bare = self._get_config('core.bare') == 'true'
 
         # post-review in directories other than the top level of
         # of a work-tree would result in broken diffs on the server
         if not self.bare:
             os.chdir(os.path.dirname(os.path.abspath(git_dir)))
 
-        self.head_ref = execute([self.git, 'symbolic-ref', '-q', 'HEAD']).strip()
-
         # We know we have something we can work with. Let's find out
         # what it is. We'll try SVN first, but only if there's a .git/svn
         # directory. Otherwise, it may attempt to create one and scan
@@ -2808,9 +4414,7 @@ class GitClient(SCMClient):
                                   ignore_errors=True)
                 version_parts = re.search('version (\d+)\.(\d+)\.(\d+)',
                                           version)
-                svn_remote = execute([self.git, "config", "--get",
-                                      "svn-remote.svn.url"],
-                                      ignore_errors=True)
+                svn_remote = self._get_config('svn-remote.svn.url')
 
                 if (version_parts and
                     not self.is_valid_version((int(version_parts.group(1)),
@@ -2827,12 +4431,8 @@ class GitClient(SCMClient):
         # Nope, it's git then.
         # Check for a tracking branch and determine merge-base
         short_head = self._strip_heads_prefix(self.head_ref)
-        merge = execute([self.git, 'config', '--get',
-                         'branch.%s.merge' % short_head],
-                        ignore_errors=True).strip()
-        remote = execute([self.git, 'config', '--get',
-                          'branch.%s.remote' % short_head],
-                         ignore_errors=True).strip()
+        merge = self._get_config('branch.%s.merge' % short_head)
+        remote = self._get_config('branch.%s.remote' % short_head)
 
         merge = self._strip_heads_prefix(merge)
         self.upstream_branch = ''
@@ -2876,11 +4476,63 @@ class GitClient(SCMClient):
         upstream_branch = options.tracking or default_upstream_branch or \
                           'origin/master'
         upstream_remote = upstream_branch.split('/')[0]
-        origin_url = execute([self.git, "config", "--get",
-                              "remote.%s.url" % upstream_remote],
-                              ignore_errors=True).rstrip("\n")
+        origin_url = self._get_config('remote.%s.url' % upstream_remote)
         return (upstream_branch, origin_url)
 
+    def _load_config(self):
+        """
+        Loads the repository's git configuration with a single git call, so
+        that settings can be looked up without running git each time.
+        """
+        self._config = self._parse_config(
+            execute([self.git, "config", "--list", "-z"],
+                    ignore_errors=True, with_errors=False))
+
+    def _parse_config(self, data):
+        """
+        Parses the output of "git config --list -z" into a dictionary.
+
+        Section and variable names are case-insensitive, so they're
+        lowercased. Subsection names are case-sensitive and kept as-is. If a
+        variable is set more than once, the last value wins, as with
+        "git config --get".
+        """
+        config = {}
+
+        for entry in data.split('\0'):
+            if not entry:
+                continue
+
+            if '\n' in entry:
+                key, value = entry.split('\n', 1)
+            else:
+                # Variables without a value, such as "[core] bare".
+                key, value = entry, ''
+
+            config[self._normalize_config_key(key)] = value
+
+        return config
+
+    def _normalize_config_key(self, key):
+        """Lowercases the case-insensitive parts of a config key."""
+        section, rest = key.split('.', 1)
+
+        if '.' in rest:
+            subsection, name = rest.rsplit('.', 1)
+            return '%s.%s.%s' % (section.lower(), subsection, name.lower())
+
+        return '%s.%s' % (section.lower(), rest.lower())
+
+    def _get_config(self, key):
+        """
+        Returns the value of a git config setting, or an empty string if
+        it's not set.
+        """
+        if self._config is None:
+            self._load_config()
+
+        return self._config.get(self._normalize_config_key(key), '')
+
     def is_valid_version(self, actual, expected):
         """
         Takes two tuples, both in the form:
@@ -2902,8 +4554,7 @@ class GitClient(SCMClient):
             return server_url
 
         # TODO: Maybe support a server per remote later? Is that useful?
-        url = execute([self.git, "config", "--get", "reviewboard.url"],
-                      ignore_errors=True).strip()
+        url = self._get_config('reviewboard.url').strip()
         if url:
             return url
 
@@ -2957,11 +4608,13 @@ class GitClient(SCMClient):
             rev_range = ancestor
 
         if self.type == "svn":
-            diff_lines = execute([self.git, "diff", "--no-color", "--no-prefix",
-                                  "--no-ext-diff", "-r", "-u", rev_range],
-                                 split_lines=True)
+            diff_lines = execute_stream([self.git, "diff", "--no-color",
+                                         "--no-prefix", "--no-ext-diff", "-r",
+                                         "-u", rev_range])
             return self.make_svn_diff(ancestor, diff_lines)
         elif self.type == "git":
+            # This diff isn't post-processed, so it's read as a single
+            # string, which is what's uploaded.
             return execute([self.git, "diff", "--no-color", "--full-index",
                             "--no-ext-diff", rev_range])
 
@@ -2978,8 +4631,23 @@ class GitClient(SCMClient):
         if not rev:
             return None
 
-        diff_data = ""
-        filename = ""
+        # The diff is uploaded as one string, so it has to be built up in
+        # memory. Writing each line to a buffer avoids also holding a list
+        # of every line, which takes more memory than the diff itself.
+        buf = StringIO()
+
+        for line in self._convert_to_svn_diff(diff_lines, rev):
+            buf.write(line)
+
+        return buf.getvalue()
+
+    def _convert_to_svn_diff(self, diff_lines, rev):
+        """
+        Converts the lines of a git diff to the lines of an svn diff against
+        the given revision.
+
+        This is a generator, so a diff can be converted a line at a time.
+        """
         newfile = False
 
         for line in diff_lines:
@@ -2989,9 +4657,8 @@ class GitClient(SCMClient):
                 #
                 # diff --git a/path/to/file b/path/to/file
                 info = line.split(" ")
-                diff_data += "Index: %s\n" % info[2]
-                diff_data += "=" * 67
-                diff_data += "\n"
+                yield "Index: %s\n" % info[2]
+                yield "=" * 67 + "\n"
             elif line.startswith("index "):
                 # Filter this out.
                 pass
@@ -3000,27 +4667,24 @@ class GitClient(SCMClient):
                 newfile = True
             elif line.startswith("--- "):
                 newfile = False
-                diff_data += "--- %s\t(revision %s)\n" % \
-                             (line[4:].strip(), rev)
+                yield "--- %s\t(revision %s)\n" % (line[4:].strip(), rev)
             elif line.startswith("+++ "):
                 filename = line[4:].strip()
                 if newfile:
-                    diff_data += "--- %s\t(revision 0)\n" % filename
-                    diff_data += "+++ %s\t(revision 0)\n" % filename
+                    yield "--- %s\t(revision 0)\n" % filename
+                    yield "+++ %s\t(revision 0)\n" % filename
                 else:
                     # We already printed the "--- " line.
-                    diff_data += "+++ %s\t(working copy)\n" % filename
+                    yield "+++ %s\t(working copy)\n" % filename
             elif line.startswith("new file mode"):
                 # Filter this out.
                 pass
             elif line.startswith("Binary files "):
                 # Add the following so that we know binary files were added/changed
-                diff_data += "Cannot display: file marked as a binary type.\n"
-                diff_data += "svn:mime-type = application/octet-stream\n"
+                yield "Cannot display: file marked as a binary type.\n"
+                yield "svn:mime-type = application/octet-stream\n"
             else:
-                diff_data += line
-
-        return diff_data
+                yield line
 
     def diff_between_revisions(self, revision_range, args, repository_info):
         """Perform a diff between two arbitrary revisions"""
@@ -3084,6 +4748,13 @@ class PlasticClient(SCMClient):
     A wrapper around the cm Plastic tool that fetches repository
     information and generates compatible diffs
     """
+    marker_files = ('.plastic',)
+
+    def __init__(self):
+        SCMClient.__init__(self)
+        self._revision_files = {}
+        self._fetch_dir = None
+
     def get_repository_info(self):
         if not check_install('cm version'):
             return None
@@ -3155,13 +4826,13 @@ class PlasticClient(SCMClient):
 
     def changenum_diff(self, changenum):
         debug("changenum_diff: %s" % (changenum))
-        files = execute(["cm", "log", "cs:" + changenum,
-                         "--csFormat={items}",
-                         "--itemFormat={shortstatus} {path} "
-                         "rev:revid:{revid} rev:revid:{parentrevid} "
-                         "src:{srccmpath} rev:revid:{srcdirrevid} "
-                         "dst:{dstcmpath} rev:revid:{dstdirrevid}{newline}"],
-                        split_lines = True)
+        files = run_cm(["log", "cs:" + changenum,
+                        "--csFormat={items}",
+                        "--itemFormat={shortstatus} {path} "
+                        "rev:revid:{revid} rev:revid:{parentrevid} "
+                        "src:{srccmpath} rev:revid:{srcdirrevid} "
+                        "dst:{dstcmpath} rev:revid:{dstdirrevid}{newline}"],
+                       split_lines = True)
 
         debug("got files: %s" % (files))
 
@@ -3169,8 +4840,7 @@ class PlasticClient(SCMClient):
         diff_lines = []
 
         empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
+        changes = []
 
         for f in files:
             f = f.strip()
@@ -3189,95 +4859,137 @@ class PlasticClient(SCMClient):
             if not m:
                 die("Could not parse 'cm log' response: %s" % f)
 
-            changetype = m.group("type")
-            filename = m.group("file")
-
-            if changetype == "M":
-                # Handle moved files as a delete followed by an add.
-                # Clunky, but at least it works
-                oldfilename = m.group("srcpath")
-                oldspec = m.group("srcrevspec")
-                newfilename = m.group("dstpath")
-                newspec = m.group("dstrevspec")
-
-                self.write_file(oldfilename, oldspec, tmp_diff_from_filename)
-                dl = self.diff_files(tmp_diff_from_filename, empty_filename,
-                                     oldfilename, "rev:revid:-1", oldspec,
-                                     changetype)
-                diff_lines += dl
-
-                self.write_file(newfilename, newspec, tmp_diff_to_filename)
-                dl = self.diff_files(empty_filename, tmp_diff_to_filename,
-                                     newfilename, newspec, "rev:revid:-1",
-                                     changetype)
-                diff_lines += dl
-            else:
-                newrevspec = m.group("revspec")
-                parentrevspec = m.group("parentrevspec")
-
-                debug("Type %s File %s Old %s New %s" % (changetype,
-                                                         filename,
-                                                         parentrevspec,
-                                                         newrevspec))
-
-                old_file = new_file = empty_filename
-
-                if (changetype in ['A'] or
-                    (changetype in ['C', 'I'] and
-                     parentrevspec == "rev:revid:-1")):
-                    # File was Added, or a Change or Merge (type I) and there
-                    # is no parent revision
-                    self.write_file(filename, newrevspec, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                elif changetype in ['C', 'I']:
-                    # File was Changed or Merged (type I)
-                    self.write_file(filename, parentrevspec,
-                                    tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                    self.write_file(filename, newrevspec, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                elif changetype in ['R']:
-                    # File was Removed
-                    self.write_file(filename, parentrevspec,
-                                    tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
-                else:
-                    die("Don't know how to handle change type '%s' for %s" %
-                        (changetype, filename))
-
-                dl = self.diff_files(old_file, new_file, filename,
-                                     newrevspec, parentrevspec, changetype)
-                diff_lines += dl
-
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
+            changes.append(m)
 
-        return ''.join(diff_lines)
+        # Fetch every revision needed up front, before any diffing.
+        revspecs = []
 
-    def branch_diff(self, args):
-        debug("branch diff: %s" % (args))
+        for m in changes:
+            revspecs += self._get_changenum_revspecs(m)
 
-        if len(args) > 0:
-            branch = args[0]
-        else:
-            branch = args
+        self._fetch_revisions(revspecs)
 
-        if not branch.startswith("br:"):
-            return None
+        # Files are diffed using up to --jobs threads, but the results are
+        # kept in the original order.
+        for dl in run_parallel(
+                lambda m: self._changenum_diff_file(m, empty_filename),
+                changes, options.jobs):
+            diff_lines += dl
 
-        if not options.branch:
-            options.branch = branch
+        os.unlink(empty_filename)
+        self._clear_fetched_revisions()
 
-        files = execute(["cm", "fbc", branch, "--format={3} {4}"],
-                        split_lines = True)
-        debug("got files: %s" % (files))
+        return ''.join(diff_lines)
 
+    def _get_changenum_revspecs(self, m):
+        """
+        Returns the revisions whose contents are needed to diff a file in
+        a changeset, given the match for its line of 'cm log' output.
+        """
+        changetype = m.group("type")
+
+        if changetype == "M":
+            return [m.group("srcrevspec"), m.group("dstrevspec")]
+        elif (changetype == "A" or
+              (changetype in ['C', 'I'] and
+               m.group("parentrevspec") == "rev:revid:-1")):
+            return [m.group("revspec")]
+        elif changetype in ['C', 'I']:
+            return [m.group("parentrevspec"), m.group("revspec")]
+        elif changetype == "R":
+            return [m.group("parentrevspec")]
+
+        return []
+
+    def _changenum_diff_file(self, m, empty_filename):
+        """
+        Generates the diff for one file in a changeset, given the match
+        for its line of 'cm log' output.
+        """
         diff_lines = []
 
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
+        changetype = m.group("type")
+        filename = m.group("file")
+
+        if changetype == "M":
+            # Handle moved files as a delete followed by an add.
+            # Clunky, but at least it works
+            oldfilename = m.group("srcpath")
+            oldspec = m.group("srcrevspec")
+            newfilename = m.group("dstpath")
+            newspec = m.group("dstrevspec")
+
+            dl = self.diff_files(self._get_revision_file(oldspec,
+                                                         empty_filename),
+                                 empty_filename,
+                                 oldfilename, "rev:revid:-1", oldspec,
+                                 changetype)
+            diff_lines += dl
+
+            dl = self.diff_files(empty_filename,
+                                 self._get_revision_file(newspec,
+                                                         empty_filename),
+                                 newfilename, newspec, "rev:revid:-1",
+                                 changetype)
+            diff_lines += dl
+        else:
+            newrevspec = m.group("revspec")
+            parentrevspec = m.group("parentrevspec")
+
+            debug("Type %s File %s Old %s New %s" % (changetype,
+                                                     filename,
+                                                     parentrevspec,
+                                                     newrevspec))
+
+            old_file = new_file = empty_filename
+
+            if (changetype in ['A'] or
+                (changetype in ['C', 'I'] and
+                 parentrevspec == "rev:revid:-1")):
+                # File was Added, or a Change or Merge (type I) and there
+                # is no parent revision
+                new_file = self._get_revision_file(newrevspec, empty_filename)
+            elif changetype in ['C', 'I']:
+                # File was Changed or Merged (type I)
+                old_file = self._get_revision_file(parentrevspec,
+                                                   empty_filename)
+                new_file = self._get_revision_file(newrevspec, empty_filename)
+            elif changetype in ['R']:
+                # File was Removed
+                old_file = self._get_revision_file(parentrevspec,
+                                                   empty_filename)
+            else:
+                die("Don't know how to handle change type '%s' for %s" %
+                    (changetype, filename))
+
+            dl = self.diff_files(old_file, new_file, filename,
+                                 newrevspec, parentrevspec, changetype)
+            diff_lines += dl
+
+        return diff_lines
+
+    def branch_diff(self, args):
+        debug("branch diff: %s" % (args))
+
+        if len(args) > 0:
+            branch = args[0]
+        else:
+            branch = args
+
+        if not branch.startswith("br:"):
+            return None
+
+        if not options.branch:
+            options.branch = branch
+
+        files = run_cm(["fbc", branch, "--format={3} {4}"],
+                       split_lines = True)
+        debug("got files: %s" % (files))
+
+        diff_lines = []
+
+        empty_filename = make_tempfile()
+        changes = []
 
         for f in files:
             f = f.strip()
@@ -3290,71 +5002,90 @@ class PlasticClient(SCMClient):
             if not m:
                 die("Could not parse 'cm fbc' response: %s" % f)
 
-            filename = m.group("file")
-            branch = m.group("branch")
-            revno = m.group("revno")
-
-            # Get the base revision with a cm find
-            basefiles = execute(["cm", "find", "revs", "where",
-                                 "item='" + filename + "'", "and",
-                                 "branch='" + branch + "'", "and",
-                                 "revno=" + revno,
-                                 "--format={item} rev:revid:{id} "
-                                 "rev:revid:{parent}", "--nototal"],
-                                split_lines = True)
-
-            # We only care about the first line
-            m = re.search(r'^(?P<filename>.*) '
-                              r'(?P<revspec>rev:revid:[-\d]+) '
-                              r'(?P<parentrevspec>rev:revid:[-\d]+)$',
-                              basefiles[0])
-            basefilename = m.group("filename")
-            newrevspec = m.group("revspec")
-            parentrevspec = m.group("parentrevspec")
+            changes.append(m)
 
-            # Cope with adds/removes
-            changetype = "C"
+        # Files are fetched and diffed using up to --jobs threads, but the
+        # results are kept in the original order.
+        for dl in run_parallel(
+                lambda m: self._branch_diff_file(m, empty_filename),
+                changes, options.jobs):
+            diff_lines += dl
 
-            if parentrevspec == "rev:revid:-1":
-                changetype = "A"
-            elif newrevspec == "rev:revid:-1":
-                changetype = "R"
+        os.unlink(empty_filename)
 
-            debug("Type %s File %s Old %s New %s" % (changetype,
-                                                     basefilename,
-                                                     parentrevspec,
-                                                     newrevspec))
+        return ''.join(diff_lines)
 
-            old_file = new_file = empty_filename
+    def _branch_diff_file(self, m, empty_filename):
+        """
+        Generates the diff for one file on a branch, given the match for
+        its line of 'cm fbc' output.
+        """
+        tmp_diff_from_filename = make_tempfile()
+        tmp_diff_to_filename = make_tempfile()
 
-            if changetype == "A":
-                # File Added
-                self.write_file(basefilename, newrevspec,
-                                tmp_diff_to_filename)
-                new_file = tmp_diff_to_filename
-            elif changetype == "R":
-                # File Removed
-                self.write_file(basefilename, parentrevspec,
-                                tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
-            else:
-                self.write_file(basefilename, parentrevspec,
-                                tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
+        filename = m.group("file")
+        branch = m.group("branch")
+        revno = m.group("revno")
+
+        # Get the base revision with a cm find
+        basefiles = run_cm(["find", "revs", "where",
+                            "item='" + filename + "'", "and",
+                            "branch='" + branch + "'", "and",
+                            "revno=" + revno,
+                            "--format={item} rev:revid:{id} "
+                            "rev:revid:{parent}", "--nototal"],
+                           split_lines = True)
+
+        # We only care about the first line
+        m = re.search(r'^(?P<filename>.*) '
+                          r'(?P<revspec>rev:revid:[-\d]+) '
+                          r'(?P<parentrevspec>rev:revid:[-\d]+)$',
+                          basefiles[0])
+        basefilename = m.group("filename")
+        newrevspec = m.group("revspec")
+        parentrevspec = m.group("parentrevspec")
+
+        # Cope with adds/removes
+        changetype = "C"
+
+        if parentrevspec == "rev:revid:-1":
+            changetype = "A"
+        elif newrevspec == "rev:revid:-1":
+            changetype = "R"
+
+        debug("Type %s File %s Old %s New %s" % (changetype,
+                                                 basefilename,
+                                                 parentrevspec,
+                                                 newrevspec))
+
+        old_file = new_file = empty_filename
+
+        if changetype == "A":
+            # File Added
+            self.write_file(basefilename, newrevspec,
+                            tmp_diff_to_filename)
+            new_file = tmp_diff_to_filename
+        elif changetype == "R":
+            # File Removed
+            self.write_file(basefilename, parentrevspec,
+                            tmp_diff_from_filename)
+            old_file = tmp_diff_from_filename
+        else:
+            self.write_file(basefilename, parentrevspec,
+                            tmp_diff_from_filename)
+            old_file = tmp_diff_from_filename
 
-                self.write_file(basefilename, newrevspec,
-                                tmp_diff_to_filename)
-                new_file = tmp_diff_to_filename
+            self.write_file(basefilename, newrevspec,
+                            tmp_diff_to_filename)
+            new_file = tmp_diff_to_filename
 
-            dl = self.diff_files(old_file, new_file, basefilename,
-                                 newrevspec, parentrevspec, changetype)
-            diff_lines += dl
+        dl = self.diff_files(old_file, new_file, basefilename,
+                             newrevspec, parentrevspec, changetype)
 
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
+        remove_tempfile(tmp_diff_from_filename)
+        remove_tempfile(tmp_diff_to_filename)
 
-        return ''.join(diff_lines)
+        return dl
 
     def diff_files(self, old_file, new_file, filename, newrevspec,
                    parentrevspec, changetype, ignore_unmodified=False):
@@ -3375,22 +5106,9 @@ class PlasticClient(SCMClient):
         if filename.startswith(self.workspacedir):
             filename = filename[len(self.workspacedir):]
 
-        diff_cmd = ["diff", "-urN", old_file, new_file]
-        # Diff returns "1" if differences were found.
-        dl = execute(diff_cmd, extra_ignore_errors=(1,2),
-                     translate_newlines = False)
-
-        # If the input file has ^M characters at end of line, lets ignore them.
-        dl = dl.replace('\r\r\n', '\r\n')
-        dl = dl.splitlines(True)
-
-        # Special handling for the output of the diff tool on binary files:
-        #     diff outputs "Files a and b differ"
-        # and the code below expects the output to start with
-        #     "Binary files "
-        if (len(dl) == 1 and
-            dl[0].startswith('Files %s and %s differ' % (old_file, new_file))):
-            dl = ['Binary files %s and %s differ\n' % (old_file, new_file)]
+        dl = diff_files(old_file, new_file,
+                        "%s\t%s" % (filename, parentrevspec),
+                        "%s\t%s" % (filename, newrevspec))
 
         if dl == [] or dl[0].startswith("Binary files "):
             if dl == []:
@@ -3404,9 +5122,6 @@ class PlasticClient(SCMClient):
                                                     changetype))
             dl.append('\n')
         else:
-            dl[0] = "--- %s\t%s\n" % (filename, parentrevspec)
-            dl[1] = "+++ %s\t%s\n" % (filename, newrevspec)
-
             # Not everybody has files that end in a newline.  This ensures
             # that the resulting diff file isn't broken.
             if dl[-1][-1] != '\n':
@@ -3417,7 +5132,74 @@ class PlasticClient(SCMClient):
     def write_file(self, filename, filespec, tmpfile):
         """ Grabs a file from Plastic and writes it to a temp file """
         debug("Writing '%s' (rev %s) to '%s'" % (filename, filespec, tmpfile))
-        execute(["cm", "cat", filespec, "--file=" + tmpfile])
+        run_cm(["cat", filespec, "--file=" + tmpfile])
+
+    def _fetch_revisions(self, revspecs):
+        """
+        Fetches the contents of many revisions into a scratch directory,
+        so they can be diffed without running cm again.
+
+        The contents are all fetched one at a time through one "cm shell",
+        which can only run one command at a time, so there is nothing to
+        gain from fetching them in parallel. Files are named after the MD5
+        of their contents, so identical contents are only stored once.
+        """
+        if self._fetch_dir is None:
+            self._fetch_dir = make_tempdir()
+
+        needed = []
+
+        for revspec in revspecs:
+            if (revspec != "rev:revid:-1" and
+                revspec not in self._revision_files and
+                revspec not in needed):
+                needed.append(revspec)
+
+        debug("Fetching %d revisions" % len(needed))
+
+        for revspec in needed:
+            self._fetch_revision(revspec)
+
+    def _fetch_revision(self, revspec):
+        """Fetches the contents of a revision into the scratch directory."""
+        fd, tmpfile = mkstemp(dir=self._fetch_dir)
+        os.close(fd)
+
+        run_cm(["cat", revspec, "--file=" + tmpfile])
+
+        digest = md5()
+        fp = open(tmpfile, 'rb')
+
+        for data in iter(lambda: fp.read(65536), ''):
+            digest.update(data)
+
+        fp.close()
+
+        path = os.path.join(self._fetch_dir, digest.hexdigest())
+
+        if os.path.exists(path):
+            os.unlink(tmpfile)
+        else:
+            os.rename(tmpfile, path)
+
+        self._revision_files[revspec] = path
+
+    def _get_revision_file(self, revspec, empty_filename):
+        """
+        Returns the file holding a revision's contents. "rev:revid:-1"
+        means there is no revision, so it's never fetched and is treated
+        as an empty file.
+        """
+        return self._revision_files.get(revspec, empty_filename)
+
+    def _clear_fetched_revisions(self):
+        """Removes any revisions fetched by _fetch_revisions()."""
+        if self._fetch_dir:
+            shutil.rmtree(self._fetch_dir, ignore_errors=True)
+            tempdirs.remove(self._fetch_dir)
+            self._fetch_dir = None
+
+        self._revision_files = {}
 
 
 SCMCLIENTS = (
@@ -3451,23 +5233,192 @@ def make_tempfile(content=None):
     return tmpfile
 
 
+def remove_tempfile(tmpfile):
+    """
+    Removes a temporary file created by make_tempfile once it's no longer
+    needed.
+    """
+    try:
+        os.unlink(tmpfile)
+    except OSError:
+        pass
+
+    tempfiles.remove(tmpfile)
+
+
+def make_tempdir():
+    """
+    Creates a temporary directory and returns the path. The path is stored
+    in an array for later cleanup.
+    """
+    tmpdir = tempfile.mkdtemp()
+    tempdirs.append(tmpdir)
+    return tmpdir
+
+
+def parse_version(version):
+    """
+    Parses a version string into a tuple, so that versions can be compared.
+
+    Numbers compare numerically, and trailing zeros in the release number
+    are ignored, so "1.5" and "1.5.0" are equal. Pre-releases, such as
+    "1.6 beta 2", "1.6rc1" or "1.6.dev", come before the release itself.
+    """
+    tokens = re.findall(r'\d+|[a-z]+', version.lower())
+    release = []
+
+    while tokens and tokens[0].isdigit():
+        release.append(int(tokens.pop(0)))
+
+    while release and release[-1] == 0:
+        release.pop()
+
+    parts = [(2, n) for n in release]
+
+    for token in tokens:
+        if token.isdigit():
+            parts.append((2, int(token)))
+        else:
+            parts.append((0, PRE_RELEASE_TAGS.get(token, 0)))
+
+    # A release sorts after its pre-releases, and before any version with
+    # more numbers after it.
+    parts.append((1, 0))
+
+    return tuple(parts)
+
+
 def check_install(command):
     """
     Try executing an external command and return a boolean indicating whether
     that command is installed or not.  The 'command' argument should be
     something that executes quickly, without hitting the network (for
     instance, 'svn help' or 'git --version').
+
+    The command is looked up in the search path rather than run, using
+    the tools cache where possible.
     """
+    args = command.split(' ')
+
+    if find_executable(args[0]):
+        return True
+
+    # Windows can run batch files that the search doesn't treat as
+    # executables, so those are still tried out. Anything else that
+    # wasn't found isn't installed.
+    if (not sys.platform.startswith('win') or
+        os.path.splitext(args[0])[1].lower() not in ('.bat', '.cmd')):
+        return False
+
     try:
-        subprocess.Popen(command.split(' '),
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
+        p = subprocess.Popen(args,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        p.communicate()
         return True
     except OSError:
         return False
 
 
+def find_executable(name):
+    """
+    Returns the absolute path of an executable, searching the same
+    directories the system would when running it, or None if it can't be
+    found.
+
+    Results are kept in a cache in the user's cache directory. The cache
+    is thrown away if the search path or any of its directories change, and
+    a cached path is only used if the executable hasn't changed since.
+    """
+    _tools_lock.acquire()
+
+    try:
+        if name in _tools:
+            return _tools[name]
+
+        search_dirs = _get_executable_search_dirs()
+        path_key = [[dirname, _get_mtime(dirname)] for dirname in search_dirs]
+        cache = None
+        entry = None
+
+        cache_dir = get_cache_dir()
+
+        if cache_dir:
+            cache = DataCache(os.path.join(cache_dir, 'tools.json'))
+            entry = cache.get('tools')
+
+        if not entry or entry['path_key'] != path_key:
+            entry = {
+                'path_key': path_key,
+                'tools': {},
+            }
+
+        tool = entry['tools'].get(name)
+
+        if tool and tool['path'] and _get_mtime(tool['path']) != tool['mtime']:
+            tool = None
+
+        if tool:
+            path = tool['path']
+        else:
+            path = _search_executable(name, search_dirs)
+            entry['tools'][name] = {
+                'path': path,
+                'mtime': path and _get_mtime(path),
+            }
+
+            if cache:
+                cache.set('tools', entry)
+
+        debug('Found %s at %s' % (name, path))
+        _tools[name] = path
+
+        return path
+    finally:
+        _tools_lock.release()
+
+
+def _get_executable_search_dirs():
+    """Returns the directories searched when running an executable."""
+    dirs = []
+
+    if sys.platform.startswith('win'):
+        # CreateProcess looks in these before the PATH.
+        dirs.append(os.path.dirname(sys.executable))
+        dirs.append(os.getcwd())
+
+        if 'SystemRoot' in os.environ:
+            system_root = os.environ['SystemRoot']
+            dirs += [os.path.join(system_root, 'system32'),
+                     os.path.join(system_root, 'system'),
+                     system_root]
+
+    for dirname in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if dirname and dirname not in dirs:
+            dirs.append(dirname)
+
+    return dirs
+
+
+def _search_executable(name, search_dirs):
+    """Returns the first match for an executable in search_dirs, or None."""
+    # Like CreateProcess, only .exe is tried if there's no extension.
+    if sys.platform.startswith('win') and not os.path.splitext(name)[1]:
+        name += '.exe'
+
+    if os.path.dirname(name):
+        candidates = [name]
+    else:
+        candidates = [os.path.join(dirname, name) for dirname in search_dirs]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.abspath(candidate)
+
+    return None
+
+
 def check_gnu_diff():
     """Checks if GNU diff is installed, and informs the user if it's not."""
     has_gnu_diff = False
@@ -3485,80 +5436,754 @@ def check_gnu_diff():
         sys.stderr.write('and in the path.\n')
         sys.stderr.write('\n')
 
-        if os.name == 'nt':
-            sys.stderr.write('On Windows, you can install this from:\n')
-            sys.stderr.write(GNU_DIFF_WIN32_URL)
-            sys.stderr.write('\n')
+        if os.name == 'nt':
+            sys.stderr.write('On Windows, you can install this from:\n')
+            sys.stderr.write(GNU_DIFF_WIN32_URL)
+            sys.stderr.write('\n')
+
+        die()
+
+
+def execute(command, env=None, split_lines=False, ignore_errors=False,
+            extra_ignore_errors=(), translate_newlines=True, with_errors=True):
+    """
+    Utility function to execute a command and return the output.
+    """
+    start_time = time.time()
+    p = _start_process(command, env, translate_newlines, with_errors)
+
+    if split_lines:
+        data = p.stdout.readlines()
+        output_bytes = sum([len(line) for line in data])
+    else:
+        data = p.stdout.read()
+        output_bytes = len(data)
+    rc = p.wait()
+    profiler.add_command(command, start_time, rc, output_bytes)
+    if rc and not ignore_errors and rc not in extra_ignore_errors:
+        die('Failed to execute command: %s\n%s' % (command, data))
+
+    return data
+
+
+def execute_stream(command, env=None, ignore_errors=False,
+                   extra_ignore_errors=(), translate_newlines=True,
+                   with_errors=True, chunk_size=None):
+    """
+    Executes a command, yielding its output as it's produced rather than
+    returning it all at once.
+
+    Output is yielded a line at a time, or in chunks of up to chunk_size
+    bytes if given. Once the output ends, a failed command is handled the
+    same way as in execute(). Since the output has already been passed on
+    by then, only the end of it is included in the error.
+    """
+    start_time = time.time()
+    p = _start_process(command, env, translate_newlines, with_errors)
+    tail = []
+    output_bytes = 0
+
+    if chunk_size:
+        read = lambda: p.stdout.read(chunk_size)
+    else:
+        read = p.stdout.readline
+
+    for data in iter(read, ''):
+        tail.append(data)
+        output_bytes += len(data)
+
+        if len(tail) > 2 * EXECUTE_ERROR_TAIL:
+            del tail[:-EXECUTE_ERROR_TAIL]
+
+        yield data
+
+    rc = p.wait()
+    profiler.add_command(command, start_time, rc, output_bytes)
+    if rc and not ignore_errors and rc not in extra_ignore_errors:
+        die('Failed to execute command: %s\n%s' %
+            (command, ''.join(tail[-EXECUTE_ERROR_TAIL:])))
+
+
+def _start_process(command, env, translate_newlines, with_errors,
+                   errors_output=None):
+    """
+    Starts a command for execute(), execute_stream() and the persistent
+    command sessions.
+
+    Errors go to errors_output if given, and otherwise are mixed in with
+    the output or piped separately, depending on with_errors.
+    """
+    if isinstance(command, list):
+        debug(subprocess.list2cmdline(command))
+
+        # Run the executable by its full path, saving the system from
+        # searching for it again.
+        path = find_executable(command[0])
+
+        if path:
+            command = [path] + command[1:]
+    else:
+        debug(command)
+
+    if env:
+        env.update(os.environ)
+    else:
+        env = os.environ.copy()
+
+    env['LC_ALL'] = 'en_US.UTF-8'
+    env['LANGUAGE'] = 'en_US.UTF-8'
+
+    if errors_output is None:
+        if with_errors:
+            errors_output = subprocess.STDOUT
+        else:
+            errors_output = subprocess.PIPE
+
+    if sys.platform.startswith('win'):
+        p = subprocess.Popen(command,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=errors_output,
+                             shell=False,
+                             universal_newlines=translate_newlines,
+                             env=env)
+    else:
+        p = subprocess.Popen(command,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=errors_output,
+                             shell=False,
+                             close_fds=True,
+                             universal_newlines=translate_newlines,
+                             env=env)
+
+    return p
+
+
+def run_in_session(session_class, args, split_lines=False,
+                   ignore_errors=False, extra_ignore_errors=(),
+                   with_errors=True):
+    """
+    Runs a command in a persistent session, returning its output the same
+    way as execute().
+
+    The session is shared by the whole run, and is started the first time
+    it's needed. If it can't be started, or goes away, commands are run
+    with execute() instead.
+    """
+    _sessions_lock.acquire()
+
+    try:
+        session = _sessions.get(session_class)
+
+        if session is None:
+            session = session_class()
+
+            if not session.start():
+                session = False
+
+            _sessions[session_class] = session
+    finally:
+        _sessions_lock.release()
+
+    if session:
+        try:
+            rc, data, errors = session.run_command(args)
+        except IOError, e:
+            debug('Lost the %s session: %s' % (session.executable, e))
+            session.close()
+            _sessions[session_class] = False
+        else:
+            if with_errors:
+                data += errors
+
+            if rc and not ignore_errors and rc not in extra_ignore_errors:
+                die('Failed to execute command: %s\n%s' %
+                    ([session.executable] + args, data))
+
+            if split_lines:
+                return data.splitlines(True)
+
+            return data
+
+    return execute([session_class.executable] + args,
+                   split_lines=split_lines, ignore_errors=ignore_errors,
+                   extra_ignore_errors=extra_ignore_errors,
+                   with_errors=with_errors)
+
+
+def close_sessions():
+    """Shuts down the persistent command sessions started so far."""
+    _sessions_lock.acquire()
+
+    try:
+        for session in _sessions.itervalues():
+            if session:
+                session.close()
+
+        _sessions.clear()
+    finally:
+        _sessions_lock.release()
+
+
+def run_cleartool(args, **kwargs):
+    """
+    Runs a cleartool command in a single interactive cleartool shared by
+    the whole run. This takes the same arguments as execute().
+    """
+    return run_in_session(CleartoolSession, args, **kwargs)
+
+
+def run_cm(args, **kwargs):
+    """
+    Runs a Plastic cm command in a single "cm shell" shared by the whole
+    run. This takes the same arguments as execute().
+    """
+    return run_in_session(CmShellSession, args, **kwargs)
+
+
+def run_parallel(func, items, num_workers, stop_when=None):
+    """
+    Calls func on each item using up to num_workers threads, returning the
+    results in the same order as items.
+
+    If stop_when is given, it's called with each result. Once it returns
+    True, no further items are started, and the results for any items that
+    were never run are None. Items are started in order, so every item
+    before the one that stopped the run will have finished.
+
+    If func raises an exception (including PostReviewError from die()), no
+    further items are started and the exception is re-raised here.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    state = {
+        'next': 0,
+        'stop': False,
+        'error': None,
+    }
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+
+            try:
+                i = state['next']
+
+                if state['stop'] or i >= len(items):
+                    return
+
+                state['next'] += 1
+            finally:
+                lock.release()
+
+            try:
+                result = func(items[i])
+            except:
+                lock.acquire()
+
+                try:
+                    if state['error'] is None:
+                        state['error'] = sys.exc_info()
+
+                    state['stop'] = True
+                finally:
+                    lock.release()
+
+                return
+
+            results[i] = result
+
+            if stop_when and stop_when(result):
+                state['stop'] = True
+
+    if num_workers <= 1 or len(items) <= 1:
+        worker()
+    else:
+        threads = []
+
+        for i in range(min(num_workers, len(items))):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            # Joining with a timeout keeps Control-C working.
+            while thread.isAlive():
+                thread.join(0.5)
+
+    if state['error']:
+        error = state['error']
+        raise error[0], error[1], error[2]
+
+    return results
+
+
+def diff_files(old_file, new_file, old_label=None, new_label=None,
+               show_c_function=False):
+    """
+    Returns a unified diff between two files as a list of lines.
+
+    The diff is in the same format as 'diff -uN', using old_label and
+    new_label for the '---' and '+++' lines. These default to the file
+    name and modification time, as GNU diff does. If show_c_function is
+    set, each hunk header names the function it's in, like 'diff -p'.
+
+    If the files are the same, this returns an empty list. If either is
+    a binary file, this returns a single "Binary files ... differ" line.
+
+    The diff is generated in-process, unless --use-gnu-diff was passed.
+    """
+    if old_label is None:
+        old_label = _get_diff_label(old_file)
+
+    if new_label is None:
+        new_label = _get_diff_label(new_file)
+
+    if options and options.use_gnu_diff:
+        dl = _gnu_diff_files(old_file, new_file, show_c_function)
+
+        if len(dl) > 1:
+            dl[0] = '--- %s\n' % old_label
+            dl[1] = '+++ %s\n' % new_label
+    else:
+        old_data = _read_diff_file(old_file)
+        new_data = _read_diff_file(new_file)
+
+        if old_data == new_data:
+            return []
+
+        if '\0' in old_data[:8192] or '\0' in new_data[:8192]:
+            return ['Binary files %s and %s differ\n' % (old_file, new_file)]
+
+        dl = unified_diff(_split_diff_lines(old_data),
+                          _split_diff_lines(new_data),
+                          show_c_function=show_c_function)
+
+        if dl:
+            dl.insert(0, '--- %s\n' % old_label)
+            dl.insert(1, '+++ %s\n' % new_label)
+
+    # If the input file has ^M characters at end of line, lets ignore them.
+    return [line.replace('\r\r\n', '\r\n') for line in dl]
+
+
+def _gnu_diff_files(old_file, new_file, show_c_function=False):
+    """Returns the output of GNU diff on two files as a list of lines."""
+    if hasattr(os, 'uname') and os.uname()[0] == 'SunOS':
+        diff_cmd = ["gdiff", "-uN"]
+    else:
+        diff_cmd = ["diff", "-uN"]
+
+    if show_c_function:
+        diff_cmd.append("-p")
+
+    # Diff returns "1" if differences were found.
+    dl = execute(diff_cmd + [old_file, new_file], extra_ignore_errors=(1,2),
+                 translate_newlines=False)
+    dl = dl.splitlines(True)
+
+    # Special handling for the output of the diff tool on binary files:
+    #     diff outputs "Files a and b differ"
+    # and the callers expect the output to start with
+    #     "Binary files "
+    if (len(dl) == 1 and
+        dl[0].startswith('Files %s and %s differ' % (old_file, new_file))):
+        dl = ['Binary files %s and %s differ\n' % (old_file, new_file)]
+
+    return dl
+
+
+def _read_diff_file(filename):
+    """Returns the contents of a file, treating a missing file as empty."""
+    try:
+        fp = open(filename, 'rb')
+    except IOError:
+        return ''
+
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+
+def _split_diff_lines(data):
+    """
+    Splits file contents into lines, keeping the newlines.
+
+    Unlike str.splitlines, only '\n' ends a line, like in GNU diff.
+    """
+    lines = data.split('\n')
+
+    if lines[-1] == '':
+        lines.pop()
+        return [line + '\n' for line in lines]
+    else:
+        return [line + '\n' for line in lines[:-1]] + [lines[-1]]
+
+
+def _get_diff_label(filename):
+    """Returns the default GNU diff header label for a file."""
+    return '%s\t%s' % (filename,
+                       format_diff_timestamp(_get_mtime(filename), True))
+
+
+def _get_mtime(filename):
+    """
+    Returns the modification time of a file. Like 'diff -N', a missing file
+    is treated as being from the epoch.
+    """
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return 0
+
+
+def format_diff_timestamp(mtime, full=False):
+    """
+    Formats a file modification time in local time, as used in diff
+    headers.
+
+    If full is set, this includes the fractional seconds and timezone
+    offset, like GNU diff's headers.
+    """
+    t = time.localtime(mtime)
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', t)
+
+    if full:
+        if t.tm_isdst > 0 and time.daylight:
+            offset = -time.altzone
+        else:
+            offset = -time.timezone
+
+        if offset < 0:
+            sign = '-'
+        else:
+            sign = '+'
+
+        timestamp = '%s.%09d %s%02d%02d' % (
+            timestamp, int((mtime % 1) * 1000000000), sign,
+            abs(offset) / 3600, abs(offset) % 3600 / 60)
+
+    return timestamp
+
+
+# Matches lines that 'diff -p' considers to be the start of a function.
+DIFF_FUNCTION_RE = re.compile(r'^[A-Za-z$_]')
+
+
+def unified_diff(old_lines, new_lines, context=3, show_c_function=False):
+    """
+    Returns the hunks of a unified diff between two lists of lines.
+
+    Each line must keep its newline, except possibly the last. The result
+    is a list of output lines in GNU diff's format, without the '---' and
+    '+++' header lines.
+    """
+    changes = _get_diff_changes(old_lines, new_lines)
+
+    if not changes:
+        return []
+
+    result = []
+    old_len = len(old_lines)
+
+    # The state for finding function names, as with 'diff -p'. The search
+    # for each hunk picks up where the last one left off.
+    last_search = 0
+    last_match = None
+
+    i = 0
+
+    while i < len(changes):
+        # Group together changes whose context overlaps.
+        group_end = i + 1
+
+        while (group_end < len(changes) and
+               changes[group_end][0] - changes[group_end - 1][1] <=
+               2 * context):
+            group_end += 1
+
+        group = changes[i:group_end]
+        i = group_end
+
+        old_start = max(0, group[0][0] - context)
+        old_end = min(old_len, group[-1][1] + context)
+        new_start = group[0][2] - (group[0][0] - old_start)
+        new_end = group[-1][3] + (old_end - group[-1][1])
+
+        header = '@@ -%s +%s @@' % (
+            _format_hunk_range(old_start, old_end - old_start),
+            _format_hunk_range(new_start, new_end - new_start))
+
+        if show_c_function:
+            for linenum in xrange(old_start - 1, last_search - 1, -1):
+                if DIFF_FUNCTION_RE.match(old_lines[linenum]):
+                    last_match = old_lines[linenum]
+                    break
+
+            last_search = old_start
+
+            if last_match is not None:
+                header += ' ' + last_match.rstrip('\n')[:40].rstrip()
+
+        result.append(header + '\n')
+
+        pos = old_start
+
+        for old_i1, old_i2, new_i1, new_i2 in group:
+            _append_diff_lines(result, ' ', old_lines, pos, old_i1)
+            _append_diff_lines(result, '-', old_lines, old_i1, old_i2)
+            _append_diff_lines(result, '+', new_lines, new_i1, new_i2)
+            pos = old_i2
+
+        _append_diff_lines(result, ' ', old_lines, pos, old_end)
+
+    return result
+
+
+def _append_diff_lines(result, prefix, lines, start, end):
+    for line in lines[start:end]:
+        if line.endswith('\n'):
+            result.append(prefix + line)
+        else:
+            result.append(prefix + line + '\n')
+            result.append('\\ No newline at end of file\n')
+
+
+def _format_hunk_range(start, count):
+    """Formats a line range for a hunk header, as GNU diff does."""
+    if count == 1:
+        return '%d' % (start + 1)
+    elif count == 0:
+        return '%d,0' % start
+    else:
+        return '%d,%d' % (start + 1, count)
+
+
+def _get_diff_changes(old_lines, new_lines):
+    """
+    Returns the differences between two lists of lines.
+
+    This is a list of (old_start, old_end, new_start, new_end) tuples, in
+    order, where each range of old lines is replaced by the range of new
+    lines.
+    """
+    # Compare lines as small integers rather than strings.
+    line_ids = {}
+    a = [line_ids.setdefault(line, len(line_ids)) for line in old_lines]
+    b = [line_ids.setdefault(line, len(line_ids)) for line in new_lines]
+
+    # Lines that only appear on one side can never match anything, so they
+    # don't need to go through the diff algorithm. For files that have
+    # been heavily rewritten, this leaves very little to compare.
+    a_ids = dict.fromkeys(a)
+    b_ids = dict.fromkeys(b)
+    a_map = [i for i in xrange(len(a)) if a[i] in b_ids]
+    b_map = [j for j in xrange(len(b)) if b[j] in a_ids]
+
+    changes = []
+    old_pos = new_pos = 0
+
+    for i, j, n in _get_matching_blocks([a[i] for i in a_map],
+                                        [b[j] for j in b_map]):
+        for k in xrange(n):
+            old_i = a_map[i + k]
+            new_j = b_map[j + k]
+
+            if old_i != old_pos or new_j != new_pos:
+                changes.append((old_pos, old_i, new_pos, new_j))
+
+            old_pos = old_i + 1
+            new_pos = new_j + 1
+
+    if old_pos != len(a) or new_pos != len(b):
+        changes.append((old_pos, len(a), new_pos, len(b)))
+
+    return changes
+
+
+def _get_matching_blocks(a, b):
+    """
+    Returns a sorted list of (i, j, n) tuples, where a[i:i + n] matches
+    b[j:j + n], making up a longest common subsequence of a and b.
+
+    This uses Myers' O(ND) algorithm in its linear space form, splitting
+    the problem at the middle snake of each part. The parts are kept on a
+    stack rather than recursing, so large files can't hit the recursion
+    limit.
+    """
+    blocks = []
+    parts = [(0, len(a), 0, len(b))]
+
+    while parts:
+        a_lo, a_hi, b_lo, b_hi = parts.pop()
+
+        # Take off the common prefix and suffix first. This is cheap, and
+        # for typical changes leaves only a small part to diff.
+        n = 0
+
+        while a_lo + n < a_hi and b_lo + n < b_hi and \
+              a[a_lo + n] == b[b_lo + n]:
+            n += 1
+
+        if n:
+            blocks.append((a_lo, b_lo, n))
+            a_lo += n
+            b_lo += n
+
+        n = 0
+
+        while a_lo < a_hi - n and b_lo < b_hi - n and \
+              a[a_hi - n - 1] == b[b_hi - n - 1]:
+            n += 1
+
+        if n:
+            blocks.append((a_hi - n, b_hi - n, n))
+            a_hi -= n
+            b_hi -= n
+
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+
+        x0, y0, x1, y1 = _find_middle_snake(a, a_lo, a_hi, b, b_lo, b_hi)
+
+        if x1 > x0:
+            blocks.append((x0, y0, x1 - x0))
+
+        parts.append((x1, a_hi, y1, b_hi))
+        parts.append((a_lo, x0, b_lo, y0))
+
+    blocks.sort()
+
+    return blocks
+
+
+def _find_middle_snake(a, a_lo, a_hi, b, b_lo, b_hi):
+    """
+    Finds the middle snake of the shortest edit script between
+    a[a_lo:a_hi] and b[b_lo:b_hi], returning its start and end points.
+
+    Like GNU diff, this gives up on finding the optimal split once it gets
+    too expensive, and splits at the furthest point reached instead. The
+    result is still a correct diff, just not always a minimal one.
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) / 2
+    too_expensive = max(256, 1 << (len('%x' % (n + m)) * 2))
+    offset = max_d + 1
+    size = 2 * max_d + 3
+    vf = [-1] * size
+    vb = [-1] * size
+    vf[offset + 1] = 0
+    vb[offset + 1] = 0
+
+    # The diagonals at either end that have run off the edge of the edit
+    # graph, and no longer need to be followed.
+    f_start = f_end = b_start = b_end = 0
+
+    for d in xrange(max_d + 1):
+        # Extend the forward paths by one edit.
+        for k in xrange(-d + f_start, d + 1 - f_end, 2):
+            if k == -d or (k != d and vf[offset + k - 1] < vf[offset + k + 1]):
+                x = vf[offset + k + 1]
+            else:
+                x = vf[offset + k - 1] + 1
+
+            y = x - k
+            start_x = x
+
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+
+            vf[offset + k] = x
+
+            if x > n:
+                f_end += 2
+            elif y > m:
+                f_start += 2
+            elif odd:
+                i = offset + delta - k
+
+                if 0 <= i < size and vb[i] != -1 and x >= n - vb[i]:
+                    return (a_lo + start_x, b_lo + start_x - k,
+                            a_lo + x, b_lo + y)
+
+        # Extend the backward paths by one edit. These work back from the
+        # end of both sequences, with x and y counting from the end.
+        for k in xrange(-d + b_start, d + 1 - b_end, 2):
+            if k == -d or (k != d and vb[offset + k - 1] < vb[offset + k + 1]):
+                x = vb[offset + k + 1]
+            else:
+                x = vb[offset + k - 1] + 1
 
-        die()
+            y = x - k
+            start_x = x
 
+            while x < n and y < m and a[a_hi - x - 1] == b[b_hi - y - 1]:
+                x += 1
+                y += 1
 
-def execute(command, env=None, split_lines=False, ignore_errors=False,
-            extra_ignore_errors=(), translate_newlines=True, with_errors=True):
-    """
-    Utility function to execute a command and return the output.
-    """
-    if isinstance(command, list):
-        debug(subprocess.list2cmdline(command))
-    else:
-        debug(command)
+            vb[offset + k] = x
 
-    if env:
-        env.update(os.environ)
-    else:
-        env = os.environ.copy()
+            if x > n:
+                b_end += 2
+            elif y > m:
+                b_start += 2
+            elif not odd:
+                i = offset + delta - k
 
-    env['LC_ALL'] = 'en_US.UTF-8'
-    env['LANGUAGE'] = 'en_US.UTF-8'
+                if 0 <= i < size and vf[i] != -1 and vf[i] >= n - x:
+                    return (a_hi - x, b_hi - y,
+                            a_hi - start_x, b_hi - start_x + k)
 
-    if with_errors:
-        errors_output = subprocess.STDOUT
-    else:
-        errors_output = subprocess.PIPE
+        if d >= too_expensive:
+            # Split at whichever forward path got furthest along.
+            best_x = best_y = 0
 
-    if sys.platform.startswith('win'):
-        p = subprocess.Popen(command,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=errors_output,
-                             shell=False,
-                             universal_newlines=translate_newlines,
-                             env=env)
-    else:
-        p = subprocess.Popen(command,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=errors_output,
-                             shell=False,
-                             close_fds=True,
-                             universal_newlines=translate_newlines,
-                             env=env)
-    if split_lines:
-        data = p.stdout.readlines()
-    else:
-        data = p.stdout.read()
-    rc = p.wait()
-    if rc and not ignore_errors and rc not in extra_ignore_errors:
-        die('Failed to execute command: %s\n%s' % (command, data))
+            for k in xrange(-d + f_start, d + 1 - f_end, 2):
+                x = vf[offset + k]
+                y = x - k
 
-    return data
+                if x <= n and 0 <= y <= m and x + y > best_x + best_y:
+                    best_x = x
+                    best_y = y
+
+            return (a_lo + best_x, b_lo + best_y, a_lo + best_x, b_lo + best_y)
+
+    # This can't be reached, since the paths always meet by max_d.
+    assert False
 
 
 def die(msg=None):
     """
-    Cleanly exits the program with an error message. Erases all remaining
-    temporary files.
+    Stops with an error message, by raising PostReviewError.
+
+    Temporary files are left for whoever catches the error to erase, as
+    other threads may still be using them.
     """
+    raise PostReviewError(msg)
+
+
+def cleanup_tempfiles():
+    """Erases all temporary files and directories that are left."""
     for tmpfile in tempfiles:
         try:
             os.unlink(tmpfile)
         except:
             pass
 
-    if msg:
-        print msg
+    for tmpdir in tempdirs:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-    sys.exit(1)
+    del tempfiles[:]
+    del tempdirs[:]
 
 
 def walk_parents(path):
@@ -3570,6 +6195,106 @@ def walk_parents(path):
         path = os.path.dirname(path)
 
 
+def get_config_cache_filename(filename):
+    """
+    Returns the file used to cache the compiled contents of a config file,
+    or None if caching has been turned off.
+    """
+    cache_dir = get_cache_dir()
+
+    if not cache_dir:
+        return None
+
+    return os.path.join(cache_dir, 'configs', md5(filename).hexdigest())
+
+
+def load_cached_config(filename, st):
+    """
+    Loads the compiled code and values cached for a config file.
+
+    The cache is only used if the config file has the same modification
+    time and size as when it was cached. This returns a tuple of
+    (code, values), either of which may be None.
+    """
+    cache_filename = get_config_cache_filename(filename)
+
+    if not cache_filename or not os.path.exists(cache_filename):
+        return None, None
+
+    try:
+        fp = open(cache_filename, 'rb')
+
+        try:
+            magic, mtime, size, code, values = marshal.load(fp)
+        finally:
+            fp.close()
+    except (IOError, EOFError, ValueError, TypeError), e:
+        debug('Unable to load cached config %s: %s' % (cache_filename, e))
+        return None, None
+
+    if (magic != imp.get_magic() or mtime != st.st_mtime or
+        size != st.st_size):
+        return None, None
+
+    return code, values
+
+
+def save_cached_config(filename, st, code, values):
+    """Caches the compiled code and values for a config file."""
+    cache_filename = get_config_cache_filename(filename)
+
+    if not cache_filename:
+        return
+
+    dirname = os.path.dirname(cache_filename)
+
+    try:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, 0700)
+
+        fd, tmpfile = mkstemp(dir=dirname)
+        os.write(fd, marshal.dumps((imp.get_magic(), st.st_mtime, st.st_size,
+                                    code, values)))
+        os.close(fd)
+
+        if os.path.exists(cache_filename):
+            os.unlink(cache_filename)
+
+        os.rename(tmpfile, cache_filename)
+    except (IOError, OSError), e:
+        debug('Unable to write cached config %s: %s' % (cache_filename, e))
+
+
+def get_static_config_values(code, config):
+    """
+    Returns the values set by a config file, if they can be cached.
+
+    A config that only assigns literal values always ends up with the same
+    values. Any config that looks up other names, such as environment
+    variables, has to be run again each time, so None is returned for it.
+    """
+    values = {}
+
+    for key, value in config.iteritems():
+        if key != '__builtins__':
+            values[key] = value
+
+    for const in code.co_consts:
+        if type(const) is type(code):
+            return None
+
+    for name in code.co_names:
+        if name not in values and name not in ('True', 'False', 'None'):
+            return None
+
+    try:
+        marshal.dumps(values)
+    except ValueError:
+        return None
+
+    return values
+
+
 def load_config_files(homepath):
     """Loads data from .reviewboardrc files"""
     def _load_config(path):
@@ -3579,16 +6304,35 @@ def load_config_files(homepath):
 
         filename = os.path.join(path, '.reviewboardrc')
 
-        if os.path.exists(filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+
+        code, values = load_cached_config(filename, st)
+
+        if values is not None:
+            config.update(values)
+            return config
+
+        if code is None:
+            fp = open(filename, 'rU')
+            source = fp.read()
+            fp.close()
+
             try:
-                execfile(filename, config)
+                # Python 2.4 requires a trailing newline in compiled code.
+                code = compile(source + '\n', filename, 'exec')
             except SyntaxError, e:
                 die('Syntax error in config file: %s\n'
                     'Line %i offset %i\n' % (filename, e.lineno, e.offset))
 
-            return config
+        exec code in config
 
-        return None
+        save_cached_config(filename, st, code,
+                           get_static_config_values(code, config))
+
+        return config
 
     for path in walk_parents(os.getcwd()):
         config = _load_config(path)
@@ -3599,6 +6343,53 @@ def load_config_files(homepath):
     globals()['user_config'] = _load_config(homepath)
 
 
+def get_config_server_index():
+    """
+    Returns an index of the Review Board servers named in the config files.
+
+    This is a tuple of (default_url, tree_urls). default_url comes from
+    the first config, checking user_config first, that sets
+    REVIEWBOARD_URL, and no later configs are used. tree_urls maps each
+    path in the TREES of earlier configs to a tuple of the config's
+    position and the server URL.
+
+    The index is only rebuilt when the loaded configs change.
+    """
+    global _config_server_index
+
+    if (_config_server_index is not None and
+        _config_server_index[0] is user_config and
+        _config_server_index[1] is configs and
+        _config_server_index[2] == len(configs)):
+        return _config_server_index[3]
+
+    default_url = None
+    tree_urls = {}
+    all_configs = [user_config] + configs
+
+    for i, config in enumerate(all_configs):
+        if not config:
+            continue
+
+        if 'REVIEWBOARD_URL' in config:
+            default_url = config['REVIEWBOARD_URL']
+            break
+        elif 'TREES' in config:
+            trees = config['TREES']
+
+            if not isinstance(trees, dict):
+                die("Warning: 'TREES' in config file is not a dict!")
+
+            for path, tree in trees.iteritems():
+                if path not in tree_urls and 'REVIEWBOARD_URL' in tree:
+                    tree_urls[path] = (i, tree['REVIEWBOARD_URL'])
+
+    index = (default_url, tree_urls)
+    _config_server_index = (user_config, configs, len(configs), index)
+
+    return index
+
+
 def tempt_fate(server, tool, changenum, diff_content=None,
                parent_diff_content=None, submit_as=None, retries=3):
     """
@@ -3611,41 +6402,41 @@ def tempt_fate(server, tool, changenum, diff_content=None,
         else:
             review_request = server.new_review_request(changenum, submit_as)
 
+        # Collect all the field changes so that they can be sent to the
+        # server in one request.
+        fields = {}
+
         if options.target_groups:
-            server.set_review_request_field(review_request, 'target_groups',
-                                            options.target_groups)
+            fields['target_groups'] = options.target_groups
 
         if options.target_people:
-            server.set_review_request_field(review_request, 'target_people',
-                                            options.target_people)
+            fields['target_people'] = options.target_people
 
         if options.summary:
-            server.set_review_request_field(review_request, 'summary',
-                                            options.summary)
+            fields['summary'] = options.summary
 
         if options.branch:
-            server.set_review_request_field(review_request, 'branch',
-                                            options.branch)
+            fields['branch'] = options.branch
 
         if options.bugs_closed:     # append to existing list
             options.bugs_closed = options.bugs_closed.strip(", ")
             bug_set = set(re.split("[, ]+", options.bugs_closed)) | \
                       set(review_request['bugs_closed'])
             options.bugs_closed = ",".join(bug_set)
-            server.set_review_request_field(review_request, 'bugs_closed',
-                                            options.bugs_closed)
+            fields['bugs_closed'] = options.bugs_closed
 
         if options.description:
-            server.set_review_request_field(review_request, 'description',
-                                            options.description)
+            fields['description'] = options.description
 
         if options.testing_done:
-            server.set_review_request_field(review_request, 'testing_done',
-                                            options.testing_done)
+            fields['testing_done'] = options.testing_done
 
         if options.change_description:
-            server.set_review_request_field(review_request, 'changedescription',
-                                            options.change_description)
+            fields['changedescription'] = options.change_description
+
+        if fields:
+            profiler.run_phase('set_fields', server.set_review_request_fields,
+                               review_request, fields)
     except APIError, e:
         if e.error_code == 103: # Not logged in
             retries = retries - 1
@@ -3669,7 +6460,8 @@ def tempt_fate(server, tool, changenum, diff_content=None,
 
     if not server.info.supports_changesets or not options.change_only:
         try:
-            server.upload_diff(review_request, diff_content,
+            profiler.run_phase('upload_diff', server.upload_diff,
+                               review_request, diff_content,
                                parent_diff_content)
         except APIError, e:
             sys.stderr.write('\n')
@@ -3692,7 +6484,7 @@ def tempt_fate(server, tool, changenum, diff_content=None,
         server.reopen(review_request)
 
     if options.publish:
-        server.publish(review_request)
+        profiler.run_phase('publish', server.publish, review_request)
 
     request_url = 'r/' + str(review_request['id']) + '/'
     review_url = urljoin(server.url, request_url)
@@ -3707,7 +6499,8 @@ def tempt_fate(server, tool, changenum, diff_content=None,
     return review_url
 
 
-def parse_options(args):
+def create_option_parser():
+    """Returns the parser for post-review's command line options."""
     parser = OptionParser(usage="%prog [-pond] [-r review_id] [changenum]",
                           version="RBTools " + get_version_string())
 
@@ -3847,8 +6640,59 @@ def parse_options(args):
     parser.add_option('--http-password',
                       dest='http_password', default=None, metavar='PASSWORD',
                       help='password for HTTP Basic authentication')
+    parser.add_option('-j', '--jobs',
+                      dest='jobs', type='int', default=1, metavar='N',
+                      help='the number of files to fetch and diff at once '
+                           'for Perforce, ClearCase and Plastic')
+    parser.add_option('--use-gnu-diff',
+                      dest='use_gnu_diff', action='store_true', default=False,
+                      help='use GNU diff instead of the built-in diff when '
+                           'generating Perforce, ClearCase and Plastic diffs')
+    parser.add_option('--local-outgoing',
+                      dest='local_outgoing', action='store_true',
+                      default=False,
+                      help='work out the outgoing Mercurial changesets '
+                           'locally, using draft phases or the last known '
+                           'remote heads, instead of contacting the remote')
+    parser.add_option('--refresh-remote',
+                      dest='refresh_remote', action='store_true',
+                      default=False,
+                      help='with --local-outgoing, look up the remote '
+                           'heads again instead of using the last known '
+                           'ones')
+    parser.add_option('--hg-command-server',
+                      dest='hg_command_server', action='store_true',
+                      default=False,
+                      help='run Mercurial commands through a single '
+                           '"hg serve --cmdserver" process, instead of '
+                           'starting hg for each command')
+    parser.add_option('--no-cache',
+                      dest='no_cache', action='store_true', default=False,
+                      help='do not use or update the local cache of data '
+                           'from previous runs')
+    parser.add_option('--flush-cache',
+                      dest='flush_cache', action='store_true', default=False,
+                      help='clear the local cache of data from previous runs '
+                           'before running')
+
+    parser.add_option('--profile',
+                      dest='profile', action='store_true', default=False,
+                      help='show how long each step took, along with the '
+                           'commands run and HTTP requests made')
+    parser.add_option('--profile-json',
+                      dest='profile_json', metavar='FILE', default=None,
+                      help='write the --profile results to FILE as JSON')
+    parser.add_option('--trace-commands',
+                      dest='trace_commands', metavar='FILE', default=None,
+                      help='write each command run to FILE as Chrome '
+                           'trace events, and list the slowest commands '
+                           'at exit')
+
+    return parser
 
-    (globals()["options"], args) = parser.parse_args(args)
+
+def parse_options(args):
+    (globals()["options"], args) = create_option_parser().parse_args(args)
 
     if options.description and options.description_file:
         sys.stderr.write("The --description and --description-file options "
@@ -3893,93 +6737,127 @@ def parse_options(args):
     return args
 
 
+def get_scm_candidates(path):
+    """
+    Returns the SCM clients that are likely to work for a directory, most
+    likely first, based on marker files such as .git or .svn.
+
+    Clients with a marker closer to the directory come first. A Perforce
+    server or client set in the environment or on the command line also
+    makes Perforce a candidate, after any with marker files.
+    """
+    found = {}
+
+    for depth, parent in enumerate(walk_parents(path)):
+        for i, tool in enumerate(SCMCLIENTS):
+            if i in found:
+                continue
+
+            for marker in tool.get_marker_files():
+                if os.path.exists(os.path.join(parent, marker)):
+                    found[i] = depth
+                    break
+
+    max_depth = len(path.split(os.sep))
+
+    for i, tool in enumerate(SCMCLIENTS):
+        if (isinstance(tool, PerforceClient) and i not in found and
+            ('P4PORT' in os.environ or 'P4CLIENT' in os.environ or
+             options.p4_port or options.p4_client)):
+            found[i] = max_depth
+
+    ranked = [(depth, i) for i, depth in found.items()]
+    ranked.sort()
+
+    return [SCMCLIENTS[i] for depth, i in ranked]
+
+
 def determine_client():
     repository_info = None
     tool = None
 
-    # Try to find the SCM Client we're going to be working with.
-    for tool in SCMCLIENTS:
+    # Try to find the SCM Client we're going to be working with. Only the
+    # clients whose marker files are found are tried, so that we don't have
+    # to run every other SCM's tools before getting to the right one. The
+    # clients that can work without a marker file, such as Perforce and
+    # ClearCase, are tried afterward.
+    candidates = get_scm_candidates(os.getcwd())
+    fallbacks = [client for client in SCMCLIENTS
+                 if client not in candidates and
+                    not client.is_marker_required()]
+    debug('Likely SCM clients: %s' %
+          ', '.join([client.__class__.__name__ for client in candidates]))
+
+    for tool in candidates + fallbacks:
+        start = time.time()
         repository_info = tool.get_repository_info()
+        debug('Checked for %s in %.3fs' % (tool.__class__.__name__,
+                                           time.time() - start))
 
         if repository_info:
             break
 
     if not repository_info:
         if options.repository_url:
-            print "No supported repository could be access at the supplied url."
+            die("No supported repository could be access at the supplied "
+                "url.")
         else:
-            print "The current directory does not contain a checkout from a"
-            print "supported source code repository."
-        sys.exit(1)
+            die("The current directory does not contain a checkout from a\n"
+                "supported source code repository.")
 
     # Verify that options specific to an SCM Client have not been mis-used.
     if options.change_only and not repository_info.supports_changesets:
-        sys.stderr.write("The --change-only option is not valid for the "
-                         "current SCM client.\n")
-        sys.exit(1)
+        die("The --change-only option is not valid for the current SCM "
+            "client.")
 
     if options.parent_branch and not repository_info.supports_parent_diffs:
-        sys.stderr.write("The --parent option is not valid for the "
-                         "current SCM client.\n")
-        sys.exit(1)
+        die("The --parent option is not valid for the current SCM client.")
 
     if ((options.p4_client or options.p4_port) and \
         not isinstance(tool, PerforceClient)):
-        sys.stderr.write("The --p4-client and --p4-port options are not valid "
-                         "for the current SCM client.\n")
-        sys.exit(1)
+        die("The --p4-client and --p4-port options are not valid for the "
+            "current SCM client.")
 
     return (repository_info, tool)
 
 
-def main():
-    origcwd = os.path.abspath(os.getcwd())
-
+def get_home_path():
+    """Returns the directory holding the user's settings and cookies."""
     if 'APPDATA' in os.environ:
-        homepath = os.environ['APPDATA']
+        return os.environ['APPDATA']
     elif 'HOME' in os.environ:
-        homepath = os.environ["HOME"]
+        return os.environ["HOME"]
     else:
-        homepath = ''
-
-    # Load the config and cookie files
-    cookie_file = os.path.join(homepath, ".post-review-cookies.txt")
-    load_config_files(homepath)
-
-    args = parse_options(sys.argv[1:])
-
-    debug('RBTools %s' % get_version_string())
-    debug('Home = %s' % homepath)
+        return ''
 
-    repository_info, tool = determine_client()
 
-    # Verify that options specific to an SCM Client have not been mis-used.
-    tool.check_options()
+def get_cache_dir():
+    """
+    Returns the directory used for caching data between runs, or None if
+    caching has been turned off.
+    """
+    if options and options.no_cache:
+        return None
 
-    # Try to find a valid Review Board server to use.
-    if options.server:
-        server_url = options.server
-    else:
-        server_url = tool.scan_for_server(repository_info)
+    return os.path.join(get_home_path(), '.post-review-cache')
 
-    if not server_url:
-        print "Unable to find a Review Board server for this source code tree."
-        sys.exit(1)
 
-    server = ReviewBoardServer(server_url, repository_info, cookie_file)
+def flush_cache():
+    """Removes all data cached by previous runs."""
+    cache_dir = os.path.join(get_home_path(), '.post-review-cache')
 
-    # Handle the case where /api/ requires authorization (RBCommons).
-    if not server.check_api_version():
-        die("Unable to log in with the supplied username and password.")
+    if os.path.exists(cache_dir):
+        debug('Removing cache directory %s' % cache_dir)
+        shutil.rmtree(cache_dir, ignore_errors=True)
 
-    if repository_info.supports_changesets:
-        changenum = tool.get_changenum(args)
-    else:
-        changenum = None
 
+def get_diff(tool, repository_info, args, origcwd):
+    """
+    Returns the diff and parent diff to post, based on the options given.
+    """
     if options.revision_range:
-        diff, parent_diff = tool.diff_between_revisions(options.revision_range, args,
-                                                        repository_info)
+        diff, parent_diff = tool.diff_between_revisions(
+            options.revision_range, args, repository_info)
     elif options.svn_changelist:
         diff, parent_diff = tool.diff_changelist(options.svn_changelist)
     elif options.diff_filename:
@@ -3997,32 +6875,293 @@ def main():
     else:
         diff, parent_diff = tool.diff(args)
 
-    if len(diff) == 0:
-        die("There don't seem to be any diffs!")
+    return diff, parent_diff
+
+
+def write_profile():
+    """Reports the --profile, --profile-json and --trace-commands results."""
+    if options.profile:
+        sys.stderr.write(profiler.format_report())
+
+    if options.trace_commands:
+        sys.stderr.write(profiler.format_slowest_commands())
+
+        try:
+            fp = open(options.trace_commands, 'w')
+            fp.write(json_dumps(profiler.get_trace()))
+            fp.close()
+        except IOError, e:
+            sys.stderr.write('Unable to write command trace to %s: %s\n' %
+                             (options.trace_commands, e))
+
+    if options.profile_json:
+        try:
+            fp = open(options.profile_json, 'w')
+            fp.write(json_dumps(profiler.get_report()))
+            fp.close()
+        except IOError, e:
+            sys.stderr.write('Unable to write profile to %s: %s\n' %
+                             (options.profile_json, e))
+
+
+class PostReviewSession(object):
+    """
+    Posts review requests from within a Python process.
+
+    This does the work of the post-review command, and can be used for
+    many changes from one process. Settings are named after the
+    post-review options, such as summary, publish or revision_range. They
+    are given as keyword arguments, or as the values from
+    create_option_parser(), and can be overridden for a single call.
+
+    The connection to each server, along with its cookies and cached
+    data, is kept between calls until close() is called. Failures raise
+    PostReviewError instead of exiting.
+
+    The SCM clients still read their settings from the module's options,
+    so each call swaps in its own settings, configs and SCM clients. Calls
+    from different threads run one at a time.
+    """
+    def __init__(self, settings=None, **kwargs):
+        if settings is None:
+            settings = create_option_parser().get_default_values()
+
+        self.settings = self._make_settings(settings, kwargs)
+        self.homepath = get_home_path()
+        self.cookie_file = os.path.join(self.homepath,
+                                        ".post-review-cookies.txt")
+        self._servers = {}
+        self._configs = {}
+
+    def get_diff(self, args=None, cwd=None, **kwargs):
+        """
+        Returns the diff and parent diff for a change, without posting it.
+
+        args are the post-review command line arguments after the options,
+        such as a changeset number. The change is looked for in cwd, or the
+        current directory if not given.
+        """
+        return self._run(self._get_diff, args or [], cwd, kwargs)
+
+    def post(self, args=None, cwd=None, **kwargs):
+        """
+        Posts a change for review, returning the review request's URL.
+
+        The arguments are the same as for get_diff().
+        """
+        return self._run(self._post, args or [], cwd, kwargs)
+
+    def close(self):
+        """Closes the connections to the servers used in this session."""
+        for server, deprecated_api in self._servers.itervalues():
+            server.close()
+
+        self._servers = {}
+
+    def _get_diff(self, args, origcwd):
+        tool, repository_info, server_url = self._find_repository()
+        diff, parent_diff = profiler.run_phase('diff', get_diff, tool,
+                                               repository_info, args,
+                                               origcwd)
+
+        if len(diff) == 0:
+            die("There don't seem to be any diffs!")
+
+        return diff, parent_diff
+
+    def _post(self, args, origcwd):
+        tool, repository_info, server_url = self._find_repository()
+        server = self._get_server(server_url, repository_info)
+
+        if repository_info.supports_changesets:
+            changenum = tool.get_changenum(args)
+        else:
+            changenum = None
+
+        diff, parent_diff = profiler.run_phase('diff', get_diff, tool,
+                                               repository_info, args,
+                                               origcwd)
+
+        if len(diff) == 0:
+            die("There don't seem to be any diffs!")
+
+        if (isinstance(tool, PerforceClient) or
+            isinstance(tool, PlasticClient)) and changenum is not None:
+            changenum = tool.sanitize_changenum(changenum)
+
+            # NOTE: In Review Board 1.5.2 through 1.5.3.1, the changenum
+            #       support is broken, so we have to force the deprecated
+            #       API.
+            rb_version = parse_version(server.rb_version)
+
+            if (parse_version('1.5.2') <= rb_version <=
+                parse_version('1.5.3.1')):
+                debug('Using changenums on Review Board %s, which is broken. '
+                      'Falling back to the deprecated 1.0 API' %
+                      server.rb_version)
+                server.deprecated_api = True
+
+        # Let's begin.
+        profiler.run_phase('login', server.login)
+
+        return tempt_fate(server, tool, changenum, diff_content=diff,
+                          parent_diff_content=parent_diff,
+                          submit_as=options.submit_as)
+
+    def _find_repository(self):
+        """
+        Loads the configs for the current directory, and finds the
+        repository there and the server to post to.
+        """
+        self._load_configs()
+
+        repository_info, tool = profiler.run_phase('determine_client',
+                                                   determine_client)
+
+        # Verify that options specific to an SCM Client have not been
+        # mis-used.
+        tool.check_options()
+
+        # Try to find a valid Review Board server to use.
+        if options.server:
+            server_url = options.server
+        else:
+            server_url = profiler.run_phase('scan_for_server',
+                                            tool.scan_for_server,
+                                            repository_info)
+
+        if not server_url:
+            die("Unable to find a Review Board server for this source code "
+                "tree.")
+
+        return tool, repository_info, server_url
+
+    def _load_configs(self):
+        """Loads the configs for the current directory, if not yet loaded."""
+        global user_config, configs
+
+        cwd = os.getcwd()
+
+        if cwd in self._configs:
+            user_config, configs = self._configs[cwd]
+        else:
+            user_config = None
+            configs = []
+            profiler.run_phase('load_config', load_config_files,
+                               self.homepath)
+            self._configs[cwd] = (user_config, configs)
+
+    def _get_server(self, server_url, repository_info):
+        """
+        Returns the server to post to, connecting to it the first time
+        it's used.
+        """
+        if server_url in self._servers:
+            server, deprecated_api = self._servers[server_url]
+            server.set_repository_info(repository_info)
+            server.deprecated_api = deprecated_api
+        else:
+            server = ReviewBoardServer(server_url, repository_info,
+                                       self.cookie_file, get_cache_dir())
+
+            # Handle the case where /api/ requires authorization
+            # (RBCommons).
+            if not profiler.run_phase('check_api_version',
+                                      server.check_api_version):
+                die("Unable to log in with the supplied username and "
+                    "password.")
+
+            self._servers[server_url] = (server, server.deprecated_api)
+
+        return server
+
+    def _make_settings(self, settings, overrides):
+        settings = Values(vars(settings))
+
+        for key, value in overrides.iteritems():
+            if not hasattr(settings, key):
+                raise TypeError('%s is not a post-review setting' % key)
+
+            setattr(settings, key, value)
+
+        return settings
+
+    def _run(self, func, args, cwd, kwargs):
+        """
+        Calls func with this session's settings in place of the module's
+        options, restoring them afterward.
+        """
+        global options, user_config, configs, SCMCLIENTS
+
+        _post_review_lock.acquire()
+
+        saved_state = (options, user_config, configs, SCMCLIENTS)
+        origcwd = os.getcwd()
 
-    if (isinstance(tool, PerforceClient) or
-        isinstance(tool, PlasticClient)) and changenum is not None:
-        changenum = tool.sanitize_changenum(changenum)
+        try:
+            options = self._make_settings(self.settings, kwargs)
+
+            # Each change gets its own SCM clients, so that nothing cached
+            # for one checkout is used for the next.
+            SCMCLIENTS = tuple([client.__class__()
+                                for client in SCMCLIENTS])
+
+            if cwd:
+                os.chdir(cwd)
+
+            return func(args, os.getcwd())
+        finally:
+            for client in SCMCLIENTS:
+                client.close()
+
+            # The command sessions are in the directory of this change and
+            # may hold onto its state, so the next change starts its own.
+            close_sessions()
+            cleanup_tempfiles()
+            os.chdir(origcwd)
+            options, user_config, configs, SCMCLIENTS = saved_state
+            _post_review_lock.release()
+
+
+def main():
+    args = parse_options(sys.argv[1:])
+
+    debug('RBTools %s' % get_version_string())
+    debug('Home = %s' % get_home_path())
+
+    if options.profile or options.profile_json or options.trace_commands:
+        profiler.enabled = True
 
-        # NOTE: In Review Board 1.5.2 through 1.5.3.1, the changenum support
-        #       is broken, so we have to force the deprecated API.
-        if (parse_version(server.rb_version) >= parse_version('1.5.2') and
-            parse_version(server.rb_version) <= parse_version('1.5.3.1')):
-            debug('Using changenums on Review Board %s, which is broken. '
-                  'Falling back to the deprecated 1.0 API' % server.rb_version)
-            server.deprecated_api = True
+        # Report the results however post-review exits.
+        atexit.register(write_profile)
 
-    if options.output_diff_only:
-        # The comma here isn't a typo, but rather suppresses the extra newline
-        print diff,
-        sys.exit(0)
+    if options.flush_cache:
+        flush_cache()
 
-    # Let's begin.
-    server.login()
+    session = PostReviewSession(options)
 
-    review_url = tempt_fate(server, tool, changenum, diff_content=diff,
-                            parent_diff_content=parent_diff,
-                            submit_as=options.submit_as)
+    try:
+        try:
+            if options.output_diff_only:
+                # Diffs that are only printed never need the server, so
+                # don't connect to it (or load the networking modules) in
+                # that case.
+                diff, parent_diff = session.get_diff(args)
+
+                # The comma here isn't a typo, but rather suppresses the
+                # extra newline
+                print diff,
+                sys.exit(0)
+
+            review_url = session.post(args)
+        except PostReviewError, e:
+            if e.msg:
+                print e.msg
+
+            sys.exit(1)
+    finally:
+        session.close()
+        cleanup_tempfiles()
 
     # Load the review up in the browser if requested to:
     if options.open_browser:
@@ -4040,4 +7179,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    # Run the copy of this module loaded through the rbtools package, so
+    # that the state it shares with rbtools.transport is in one place.
+    import rbtools.postreview
+    rbtools.postreview.main()
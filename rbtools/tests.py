@@ -1,8 +1,10 @@
 import os
 import re
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
 import urllib2
@@ -20,11 +22,24 @@ except ImportError:
     import simplejson as json
 
 import nose
-
-from rbtools.postreview import execute, load_config_files
-from rbtools.postreview import APIError, GitClient, MercurialClient, \
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from rbtools.postreview import check_install, cleanup_tempfiles, \
+                               close_sessions, die, diff_files, execute, \
+                               execute_stream, find_executable, \
+                               get_scm_candidates, load_config_files, \
+                               make_tempfile, run_cleartool, unified_diff
+from rbtools.postreview import APIError, ClearCaseClient, \
+                               CleartoolSession, CmShellSession, \
+                               GitClient, \
+                               HgCommandServer, HTTPConnectionPool, \
+                               MercurialClient, MultipartFormData, \
+                               PerforceClient, PlasticClient, \
+                               PostReviewError, PostReviewSession, Profiler, \
                                RepositoryInfo, ReviewBoardServer, \
-                               SvnRepositoryInfo
+                               SCMClient, SVNClient, SvnRepositoryInfo, \
+                               parse_version, run_parallel
+from rbtools.transport import KeepAliveHTTPHandler, ProfilingHandler
 import rbtools.postreview
 
 
@@ -66,20 +81,26 @@ class MockHttpUnitTest(unittest.TestCase):
 
         self.saved_http_get = ReviewBoardServer.http_get
         self.saved_http_post = ReviewBoardServer.http_post
+        self.saved_http_put = ReviewBoardServer.http_put
 
         self.server = ReviewBoardServer('http://localhost:8080/',
                                         RepositoryInfo(), None)
         ReviewBoardServer.http_get = self._http_method
         ReviewBoardServer.http_post = self._http_method
+        ReviewBoardServer.http_put = self._http_method
 
         self.server.deprecated_api = self.deprecated_api
         self.http_response = {}
+        self.http_requests = []
 
     def tearDown(self):
         ReviewBoardServer.http_get = self.saved_http_get
         ReviewBoardServer.http_post = self.saved_http_post
+        ReviewBoardServer.http_put = self.saved_http_put
 
     def _http_method(self, path, *args, **kwargs):
+        self.http_requests.append((path, args))
+
         if isinstance(self.http_response, dict):
             http_response = self.http_response[path]
         else:
@@ -100,6 +121,13 @@ class OptionsStub(object):
         self.username = None
         self.password = None
         self.repository_url = None
+        self.use_gnu_diff = False
+        self.jobs = 1
+        self.p4_port = None
+        self.p4_client = None
+        self.no_cache = True
+        self.local_outgoing = False
+        self.refresh_remote = False
 
 
 class GitClientTests(unittest.TestCase):
@@ -170,6 +198,35 @@ class GitClientTests(unittest.TestCase):
         self.assertTrue(ri.supports_parent_diffs)
         self.assertFalse(ri.supports_changesets)
 
+    def test_get_repository_info_unborn_branch(self):
+        """Test GitClient get_repository_info on a branch with no commits"""
+        empty_dir = _get_tmpdir()
+
+        try:
+            os.chdir(empty_dir)
+            self._gitcmd(['init'])
+            self._gitcmd(['symbolic-ref', 'HEAD', 'refs/heads/unborn'])
+
+            ri = self.client.get_repository_info()
+            self.assert_(isinstance(ri, RepositoryInfo))
+            self.assertEqual(self.client.head_ref, 'refs/heads/unborn')
+        finally:
+            os.chdir(self.orig_dir)
+            shutil.rmtree(empty_dir)
+
+    def test_get_repository_info_detached_head(self):
+        """Test GitClient get_repository_info with a detached HEAD"""
+        os.chdir(self.clone_dir)
+        self._gitcmd(['checkout', '-q', 'HEAD^0'])
+
+        ri = self.client.get_repository_info()
+        self.assert_(isinstance(ri, RepositoryInfo))
+        self.assertEqual(self.client.head_ref, 'HEAD')
+
+        self._git_add_file_commit('foo.txt', FOO1, 'delete and modify stuff')
+        diff, parent_diff = self.client.diff(None)
+        self.assertTrue(diff.startswith('diff --git a/foo.txt b/foo.txt\n'))
+
     def test_scan_for_server_simple(self):
         """Test GitClient scan_for_server, simple case"""
         os.chdir(self.clone_dir)
@@ -412,6 +469,78 @@ class GitClientTests(unittest.TestCase):
         self.client.get_repository_info()
         self.assertEqual(self.client.diff(None), (diff, None))
 
+    def test_convert_to_svn_diff(self):
+        """Test GitClient converting a git-svn diff to an svn diff"""
+        diff = [
+            "diff --git foo.txt foo.txt\n",
+            "index 5e98e95..e619c13 100644\n",
+            "--- foo.txt\n",
+            "+++ foo.txt\n",
+            "@@ -1 +1,2 @@\n",
+            " ARMA virumque cano, Troiae qui primus ab oris\n",
+            "+Italiam, fato profugus, Laviniaque venit\n",
+            "diff --git new.txt new.txt\n",
+            "new file mode 100644\n",
+            "index 0000000..e619c13\n",
+            "--- /dev/null\n",
+            "+++ new.txt\n",
+            "@@ -0,0 +1 @@\n",
+            "+ARMA virumque cano, Troiae qui primus ab oris\n",
+            "diff --git logo.png logo.png\n",
+            "index 0000000..e619c13\n",
+            "Binary files logo.png and logo.png differ\n",
+        ]
+
+        self.assertEqual(
+            ''.join(self.client._convert_to_svn_diff(iter(diff), '12')),
+            "Index: foo.txt\n" +
+            "=" * 67 + "\n" +
+            "--- foo.txt\t(revision 12)\n"
+            "+++ foo.txt\t(working copy)\n"
+            "@@ -1 +1,2 @@\n"
+            " ARMA virumque cano, Troiae qui primus ab oris\n"
+            "+Italiam, fato profugus, Laviniaque venit\n"
+            "Index: new.txt\n" +
+            "=" * 67 + "\n" +
+            "--- new.txt\t(revision 0)\n"
+            "+++ new.txt\t(revision 0)\n"
+            "@@ -0,0 +1 @@\n"
+            "+ARMA virumque cano, Troiae qui primus ab oris\n"
+            "Index: logo.png\n" +
+            "=" * 67 + "\n" +
+            "Cannot display: file marked as a binary type.\n"
+            "svn:mime-type = application/octet-stream\n")
+
+    def test_parse_config(self):
+        """Test GitClient parsing git config --list -z output"""
+        config = self.client._parse_config(
+            'core.bare\0'
+            'branch.My-Branch.remote\norigin\0'
+            'alias.lg\nlog\n--graph\0'
+            'remote.origin.url\nold\0'
+            'remote.origin.url\nnew\0')
+
+        self.assertEqual(config, {
+            'core.bare': '',
+            'branch.My-Branch.remote': 'origin',
+            'alias.lg': 'log\n--graph',
+            'remote.origin.url': 'new',
+        })
+
+    def test_get_config(self):
+        """Test GitClient looking up git config settings"""
+        os.chdir(self.clone_dir)
+        self._gitcmd(['config', 'reviewboard.url', self.TESTSERVER])
+
+        self.client.get_repository_info()
+        self.assertEqual(self.client.head_ref,
+                         self._gitcmd(['symbolic-ref', 'HEAD']).strip())
+        self.assertEqual(self.client._get_config('Remote.origin.URL'),
+                         self.git_dir)
+        self.assertEqual(self.client._get_config('reviewboard.url'),
+                         self.TESTSERVER)
+        self.assertEqual(self.client._get_config('remote.Origin.url'), '')
+
 
 class MercurialTestBase(unittest.TestCase):
 
@@ -778,6 +907,149 @@ class MercurialSubversionClientTests(MercurialTestBase):
         self.assertEqual(EXPECTED_HG_SVN_DIFF_1, self.client.diff(None)[0])
 
 
+class MercurialLocalOutgoingTests(unittest.TestCase):
+    REMOTE_HEAD = 'b' * 40
+
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        rbtools.postreview.options.local_outgoing = True
+        rbtools.postreview.options.no_cache = False
+
+        self.tmpdir = _get_tmpdir()
+        self.saved_environ = os.environ.copy()
+        os.environ['HOME'] = self.tmpdir
+
+        if 'APPDATA' in os.environ:
+            del os.environ['APPDATA']
+
+        self.client = MercurialClient()
+        self.client._hg_root = self.tmpdir
+        self.client._run_hg = self._run_hg
+        self.has_phases = True
+        self.commands = []
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        shutil.rmtree(self.tmpdir)
+
+    def _run_hg(self, args, split_lines=False, ignore_errors=False):
+        self.commands.append(args)
+
+        if args[0] == '-q' and args[1] == 'outgoing':
+            return 'a' * 40 + '\n'
+        elif args[2] == 'draft() and branch(.)':
+            if self.has_phases:
+                return '4\n5\n'
+            else:
+                return 'hg: parse error: unknown identifier: draft\n'
+        elif args[2] == 'heads(all() - (%s))' % ('a' * 40):
+            return self.REMOTE_HEAD + '\n'
+        elif args[2] == 'branch(.) - ::(%s)' % self.REMOTE_HEAD:
+            return '7\n'
+
+        self.fail('Unexpected hg command: %r' % args)
+
+    def test_draft_phases(self):
+        """Testing MercurialClient finding outgoing changesets by phase"""
+        self.assertEqual(
+            self.client._get_outgoing_changesets('default', 'default'),
+            [4, 5])
+        self.assertEqual(len(self.commands), 1)
+
+    def test_remote_heads(self):
+        """Testing MercurialClient finding outgoing changesets from cached remote heads"""
+        self.has_phases = False
+
+        self.assertEqual(
+            self.client._get_outgoing_changesets('default', 'default'), [7])
+        self.assertEqual(len([args for args in self.commands
+                              if 'outgoing' in args]), 1)
+
+        # The remote heads are cached for the next run.
+        self.commands = []
+        self.assertEqual(
+            self.client._get_outgoing_changesets('default', 'default'), [7])
+        self.assertEqual(len([args for args in self.commands
+                              if 'outgoing' in args]), 0)
+
+        # Unless they're explicitly refreshed.
+        rbtools.postreview.options.refresh_remote = True
+        self.commands = []
+        self.assertEqual(
+            self.client._get_outgoing_changesets('default', 'default'), [7])
+        self.assertEqual(len([args for args in self.commands
+                              if 'outgoing' in args]), 1)
+
+
+class HgCommandServerTests(unittest.TestCase):
+    FAKE_SERVER = dedent("""
+    import struct, sys
+
+    def write(channel, data):
+        sys.stdout.write(channel + struct.pack('>I', len(data)) + data)
+        sys.stdout.flush()
+
+    write('o', 'capabilities: getencoding runcommand\\nencoding: UTF-8')
+
+    while sys.stdin.readline():
+        length = struct.unpack('>I', sys.stdin.read(4))[0]
+        args = sys.stdin.read(length).split('\\0')
+
+        if args[0] == 'fail':
+            write('e', 'abort: failed\\n')
+            write('r', struct.pack('>i', 255))
+        else:
+            write('o', ' '.join(args) + '\\n')
+            write('r', struct.pack('>i', 0))
+    """)
+
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        rbtools.postreview.options.hg_command_server = True
+
+        self.tmpdir = _get_tmpdir()
+        self.server_script = os.path.join(self.tmpdir, 'server.py')
+        fp = open(self.server_script, 'w')
+        fp.write(self.FAKE_SERVER)
+        fp.close()
+
+        self.orig_command = HgCommandServer.command
+        HgCommandServer.command = [sys.executable, self.server_script]
+
+    def tearDown(self):
+        HgCommandServer.command = self.orig_command
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_command(self):
+        """Testing HgCommandServer.run_command"""
+        server = HgCommandServer({'HGPLAIN': '1'})
+        self.assertTrue(server.start())
+        self.assertEqual(server.run_command(['log', '-r', '1']),
+                         (0, 'log -r 1\n'))
+        self.assertEqual(server.run_command(['fail']),
+                         (255, 'abort: failed\n'))
+        server.close()
+
+    def test_client_uses_server(self):
+        """Testing MercurialClient running commands through the server"""
+        client = MercurialClient()
+        client._hg_root = self.tmpdir
+
+        self.assertEqual(client._run_hg(['branch']), 'branch\n')
+        self.assertEqual(client._run_hg(['fail'], ignore_errors=True),
+                         'abort: failed\n')
+        self.assertRaises(PostReviewError, client._run_hg, ['fail'])
+        client._hg_server.close()
+
+    def test_unavailable(self):
+        """Testing HgCommandServer when the server can't be started"""
+        HgCommandServer.command = [sys.executable, '-c', 'pass']
+        server = HgCommandServer({})
+        self.assertFalse(server.start())
+        self.assertEqual(server.process, None)
+
+
 class SVNClientTests(unittest.TestCase):
     def test_relative_paths(self):
         """Testing SvnRepositoryInfo._get_relative_path"""
@@ -797,6 +1069,476 @@ class SVNClientTests(unittest.TestCase):
             info._get_relative_path('/trunk/myproject', '/trunk/myproject'),
             '/')
 
+    def test_parse_svn_info_xml(self):
+        """Testing SVNClient._parse_svn_info_xml"""
+        client = SVNClient()
+        info = client._parse_svn_info_xml(SVN_INFO_XML)
+
+        self.assertEqual(info, {
+            'foo.c': {
+                'Path': 'foo.c',
+                'Revision': '12',
+                'Node Kind': 'file',
+                'URL': 'http://svn.example.com/svn/trunk/foo.c',
+                'Repository Root': 'http://svn.example.com/svn',
+                'Repository UUID': '3b7a1e3c-0000-0000-0000-000000000000',
+            },
+            'new dir/bar.c': {
+                'Path': 'new dir/bar.c',
+                'Revision': '-1',
+                'Node Kind': 'file',
+                'URL': 'http://svn.example.com/svn/trunk/new%20dir/bar.c',
+                'Repository Root': 'http://svn.example.com/svn',
+                'Repository UUID': '3b7a1e3c-0000-0000-0000-000000000000',
+                'Copied From URL':
+                    'http://svn.example.com/svn/branches/1.0/bar.c',
+                'Copied From Rev': '10',
+            },
+        })
+        self.assertEqual(client._parse_svn_info_xml('svn: E200009'), {})
+
+    def test_get_diff_paths(self):
+        """Testing SVNClient._get_diff_paths"""
+        client = SVNClient()
+        diff = [
+            'Index: foo.c\n',
+            '=' * 67 + '\n',
+            '--- foo.c\t(revision 12)\n',
+            '+++ foo.c\t(working copy)\n',
+            '@@ -1 +1 @@\n',
+            '--- /trunk/bar.c\t(revision 12)\n',
+            '+++ new dir/bar.c\t(working copy)\n',
+        ]
+
+        self.assertEqual(client._get_diff_paths(diff),
+                         ['foo.c', 'new dir/bar.c'])
+
+    def test_find_server_repository_info(self):
+        """Testing SvnRepositoryInfo.find_server_repository_info"""
+        rbtools.postreview.options = OptionsStub()
+        server = RepositoryServerStub([
+            {'id': 1, 'tool': 'Git', 'uuid': None},
+            {'id': 2, 'tool': 'Subversion', 'uuid': 'other-uuid'},
+            {'id': 3, 'tool': 'Subversion', 'uuid': None},
+            {'id': 4, 'tool': 'Subversion', 'uuid': None},
+            {'id': 5, 'tool': 'Subversion', 'uuid': None},
+        ], {
+            3: {
+                'uuid': 'my-uuid',
+                'url': 'svn://example.com/repo/trunk',
+                'root_url': 'svn://example.com/repo',
+            },
+            4: {
+                'uuid': 'another-uuid',
+            },
+            5: {
+                # A later match, which must not replace the first one.
+                'uuid': 'my-uuid',
+                'url': 'svn://example.com/mirror/trunk',
+                'root_url': 'svn://example.com/mirror',
+            },
+        })
+
+        info = SvnRepositoryInfo('http://svn.example.com/svn/',
+                                 '/trunk/myproject', 'my-uuid')
+        server_info = info.find_server_repository_info(server)
+        self.assertEqual(server_info.path, 'svn://example.com/repo/trunk')
+        self.assertEqual(server_info.base_path, '/myproject')
+
+        # Repositories known not to match are never looked up.
+        self.assertFalse(2 in server.info_requests)
+        self.assertEqual(server.matches, {
+            'svn:my-uuid': {
+                'id': 3,
+                'url': 'svn://example.com/repo/trunk',
+                'base_path': '/trunk',
+            },
+        })
+
+        # Later lookups use the cached match.
+        server.info_requests = []
+        server_info = info.find_server_repository_info(server)
+        self.assertEqual(server_info.path, 'svn://example.com/repo/trunk')
+        self.assertEqual(server.info_requests, [])
+
+    def test_convert_to_absolute_paths(self):
+        """Testing SVNClient.convert_to_absolute_paths with a repository URL"""
+        rbtools.postreview.options = OptionsStub()
+        rbtools.postreview.options.repository_url = \
+            'http://svn.example.com/svn/trunk'
+        client = SVNClient()
+        info = SvnRepositoryInfo('http://svn.example.com/svn/', '/trunk', '')
+        diff = [
+            'Index: foo.c\n',
+            '=' * 67 + '\n',
+            '--- foo.c\t(revision 1)\n',
+            '+++ foo.c\t(revision 2)\n',
+            '@@ -1 +1 @@\n',
+        ]
+
+        result = client.convert_to_absolute_paths(
+            client.handle_renames(iter(diff)), info)
+        self.assertEqual(list(result), [
+            'Index: /trunk/foo.c\n',
+            '=' * 67 + '\n',
+            '--- /trunk/foo.c\t(revision 1)\n',
+            '+++ /trunk/foo.c\t(revision 2)\n',
+            '@@ -1 +1 @@\n',
+        ])
+
+
+class PerforceClientTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        self.client = PerforceClient()
+        self.client._run_p4_batch = self._run_p4_batch
+        self.batch_commands = []
+
+    def tearDown(self):
+        self.client._clear_fetched_files()
+
+    def test_fetch_files(self):
+        """Testing PerforceClient._fetch_files"""
+        self.records = {
+            'print': [
+                {'code': 'stat', 'depotFile': '//depot/a.c', 'rev': '3'},
+                {'code': 'text', 'data': 'line 1\n'},
+                {'code': 'text', 'data': 'line 2\n'},
+                {'code': 'text', 'data': ''},
+                {'code': 'error', 'data': '//depot/b.c#2 - no such file\n'},
+                {'code': 'stat', 'depotFile': '//depot/c.png', 'rev': '7'},
+                {'code': 'binary', 'data': '\x89PNG\x00'},
+            ],
+            'where': [
+                {'code': 'stat', 'depotFile': '//depot/d.c',
+                 'path': '/old/d.c', 'unmap': ''},
+                {'code': 'stat', 'depotFile': '//depot/d.c',
+                 'path': '/src/d.c'},
+            ],
+        }
+
+        self.client._fetch_files(['//depot/a.c#3', '//depot/b.c#2',
+                                  '//depot/c.png'],
+                                 ['//depot/d.c'])
+
+        self.assertEqual(self.batch_commands, [
+            (['print'], ['//depot/a.c#3', '//depot/b.c#2', '//depot/c.png']),
+            (['where'], ['//depot/d.c']),
+        ])
+
+        filename = self.client._get_file('//depot/a.c#3', None)
+        self.assertEqual(open(filename, 'rb').read(),
+                         'line 1\nline 2\n'.replace('\n', os.linesep))
+
+        filename = self.client._get_file('//depot/c.png', None)
+        self.assertEqual(open(filename, 'rb').read(), '\x89PNG\x00')
+
+        self.assertFalse('//depot/b.c#2' in self.client._fetched_files)
+        self.assertEqual(self.client._depot_to_local('//depot/d.c'),
+                         '/src/d.c')
+
+    def _run_p4_batch(self, command, args):
+        self.batch_commands.append((command, args))
+        return iter(self.records[command[0]])
+
+
+class ClearCaseClientTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        self.client = ClearCaseClient()
+        self.saved_run_cleartool = rbtools.postreview.run_cleartool
+        rbtools.postreview.run_cleartool = self._run_cleartool
+        self.commands = []
+
+    def tearDown(self):
+        rbtools.postreview.run_cleartool = self.saved_run_cleartool
+
+    def test_batch_args(self):
+        """Testing ClearCaseClient._batch_args"""
+        self.assertEqual(
+            self.client._batch_args(['aaa', 'bbb', 'ccc', 'dddddddddd'], 8),
+            [['aaa', 'bbb'], ['ccc'], ['dddddddddd']])
+
+    def test_get_branch_changeset(self):
+        """Testing ClearCaseClient.get_branch_changeset"""
+        self.client.DESCRIBE_MAX_ARGS_LENGTH = 60
+        changeset = self.client.get_branch_changeset('mybranch')
+
+        self.assertEqual(len(self.commands), 3)
+        self.assertEqual(self.commands[0][-1], '-print')
+        self.assertEqual(self.commands[1][-2:], [
+            '/vobs/a.c@@/main/mybranch/0',
+            '/vobs/a.c@@/main/mybranch/1',
+        ])
+        self.assertEqual(self.commands[2][-1], '/vobs/b.c@@/main/mybranch/1')
+
+        changeset.sort()
+        self.assertEqual(changeset, [
+            ('/vobs/a.c@@/main/3', '/vobs/a.c@@/main/mybranch/1'),
+            ('/vobs/b.c@@/main/mybranch/0', '/vobs/b.c@@/main/mybranch/1'),
+        ])
+
+    def _run_cleartool(self, command, *args, **kwargs):
+        self.commands.append(command)
+
+        if command[0] == 'find':
+            return ('/vobs/a.c@@/main/mybranch/0\n'
+                    '/vobs/a.c@@/main/mybranch/1\n'
+                    '/vobs/b.c@@/main/mybranch/1\n')
+
+        previous = {
+            '0': '/main/3',
+            '1': '/main/mybranch/0',
+        }
+
+        return ''.join([
+            '%s\t%s\t%s\n' % (version.split('@@')[0],
+                              previous[version[-1]],
+                              version.split('@@')[1])
+            for version in command[3:]
+        ])
+
+
+class CleartoolSessionTests(unittest.TestCase):
+    FAKE_CLEARTOOL = dedent("""
+    import os, shlex, sys
+
+    count = 0
+
+    while True:
+        sys.stdout.write('cleartool> ')
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+
+        if not line:
+            break
+
+        args = shlex.split(line)
+        count += 1
+        status = 0
+
+        if args[0] == 'quit':
+            break
+        elif args[0] == 'cd':
+            os.chdir(args[1])
+        elif args[0] == 'pwd':
+            sys.stdout.write(os.getcwd() + '\\n')
+        elif args[0] == 'describe':
+            sys.stdout.write(args[2].replace('%On', 'oid:' + args[3]))
+        else:
+            sys.stderr.write('cleartool: Error: Unrecognized command\\n')
+            sys.stderr.flush()
+            status = 1
+
+        sys.stdout.write('Command %d returned status %d\\n' % (count, status))
+        sys.stdout.flush()
+    """)
+
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+
+        self.tmpdir = _get_tmpdir()
+        self.cleartool_script = os.path.join(self.tmpdir, 'cleartool.py')
+        fp = open(self.cleartool_script, 'w')
+        fp.write(self.FAKE_CLEARTOOL)
+        fp.close()
+
+        self.orig_command = CleartoolSession.command
+        CleartoolSession.command = [sys.executable, self.cleartool_script]
+        rbtools.postreview._sessions.clear()
+
+    def tearDown(self):
+        close_sessions()
+        CleartoolSession.command = self.orig_command
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_command(self):
+        """Testing CleartoolSession.run_command"""
+        session = CleartoolSession()
+        self.assertTrue(session.start())
+        self.assertEqual(session.run_command(['describe', '-fmt',
+                                              r'%On\t', 'my file']),
+                         (0, r'oid:my file\t', ''))
+        self.assertEqual(session.run_command(['bogus']),
+                         (1, '', 'cleartool: Error: Unrecognized command\n'))
+        session.close()
+
+    def test_run_cleartool(self):
+        """Testing run_cleartool"""
+        self.assertEqual(run_cleartool(['describe', '-fmt', '%On', 'a.c']),
+                         'oid:a.c')
+        self.assertEqual(run_cleartool(['bogus'], ignore_errors=True),
+                         'cleartool: Error: Unrecognized command\n')
+        self.assertEqual(run_cleartool(['bogus'], extra_ignore_errors=(1,),
+                                       with_errors=False),
+                         '')
+        self.assertRaises(PostReviewError, run_cleartool, ['bogus'])
+
+
+class CmShellSessionTests(unittest.TestCase):
+    FAKE_CM = dedent("""
+    import os, sys
+
+    while True:
+        line = sys.stdin.readline()
+
+        if not line:
+            break
+
+        args = line.split()
+        status = 0
+
+        if args[0] == 'exit':
+            break
+        elif args[0] == 'cd':
+            os.chdir(args[1])
+        elif args[0] == 'getworkspacefrompath':
+            sys.stdout.write(os.getcwd() + '\\n')
+        elif args[0] != 'version':
+            status = 1
+
+        sys.stdout.write('CommandResult %d\\n' % status)
+        sys.stdout.flush()
+    """)
+
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+
+        self.orig_dir = os.getcwd()
+        self.tmpdir = os.path.realpath(_get_tmpdir())
+        self.workspace_dir = os.path.join(self.tmpdir, 'workspace')
+        os.mkdir(self.workspace_dir)
+
+        self.cm_script = os.path.join(self.tmpdir, 'cm.py')
+        fp = open(self.cm_script, 'w')
+        fp.write(self.FAKE_CM)
+        fp.close()
+
+        self.orig_command = CmShellSession.command
+        CmShellSession.command = [sys.executable, self.cm_script]
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        CmShellSession.command = self.orig_command
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_command_cwd(self):
+        """Testing CmShellSession.run_command following the current directory"""
+        os.chdir(self.tmpdir)
+        session = CmShellSession()
+        self.assertTrue(session.start())
+        self.assertEqual(session.run_command(['getworkspacefrompath']),
+                         (0, self.tmpdir + '\n', ''))
+
+        os.chdir(self.workspace_dir)
+        self.assertEqual(session.run_command(['getworkspacefrompath']),
+                         (0, self.workspace_dir + '\n', ''))
+        session.close()
+
+
+class PlasticClientTests(unittest.TestCase):
+    CONTENTS = {
+        'rev:revid:10': 'old\n',
+        'rev:revid:11': 'new\n',
+        'rev:revid:20': 'added\n',
+        'rev:revid:30': 'old\n',
+        'rev:revid:31': 'old\n',
+    }
+
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        self.client = PlasticClient()
+        self.client.workspacedir = '/ws'
+        self.saved_run_cm = rbtools.postreview.run_cm
+        rbtools.postreview.run_cm = self._run_cm
+        self.cat_revspecs = []
+        self.log = [
+            'C /ws/a.c rev:revid:11 rev:revid:10 '
+            'src: rev:revid:-1 dst: rev:revid:-1\n',
+            'A /ws/b.c rev:revid:20 rev:revid:-1 '
+            'src: rev:revid:-1 dst: rev:revid:-1\n',
+            'M /ws/c.c rev:revid:31 rev:revid:30 '
+            'src:/ws/d.c rev:revid:30 dst:/ws/c.c rev:revid:31\n',
+        ]
+
+    def tearDown(self):
+        rbtools.postreview.run_cm = self.saved_run_cm
+
+    def test_changenum_diff(self):
+        """Testing PlasticClient.changenum_diff fetching revisions in bulk"""
+        fetched = []
+        saved_clear = self.client._clear_fetched_revisions
+
+        def clear_fetched_revisions():
+            fetched.append(self.client._revision_files.copy())
+            saved_clear()
+
+        self.client._clear_fetched_revisions = clear_fetched_revisions
+
+        diff = self.client.changenum_diff('5')
+
+        # Each revision is fetched once, and identical contents are
+        # stored once.
+        self.cat_revspecs.sort()
+        self.assertEqual(self.cat_revspecs, ['rev:revid:10', 'rev:revid:11',
+                                             'rev:revid:20', 'rev:revid:30',
+                                             'rev:revid:31'])
+        self.assertEqual(fetched[0]['rev:revid:10'],
+                         fetched[0]['rev:revid:30'])
+        self.assertNotEqual(fetched[0]['rev:revid:10'],
+                            fetched[0]['rev:revid:11'])
+        self.assertEqual(self.client._fetch_dir, None)
+
+        self.assertTrue('-old\n+new\n' in diff)
+        self.assertTrue('+added\n' in diff)
+        self.assertTrue('--- /a.c\trev:revid:10' in diff)
+        self.assertTrue('+++ /c.c\trev:revid:31' in diff)
+
+    def test_changenum_diff_no_revision(self):
+        """Testing PlasticClient.changenum_diff with a missing revision"""
+        self.log = [
+            'M /ws/e.c rev:revid:20 rev:revid:-1 '
+            'src:/ws/f.c rev:revid:-1 dst:/ws/e.c rev:revid:20\n',
+        ]
+
+        diff = self.client.changenum_diff('5')
+
+        self.assertEqual(self.cat_revspecs, ['rev:revid:20'])
+        self.assertTrue('+added\n' in diff)
+
+    def _run_cm(self, args, **kwargs):
+        if args[0] == 'log':
+            return self.log
+        elif args[0] == 'cat':
+            self.cat_revspecs.append(args[1])
+            fp = open(args[2][len('--file='):], 'w')
+            fp.write(self.CONTENTS[args[1]])
+            fp.close()
+            return ''
+
+        self.fail('Unexpected cm command: %r' % args)
+
+
+class RepositoryServerStub(object):
+    def __init__(self, repositories, repository_info):
+        self.repositories = repositories
+        self.repository_info = repository_info
+        self.info_requests = []
+        self.matches = {}
+
+    def get_repositories(self):
+        return self.repositories
+
+    def get_repository_info(self, rid):
+        self.info_requests.append(rid)
+        return self.repository_info[rid]
+
+    def get_repository_match(self, key):
+        return self.matches.get(key)
+
+    def set_repository_match(self, key, match):
+        self.matches[key] = match
+
 
 class ApiTests(MockHttpUnitTest):
     def setUp(self):
@@ -839,6 +1581,28 @@ class ApiTests(MockHttpUnitTest):
         self.server.check_api_version()
         self.assertTrue(self.server.deprecated_api)
 
+    def test_set_review_request_fields(self):
+        """Testing ReviewBoardServer.set_review_request_fields"""
+        draft_url = 'http://localhost:8080/api/review-requests/42/draft/'
+        self.http_response[draft_url] = json.dumps({'stat': 'ok'})
+        review_request = {
+            'id': 42,
+            'links': {
+                'draft': {
+                    'href': draft_url,
+                },
+            },
+        }
+        fields = {
+            'summary': 'My summary',
+            'branch': 'trunk',
+            'target_people': 'alice,bob',
+        }
+
+        self.server.set_review_request_fields(review_request, fields)
+
+        self.assertEqual(self.http_requests, [(draft_url, (fields,))])
+
     def _build_info_resource(self, package_version):
         return {
             'api/info/': json.dumps({
@@ -852,6 +1616,266 @@ class ApiTests(MockHttpUnitTest):
         }
 
 
+class FakeHttpResponse(object):
+    def __init__(self, body, headers={}):
+        self.body = body
+        self.headers = headers
+
+    def read(self):
+        return self.body
+
+    def info(self):
+        return self
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+class ServerCacheTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+
+        self.cache_dir = _get_tmpdir()
+        self.saved_http_get_response = ReviewBoardServer.http_get_response
+        ReviewBoardServer.http_get_response = self._http_get_response
+        self.requests = []
+        self.root_rsp = {
+            'stat': 'ok',
+            'links': {},
+        }
+
+    def tearDown(self):
+        ReviewBoardServer.http_get_response = self.saved_http_get_response
+        shutil.rmtree(self.cache_dir)
+
+    def test_api_get_cached(self):
+        """Testing ReviewBoardServer.api_get_cached within the TTL"""
+        self.response = FakeHttpResponse(json.dumps(self.root_rsp),
+                                         {'ETag': '"abc123"'})
+
+        server = self._make_server()
+        self.assertEqual(server.api_get_cached('api/', 'root'),
+                         self.root_rsp)
+        self.assertEqual(server.api_get_cached('api/', 'root'),
+                         self.root_rsp)
+        self.assertEqual(self.requests, [('api/', {})])
+
+        # A new run should use the copy on disk.
+        server = self._make_server()
+        self.assertEqual(server.api_get_cached('api/', 'root'),
+                         self.root_rsp)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_api_get_cached_revalidate(self):
+        """Testing ReviewBoardServer.api_get_cached revalidating a stale entry"""
+        self.response = FakeHttpResponse(json.dumps(self.root_rsp),
+                                         {'ETag': '"abc123"'})
+
+        server = self._make_server()
+        server.api_get_cached('api/', 'root')
+
+        entry = server.cache.get('root')
+        entry['timestamp'] = 0
+        self.response = urllib2.HTTPError('api/', 304, 'Not Modified', {},
+                                          StringIO(''))
+
+        self.assertEqual(server.api_get_cached('api/', 'root'),
+                         self.root_rsp)
+        self.assertEqual(self.requests[1],
+                         ('api/', {'If-None-Match': '"abc123"'}))
+        self.assertTrue(server.cache.is_fresh(server.cache.get('root')))
+
+    def test_get_repositories_incremental(self):
+        """Testing ReviewBoardServer.get_repositories refreshing the index"""
+        self.response = {
+            'api/repositories/': self._make_repository_list([1], 'page2/'),
+            'page2/': self._make_repository_list([2]),
+        }
+
+        server = self._make_server()
+        server.root_resource = {
+            'links': {
+                'repositories': {
+                    'href': 'api/repositories/',
+                },
+            },
+        }
+        self.assertEqual([r['id'] for r in server.get_repositories()], [1, 2])
+        self.assertEqual([r['id'] for r in server.get_repositories()], [1, 2])
+        self.assertEqual(len(self.requests), 2)
+
+        # Once the index is stale, only the new repositories are fetched.
+        entry = server.cache.get('repositories')
+        entry['timestamp'] = 0
+        self.requests = []
+        self.response = {
+            'api/repositories/?start=1&max-results=1':
+                self._make_repository_list([2], total_results=3),
+            'api/repositories/?start=2': self._make_repository_list([3]),
+        }
+
+        repositories = server.get_repositories()
+        self.assertEqual([r['id'] for r in repositories], [1, 2, 3])
+        self.assertEqual([path for path, headers in self.requests],
+                         ['api/repositories/?start=1&max-results=1',
+                          'api/repositories/?start=2'])
+        self.assertEqual(repositories[2], {
+            'id': 3,
+            'tool': 'Subversion',
+            'path': 'svn://example.com/3',
+            'mirror_path': '',
+            'uuid': None,
+        })
+
+        # Removing one repository and adding another keeps the count the
+        # same, but still means a full refetch.
+        entry = server.cache.get('repositories')
+        entry['timestamp'] = 0
+        self.requests = []
+        self.response = {
+            'api/repositories/?start=2&max-results=1':
+                self._make_repository_list([4], total_results=3),
+            'api/repositories/': self._make_repository_list([1, 3, 4]),
+        }
+
+        repositories = server.get_repositories()
+        self.assertEqual([r['id'] for r in repositories], [1, 3, 4])
+        self.assertEqual(len(self.requests), 2)
+
+        # Once the last full fetch is old enough, the list is fetched in
+        # full even if nothing seems to have changed.
+        entry = server.cache.get('repositories')
+        entry['timestamp'] = 0
+        entry['fetched'] = 0
+        self.requests = []
+
+        repositories = server.get_repositories()
+        self.assertEqual([path for path, headers in self.requests],
+                         ['api/repositories/'])
+
+    def test_get_repositories_force_refresh(self):
+        """Testing ReviewBoardServer.new_review_request refetching a changed repository path"""
+        rbtools.postreview.configs = []
+        self.response = {
+            'api/repositories/': self._make_repository_list([1, 2]),
+        }
+
+        server = ReviewBoardServer('http://localhost:8080/',
+                                   RepositoryInfo(['p4://alias', 'p4://old']),
+                                   None, self.cache_dir)
+        server.root_resource = {
+            'links': {
+                'repositories': {
+                    'href': 'api/repositories/',
+                },
+                'review_requests': {
+                    'href': 'api/review-requests/',
+                },
+            },
+        }
+        self.assertEqual([r['id'] for r in server.get_repositories()], [1, 2])
+
+        # The path of a repository changes without changing the number of
+        # repositories. A routine refresh doesn't see that, but a forced
+        # one fetches the whole list again.
+        self.response['api/repositories/'] = self._make_repository_list(
+            [1, 2], paths={2: 'p4://alias'})
+        posts = []
+
+        def api_post(path, data):
+            posts.append((path, data))
+            return {'review_request': {'id': 10}}
+
+        server.api_post = api_post
+
+        self.assertEqual(server.new_review_request(None), {'id': 10})
+        self.assertEqual(posts, [
+            ('api/review-requests/', {'repository': 'p4://alias'}),
+        ])
+        self.assertEqual(server.info.path, 'p4://alias')
+
+    def test_repository_matches(self):
+        """Testing ReviewBoardServer forgetting repository matches on a full refetch"""
+        self.response = {
+            'api/repositories/': self._make_repository_list([1, 2]),
+        }
+
+        server = self._make_server()
+        server.root_resource = {
+            'links': {
+                'repositories': {
+                    'href': 'api/repositories/',
+                },
+            },
+        }
+        match = {
+            'id': 2,
+            'url': 'svn://example.com/2',
+            'base_path': '/',
+        }
+        server.get_repositories()
+        server.set_repository_match('svn:abc', match)
+        self.assertEqual(server.get_repository_match('svn:abc'), match)
+
+        # A routine refresh keeps the match.
+        entry = server.cache.get('repositories')
+        entry['timestamp'] = 0
+        self.response['api/repositories/?start=1&max-results=1'] = \
+            self._make_repository_list([2], total_results=2)
+        self.assertEqual(server.get_repository_match('svn:abc'), match)
+
+        # Once the index is fetched in full, the match has to be found
+        # again.
+        entry = server.cache.get('repositories')
+        entry['timestamp'] = 0
+        entry['fetched'] = 0
+        self.assertEqual(server.get_repository_match('svn:abc'), None)
+
+        server.set_repository_match('svn:abc', match)
+        server.get_repositories(force_refresh=True)
+        self.assertEqual(server.get_repository_match('svn:abc'), None)
+
+    def _make_repository_list(self, ids, next_href=None, total_results=None,
+                              paths={}):
+        rsp = {
+            'stat': 'ok',
+            'links': {},
+            'repositories': [
+                {
+                    'id': rid,
+                    'tool': 'Subversion',
+                    'path': paths.get(rid, 'svn://example.com/%s' % rid),
+                }
+                for rid in ids
+            ],
+        }
+
+        if next_href:
+            rsp['links']['next'] = {'href': next_href}
+
+        if total_results:
+            rsp['total_results'] = total_results
+
+        return FakeHttpResponse(json.dumps(rsp))
+
+    def _make_server(self):
+        return ReviewBoardServer('http://localhost:8080/', RepositoryInfo(),
+                                 None, self.cache_dir)
+
+    def _http_get_response(self, path, headers={}):
+        self.requests.append((path, headers))
+
+        if isinstance(self.response, dict):
+            response = self.response[path]
+        else:
+            response = self.response
+
+        if isinstance(response, Exception):
+            raise response
+
+        return response
+
+
 class DeprecatedApiTests(MockHttpUnitTest):
     deprecated_api = True
 
@@ -925,10 +1949,852 @@ class DeprecatedApiTests(MockHttpUnitTest):
             self.assertEqual(str(e),
                              'This is a test failure (HTTP 400, API Error 100)')
 
+    def test_set_review_request_fields(self):
+        """Testing set_review_request_fields with the deprecated API"""
+        self.http_response = json.dumps({'stat': 'ok'})
+        fields = {
+            'summary': 'My summary',
+            'description': 'My description',
+            'testing_done': 'Ran the tests',
+        }
+
+        self.server.set_review_request_fields({'id': 42}, fields)
+
+        self.assertEqual(self.http_requests, [
+            ('api/json/reviewrequests/42/draft/set/', (fields, None)),
+        ])
+
     def _make_http_error(self, url, code, body):
         return urllib2.HTTPError(url, code, body, {}, StringIO(body))
 
 
+class KeepAliveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.num_connections += 1
+
+    def do_GET(self):
+        body = 'path=%s' % self.path
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        body = '%s %d' % (self.headers['Content-Type'], len(data))
+        self.server.posted_data = data
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), KeepAliveRequestHandler)
+        self.httpd.num_connections = 0
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_connection_reuse(self):
+        """Testing KeepAliveHTTPHandler reusing a single connection"""
+        pool = HTTPConnectionPool()
+        opener = urllib2.build_opener(KeepAliveHTTPHandler(pool))
+
+        for i in range(3):
+            rsp = opener.open('%s/api/%d/' % (self.url, i))
+            self.assertEqual(rsp.code, 200)
+            self.assertEqual(rsp.read(), 'path=/api/%d/' % i)
+
+        pool.close()
+
+        self.assertEqual(pool.num_requests, 3)
+        self.assertEqual(pool.num_connections, 1)
+        self.assertEqual(self.httpd.num_connections, 1)
+
+    def test_stale_connection(self):
+        """Testing KeepAliveHTTPHandler recovering from a dropped connection"""
+        pool = HTTPConnectionPool()
+        opener = urllib2.build_opener(KeepAliveHTTPHandler(pool))
+
+        self.assertEqual(opener.open(self.url + '/a/').read(), 'path=/a/')
+
+        # Simulate the server timing out the idle connection.
+        for conns in pool._idle.values():
+            for conn in conns:
+                conn.sock.shutdown(2)
+
+        self.assertEqual(opener.open(self.url + '/b/').read(), 'path=/b/')
+        self.assertEqual(pool.num_connections, 2)
+        pool.close()
+
+    def test_streaming_post(self):
+        """Testing KeepAliveHTTPHandler streaming a MultipartFormData body"""
+        pool = HTTPConnectionPool()
+        opener = urllib2.build_opener(KeepAliveHTTPHandler(pool))
+
+        diff = 'x' * (MultipartFormData.CHUNK_SIZE * 3 + 17)
+        body = MultipartFormData({'basedir': '/'}, {
+            'path': {
+                'filename': 'diff',
+                'content': diff,
+            },
+        })
+
+        r = urllib2.Request(self.url + '/upload/', body, {
+            'Content-Type': body.content_type,
+            'Content-Length': str(len(body)),
+        })
+
+        self.assertEqual(opener.open(r).read(),
+                         '%s %d' % (body.content_type, len(body)))
+        self.assertEqual(self.httpd.posted_data, ''.join(body))
+        pool.close()
+
+    def test_profiling(self):
+        """Testing ProfilingHandler counting requests and data"""
+        pool = HTTPConnectionPool()
+        profiler = Profiler(enabled=True)
+        opener = urllib2.build_opener(ProfilingHandler(profiler),
+                                      KeepAliveHTTPHandler(pool))
+
+        responses = [opener.open(self.url + '/a/').read(),
+                     opener.open(self.url + '/upload/', 'x' * 10).read()]
+        pool.close()
+
+        self.assertEqual(responses[1], 'application/x-www-form-urlencoded 10')
+        self.assertEqual(profiler.http_requests, 2)
+        self.assertEqual(profiler.http_bytes_sent, 10)
+        self.assertEqual(profiler.http_bytes_received,
+                         len(''.join(responses)))
+
+
+class MultipartFormDataTests(unittest.TestCase):
+    def test_encoding(self):
+        """Testing MultipartFormData encoding"""
+        body = MultipartFormData({'basedir': '/trunk'}, {
+            'path': {
+                'filename': 'diff',
+                'content': 'DIFF',
+            },
+        }, boundary='BOUNDARY')
+
+        expected = ('--BOUNDARY\r\n'
+                    'Content-Disposition: form-data; name="basedir"\r\n'
+                    '\r\n'
+                    '/trunk\r\n'
+                    '--BOUNDARY\r\n'
+                    'Content-Disposition: form-data; name="path"; '
+                    'filename="diff"\r\n'
+                    '\r\n'
+                    'DIFF\r\n'
+                    '--BOUNDARY--\r\n'
+                    '\r\n')
+
+        self.assertEqual(body.content_type,
+                         'multipart/form-data; boundary=BOUNDARY')
+        self.assertEqual(''.join(body), expected)
+        self.assertEqual(len(body), len(expected))
+
+    def test_chunking(self):
+        """Testing MultipartFormData splitting large files into chunks"""
+        content = 'a' * (MultipartFormData.CHUNK_SIZE * 2 + 1)
+        body = MultipartFormData(files={
+            'path': {
+                'filename': 'diff',
+                'content': content,
+            },
+        })
+
+        chunks = list(body)
+
+        for chunk in chunks:
+            self.assertTrue(len(chunk) <= MultipartFormData.CHUNK_SIZE)
+
+        self.assertTrue(content in ''.join(chunks))
+        self.assertEqual(len(''.join(chunks)), len(body))
+
+
+class DiffTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        self.tmpdir = _get_tmpdir()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unified_diff(self):
+        """Testing unified_diff"""
+        old_lines = ['line %d\n' % i for i in range(20)]
+        new_lines = old_lines[:]
+        del new_lines[1]
+        new_lines[14:15] = ['changed\n', 'added\n']
+
+        self.assertEqual(unified_diff(old_lines, new_lines), [
+            '@@ -1,5 +1,4 @@\n',
+            ' line 0\n',
+            '-line 1\n',
+            ' line 2\n',
+            ' line 3\n',
+            ' line 4\n',
+            '@@ -13,7 +12,8 @@\n',
+            ' line 12\n',
+            ' line 13\n',
+            ' line 14\n',
+            '-line 15\n',
+            '+changed\n',
+            '+added\n',
+            ' line 16\n',
+            ' line 17\n',
+            ' line 18\n',
+        ])
+        self.assertEqual(unified_diff(old_lines, old_lines), [])
+        self.assertEqual(unified_diff([], ['a\n']), ['@@ -0,0 +1 @@\n',
+                                                     '+a\n'])
+
+    def test_unified_diff_show_c_function(self):
+        """Testing unified_diff with show_c_function and missing newlines"""
+        old_lines = DIFF_OLD_C.splitlines(True)
+        new_lines = DIFF_NEW_C.splitlines(True)
+
+        self.assertEqual(
+            ''.join(unified_diff(old_lines, new_lines, show_c_function=True)),
+            EXPECTED_C_DIFF)
+
+    def test_diff_files(self):
+        """Testing diff_files"""
+        old_file = self._write_file('old.c', DIFF_OLD_C)
+        new_file = self._write_file('new.c', DIFF_NEW_C)
+
+        self.assertEqual(
+            ''.join(diff_files(old_file, new_file, 'a.c\t#1', 'a.c\tnow',
+                               show_c_function=True)),
+            '--- a.c\t#1\n+++ a.c\tnow\n' + EXPECTED_C_DIFF)
+        self.assertEqual(diff_files(old_file, old_file), [])
+
+        rbtools.postreview.options.use_gnu_diff = True
+
+        if is_exe_in_path('diff'):
+            self.assertEqual(
+                ''.join(diff_files(old_file, new_file, 'a.c\t#1',
+                                   'a.c\tnow', show_c_function=True)),
+                '--- a.c\t#1\n+++ a.c\tnow\n' + EXPECTED_C_DIFF)
+
+    def test_diff_files_binary(self):
+        """Testing diff_files with binary files"""
+        old_file = self._write_file('old.png', '\x89PNG\x00\x01')
+        new_file = self._write_file('new.png', '\x89PNG\x00\x02')
+
+        self.assertEqual(diff_files(old_file, new_file), [
+            'Binary files %s and %s differ\n' % (old_file, new_file),
+        ])
+        self.assertEqual(diff_files(old_file, old_file), [])
+
+    def _write_file(self, name, content):
+        filename = os.path.join(self.tmpdir, name)
+        fp = open(filename, 'wb')
+        fp.write(content)
+        fp.close()
+
+        return filename
+
+
+class DetermineClientTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        self.tmpdir = _get_tmpdir()
+        self.saved_environ = os.environ.copy()
+
+        for name in ('P4CONFIG', 'P4PORT', 'P4CLIENT'):
+            if name in os.environ:
+                del os.environ[name]
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_scm_candidates(self):
+        """Testing get_scm_candidates ranking the nearest markers first"""
+        svn_dir = os.path.join(self.tmpdir, 'vendor', 'lib')
+        os.makedirs(os.path.join(svn_dir, '.svn'))
+        os.mkdir(os.path.join(self.tmpdir, '.git'))
+
+        self.assertEqual(self._get_candidate_names(svn_dir),
+                         ['SVNClient', 'GitClient'])
+        self.assertEqual(self._get_candidate_names(self.tmpdir),
+                         ['GitClient'])
+
+    def test_get_scm_candidates_perforce(self):
+        """Testing get_scm_candidates with Perforce settings"""
+        self.assertEqual(self._get_candidate_names(self.tmpdir), [])
+
+        os.environ['P4PORT'] = 'perforce:1666'
+        self.assertEqual(self._get_candidate_names(self.tmpdir),
+                         ['PerforceClient'])
+
+        del os.environ['P4PORT']
+        os.environ['P4CONFIG'] = '.p4config'
+        open(os.path.join(self.tmpdir, '.p4config'), 'w').close()
+        os.mkdir(os.path.join(self.tmpdir, '.hg'))
+        self.assertEqual(self._get_candidate_names(self.tmpdir),
+                         ['MercurialClient', 'PerforceClient'])
+
+    def test_fallback_clients(self):
+        """Testing which SCM clients are probed without marker files"""
+        if 'GIT_DIR' in os.environ:
+            del os.environ['GIT_DIR']
+
+        self.assertEqual(self._get_fallback_names(),
+                         ['PerforceClient', 'ClearCaseClient'])
+
+        rbtools.postreview.options.repository_url = 'http://svn.example.com/'
+        self.assertEqual(self._get_fallback_names(),
+                         ['SVNClient', 'PerforceClient', 'ClearCaseClient'])
+
+    def _get_fallback_names(self):
+        return [tool.__class__.__name__
+                for tool in rbtools.postreview.SCMCLIENTS
+                if not tool.is_marker_required()]
+
+    def _get_candidate_names(self, path):
+        return [tool.__class__.__name__
+                for tool in get_scm_candidates(path)]
+
+
+class FindExecutableTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        rbtools.postreview.options.no_cache = False
+        rbtools.postreview._tools.clear()
+
+        self.tmpdir = _get_tmpdir()
+        self.bin_dir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(self.bin_dir)
+
+        self.saved_environ = os.environ.copy()
+        os.environ['HOME'] = self.tmpdir
+        os.environ['PATH'] = self.bin_dir
+
+        if 'APPDATA' in os.environ:
+            del os.environ['APPDATA']
+
+    def tearDown(self):
+        rbtools.postreview._tools.clear()
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_find_executable(self):
+        """Testing find_executable and the tools cache"""
+        if sys.platform.startswith('win'):
+            raise nose.SkipTest('This test relies on POSIX executables')
+
+        tool = os.path.join(self.bin_dir, 'mytool')
+        open(tool, 'w').close()
+        os.chmod(tool, 0755)
+
+        self.assertEqual(find_executable('mytool'), tool)
+        self.assertEqual(find_executable('othertool'), None)
+
+        cache_file = os.path.join(self.tmpdir, '.post-review-cache',
+                                  'tools.json')
+        cache = json.loads(open(cache_file).read())
+        self.assertEqual(cache['tools']['tools']['mytool']['path'], tool)
+        self.assertEqual(cache['tools']['tools']['othertool']['path'], None)
+
+        # Adding a tool to the PATH makes the cache stale.
+        os.utime(self.bin_dir, (0, 0))
+        other_tool = os.path.join(self.bin_dir, 'othertool')
+        open(other_tool, 'w').close()
+        os.chmod(other_tool, 0755)
+        rbtools.postreview._tools.clear()
+
+        self.assertEqual(find_executable('othertool'), other_tool)
+
+    def test_check_install_missing(self):
+        """Testing check_install not running a missing tool"""
+        if sys.platform.startswith('win'):
+            raise nose.SkipTest('This test relies on POSIX executables')
+
+        saved_popen = subprocess.Popen
+
+        def popen(*args, **kwargs):
+            self.fail('check_install started a process')
+
+        subprocess.Popen = popen
+
+        try:
+            self.assertFalse(check_install('othertool --version'))
+            self.assertFalse(check_install('othertool --version'))
+        finally:
+            subprocess.Popen = saved_popen
+
+
+class ConfigFileTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        rbtools.postreview.options.no_cache = False
+        rbtools.postreview.user_config = None
+        rbtools.postreview.configs = []
+
+        self.orig_dir = os.getcwd()
+        self.tmpdir = _get_tmpdir()
+        self.work_dir = os.path.join(self.tmpdir, 'work')
+        os.mkdir(self.work_dir)
+        os.chdir(self.work_dir)
+
+        self.saved_environ = os.environ.copy()
+        os.environ['HOME'] = self.tmpdir
+
+        if 'APPDATA' in os.environ:
+            del os.environ['APPDATA']
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        shutil.rmtree(self.tmpdir)
+
+    def _write_config(self, contents):
+        filename = os.path.join(self.work_dir, '.reviewboardrc')
+        fp = open(filename, 'w')
+        fp.write(contents)
+        fp.close()
+
+        return filename
+
+    def _load_config(self):
+        rbtools.postreview.configs = []
+        load_config_files(self.tmpdir)
+
+        return rbtools.postreview.configs[0]
+
+    def test_cached_config(self):
+        """Testing load_config_files with a cached config"""
+        mtime = time.time() - 60
+        filename = self._write_config('REVIEWBOARD_URL = "http://a.example.com"')
+        os.utime(filename, (mtime, mtime))
+        self.assertEqual(self._load_config()['REVIEWBOARD_URL'],
+                         'http://a.example.com')
+
+        # A change that keeps the same size and modification time isn't
+        # noticed, since the cached values are used.
+        self._write_config('REVIEWBOARD_URL = "http://b.example.com"')
+        os.utime(filename, (mtime, mtime))
+        self.assertEqual(self._load_config()['REVIEWBOARD_URL'],
+                         'http://a.example.com')
+
+        self._write_config('REVIEWBOARD_URL = "http://cc.example.com"')
+        self.assertEqual(self._load_config()['REVIEWBOARD_URL'],
+                         'http://cc.example.com')
+
+    def test_dynamic_config(self):
+        """Testing load_config_files with a config that reads other data"""
+        self._write_config('import os\n'
+                           'REVIEWBOARD_URL = os.environ["RB_TEST_URL"]\n')
+
+        os.environ['RB_TEST_URL'] = 'http://a.example.com'
+        self.assertEqual(self._load_config()['REVIEWBOARD_URL'],
+                         'http://a.example.com')
+
+        os.environ['RB_TEST_URL'] = 'http://b.example.com'
+        self.assertEqual(self._load_config()['REVIEWBOARD_URL'],
+                         'http://b.example.com')
+
+    def test_scan_for_server_trees(self):
+        """Testing SCMClient.scan_for_server with TREES in several configs"""
+        rbtools.postreview.user_config = {
+            'TREES': {
+                '/repo2': {'REVIEWBOARD_URL': 'http://user.example.com'},
+            },
+        }
+        rbtools.postreview.configs = [
+            {
+                'TREES': {
+                    '/repo1': {'REVIEWBOARD_URL': 'http://one.example.com'},
+                    '/repo2': {'REVIEWBOARD_URL': 'http://two.example.com'},
+                },
+            },
+            {
+                'REVIEWBOARD_URL': 'http://default.example.com',
+            },
+        ]
+
+        client = SCMClient()
+        self.assertEqual(client.scan_for_server(RepositoryInfo('/repo1')),
+                         'http://one.example.com')
+        self.assertEqual(client.scan_for_server(RepositoryInfo('/repo2')),
+                         'http://user.example.com')
+        self.assertEqual(
+            client.scan_for_server(RepositoryInfo(['/repo1', '/repo2'])),
+            'http://user.example.com')
+        self.assertEqual(client.scan_for_server(RepositoryInfo('/repo3')),
+                         'http://default.example.com')
+
+
+class RunParallelTests(unittest.TestCase):
+    def test_results_in_order(self):
+        """Testing run_parallel returning results in order"""
+        def func(i):
+            time.sleep(0.01 * (5 - i))
+            return i * 2
+
+        self.assertEqual(run_parallel(func, range(5), 3), [0, 2, 4, 6, 8])
+
+    def test_stop_when(self):
+        """Testing run_parallel with stop_when"""
+        started = []
+
+        def func(i):
+            started.append(i)
+            return i
+
+        results = run_parallel(func, range(100), 1, lambda i: i == 3)
+        self.assertEqual(results[:4], [0, 1, 2, 3])
+        self.assertEqual(started, [0, 1, 2, 3])
+
+    def test_exception(self):
+        """Testing run_parallel re-raising exceptions from workers"""
+        def func(i):
+            if i == 2:
+                raise SystemExit(1)
+
+            return i
+
+        self.assertRaises(SystemExit, run_parallel, func, range(5), 3)
+
+
+class ExecuteStreamTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+
+    def test_lines(self):
+        """Testing execute_stream yielding lines"""
+        lines = execute_stream([sys.executable, '-c',
+                                'print "one"; print "two"'])
+        self.assertEqual(list(lines), ['one\n', 'two\n'])
+
+    def test_chunks(self):
+        """Testing execute_stream yielding chunks"""
+        chunks = list(execute_stream([sys.executable, '-c',
+                                      'print "x" * 99'],
+                                     chunk_size=30))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(''.join(chunks), 'x' * 99 + '\n')
+
+    def test_errors(self):
+        """Testing execute_stream with a failing command"""
+        command = [sys.executable, '-c', 'import sys; sys.exit(3)']
+
+        self.assertRaises(PostReviewError, list, execute_stream(command))
+        self.assertEqual(list(execute_stream(command, ignore_errors=True)),
+                         [])
+        self.assertEqual(
+            list(execute_stream(command, extra_ignore_errors=(3,))), [])
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        rbtools.postreview.options = OptionsStub()
+        self.saved_profiler = rbtools.postreview.profiler
+        rbtools.postreview.profiler = Profiler(enabled=True)
+
+    def tearDown(self):
+        rbtools.postreview.profiler = self.saved_profiler
+
+    def test_run_phase(self):
+        """Testing Profiler.run_phase"""
+        profiler = rbtools.postreview.profiler
+
+        self.assertEqual(profiler.run_phase('add', lambda a, b: a + b, 1, 2),
+                         3)
+        self.assertRaises(ZeroDivisionError, profiler.run_phase, 'fail',
+                          lambda: 1 / 0)
+
+        report = profiler.get_report()
+        self.assertEqual([phase['name'] for phase in report['phases']],
+                         ['add', 'fail'])
+        self.assertTrue('fail' in profiler.format_report())
+
+    def test_disabled(self):
+        """Testing Profiler recording nothing unless enabled"""
+        profiler = Profiler()
+
+        self.assertEqual(profiler.run_phase('add', lambda a, b: a + b, 1, 2),
+                         3)
+        profiler.add_command(['true'], time.time(), 0, 0)
+        profiler.add_http_request(10)
+        profiler.add_http_bytes_received(10)
+
+        self.assertEqual(profiler.phases, [])
+        self.assertEqual(profiler.commands, [])
+        self.assertEqual(profiler.subprocesses, 0)
+        self.assertEqual(profiler.http_requests, 0)
+        self.assertEqual(profiler.http_bytes_received, 0)
+
+    def test_add_command_redacts_passwords(self):
+        """Testing Profiler.add_command hiding passwords"""
+        profiler = rbtools.postreview.profiler
+        profiler.add_command(['p4', '-P', 'secret', 'describe', '-s', '1'],
+                             time.time(), 0, 0)
+        profiler.add_command(['svn', '--password=secret', 'info',
+                              '--username', 'user'],
+                             time.time(), 0, 0)
+        profiler.add_command(['tool', '--http-password', 'secret', 'x'],
+                             time.time(), 0, 0)
+
+        self.assertEqual([command['argv'] for command in profiler.commands], [
+            ['p4', '-P', '**************', 'describe', '-s', '1'],
+            ['svn', '--password=**************', 'info', '--username',
+             'user'],
+            ['tool', '--http-password', '**************', 'x'],
+        ])
+        self.assertFalse('secret' in profiler.format_slowest_commands())
+        self.assertFalse('secret' in repr(profiler.get_trace()))
+
+    def test_subprocesses(self):
+        """Testing Profiler counting the commands run by execute"""
+        execute([sys.executable, '-c', 'pass'])
+        list(execute_stream([sys.executable, '-c', 'print 1']))
+
+        profiler = rbtools.postreview.profiler
+        self.assertEqual(profiler.subprocesses, 2)
+        self.assertTrue(profiler.subprocess_time > 0)
+
+    def test_trace(self):
+        """Testing Profiler tracing the commands run by execute"""
+        execute([sys.executable, '-c', 'print "x" * 9'])
+        execute([sys.executable, '-c', 'import sys; sys.exit(2)'],
+                ignore_errors=True)
+
+        profiler = rbtools.postreview.profiler
+        self.assertEqual([command['exit_code']
+                          for command in profiler.commands], [0, 2])
+        self.assertEqual(profiler.commands[0]['output_bytes'], 10)
+        self.assertEqual(profiler.commands[0]['cwd'], os.getcwd())
+
+        events = [event for event in profiler.get_trace()['traceEvents']
+                  if event['ph'] == 'X']
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[1]['args']['exit_code'], 2)
+
+        summary = profiler.format_slowest_commands(1).splitlines()
+        self.assertEqual(len(summary), 2)
+
+
+class PostReviewSessionTests(unittest.TestCase):
+    def setUp(self):
+        if not is_exe_in_path('git'):
+            raise nose.SkipTest('git not found in path')
+
+        self.orig_dir = os.getcwd()
+        self.tmpdir = _get_tmpdir()
+        self.repo_dir = os.path.join(self.tmpdir, 'repo')
+        os.mkdir(self.repo_dir)
+        os.chdir(self.repo_dir)
+
+        execute(['git', 'init'])
+
+        for data in ('a\n', 'a\nb\n'):
+            fp = open('foo.txt', 'w')
+            fp.write(data)
+            fp.close()
+
+            execute(['git', 'add', 'foo.txt'])
+            execute(['git', 'commit', '-m', 'Change foo.txt'])
+
+        os.chdir(self.orig_dir)
+
+        rbtools.postreview.options = OptionsStub()
+        self.session = PostReviewSession(server='http://rb.example.com',
+                                         no_cache=True)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_diff(self):
+        """Testing PostReviewSession.get_diff"""
+        saved_options = rbtools.postreview.options
+
+        for i in range(2):
+            diff, parent_diff = self.session.get_diff(
+                cwd=self.repo_dir, revision_range='HEAD~1:HEAD')
+            self.assertTrue('\n+b\n' in diff)
+
+        self.assertTrue(rbtools.postreview.options is saved_options)
+        self.assertEqual(os.getcwd(), self.orig_dir)
+
+    def test_errors(self):
+        """Testing PostReviewSession raising PostReviewError"""
+        try:
+            self.session.get_diff(cwd=self.tmpdir)
+        except PostReviewError, e:
+            self.assertTrue('does not contain a checkout' in str(e))
+        else:
+            self.fail('PostReviewError was not raised')
+
+        self.assertRaises(TypeError, PostReviewSession, not_a_setting=True)
+
+    def test_cleanup(self):
+        """Testing PostReviewSession cleaning up after each call"""
+        closed = []
+
+        class SessionStub(object):
+            def close(self):
+                closed.append(self)
+
+        rbtools.postreview._sessions[CmShellSession] = SessionStub()
+
+        self.assertRaises(PostReviewError, self.session.get_diff,
+                          cwd=self.tmpdir)
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(rbtools.postreview._sessions, {})
+
+    def test_die_keeps_tempfiles(self):
+        """Testing die leaving temporary files in use"""
+        path = make_tempfile()
+
+        try:
+            self.assertRaises(PostReviewError, die, 'Failed')
+            self.assertTrue(os.path.exists(path))
+        finally:
+            cleanup_tempfiles()
+
+
+class ParseVersionTests(unittest.TestCase):
+    def test_release_versions(self):
+        """Testing parse_version with release versions"""
+        self.assertEqual(parse_version('1.5'), parse_version('1.5.0'))
+        self.assertTrue(parse_version('1.5.2') >= parse_version('1.5.2'))
+        self.assertTrue(parse_version('1.5.10') > parse_version('1.5.9'))
+        self.assertTrue(parse_version('1.5.3.1') > parse_version('1.5.3'))
+
+    def test_pre_release_versions(self):
+        """Testing parse_version with pre-release versions"""
+        self.assertTrue(parse_version('1.6 beta 2') < parse_version('1.6'))
+        self.assertTrue(parse_version('1.6 alpha 1') <
+                        parse_version('1.6 beta 1'))
+        self.assertTrue(parse_version('1.6rc1') > parse_version('1.6 beta 2'))
+        self.assertTrue(parse_version('1.6 beta 2') >
+                        parse_version('1.5.2'))
+
+    def test_lazy_imports(self):
+        """Testing that importing postreview skips the networking modules"""
+        output = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys; import rbtools.postreview; '
+             'print [name for name in ("urllib2", "httplib", "pkg_resources",'
+             ' "rbtools.transport") if name in sys.modules]'],
+            stdout=subprocess.PIPE,
+            cwd=os.path.join(os.path.dirname(__file__), '..')).communicate()[0]
+        self.assertEqual(output.strip(), '[]')
+
+
+SVN_INFO_XML = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<info>
+<entry
+   kind="file"
+   path="foo.c"
+   revision="12">
+<url>http://svn.example.com/svn/trunk/foo.c</url>
+<repository>
+<root>http://svn.example.com/svn</root>
+<uuid>3b7a1e3c-0000-0000-0000-000000000000</uuid>
+</repository>
+<wc-info>
+<schedule>normal</schedule>
+<depth>infinity</depth>
+</wc-info>
+</entry>
+<entry
+   kind="file"
+   path="new dir/bar.c"
+   revision="-1">
+<url>http://svn.example.com/svn/trunk/new%20dir/bar.c</url>
+<repository>
+<root>http://svn.example.com/svn</root>
+<uuid>3b7a1e3c-0000-0000-0000-000000000000</uuid>
+</repository>
+<wc-info>
+<schedule>add</schedule>
+<depth>infinity</depth>
+<copy-from-url>http://svn.example.com/svn/branches/1.0/bar.c</copy-from-url>
+<copy-from-rev>10</copy-from-rev>
+</wc-info>
+</entry>
+</info>
+"""
+
+DIFF_OLD_C = """\
+int foo(void)
+{
+    int a = 1;
+    int b = 2;
+    int c = 3;
+    int d = 4;
+    return a;
+}
+
+int bar(void)
+{
+    return 0;
+}"""
+
+DIFF_NEW_C = """\
+int foo(void)
+{
+    int a = 1;
+    int b = 2;
+    int c = 3;
+    int d = 5;
+    return a;
+}
+
+int bar(void)
+{
+    return 1;
+}
+"""
+
+EXPECTED_C_DIFF = """\
+@@ -3,11 +3,11 @@ int foo(void)
+     int a = 1;
+     int b = 2;
+     int c = 3;
+-    int d = 4;
++    int d = 5;
+     return a;
+ }
+ 
+ int bar(void)
+ {
+-    return 0;
+-}
+\\ No newline at end of file
++    return 1;
++}
+"""
+
 FOO = """\
 ARMA virumque cano, Troiae qui primus ab oris
 Italiam, fato profugus, Laviniaque venit
@@ -0,0 +1,343 @@
+"""
+HTTP support for talking to a Review Board server.
+
+These are the urllib2 handlers and requests used by ReviewBoardServer. They
+live in their own module so that urllib2 and the rest of the networking
+modules are only loaded when a server is actually contacted, and not for
+commands like --output-diff.
+"""
+import base64
+import getpass
+import httplib
+import socket
+import threading
+import urllib2
+from urlparse import urlparse
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from rbtools import postreview
+
+
+class HTTPRequest(urllib2.Request):
+    def __init__(self, url, body='', headers={}, method="PUT"):
+        urllib2.Request.__init__(self, url, body, headers)
+        self.method = method
+
+    def get_method(self):
+        return self.method
+
+
+class PresetHTTPAuthHandler(urllib2.BaseHandler):
+    """urllib2 handler that conditionally presets the use of HTTP Basic Auth.
+
+    This is used when specifying --username= on the command line. It will
+    force an HTTP_AUTHORIZATION header with the user info, asking the user
+    for any missing info beforehand. It will then try this header for that
+    first request.
+
+    It will only do this once.
+    """
+    handler_order = 480 # After Basic auth
+
+    def __init__(self, url, password_mgr):
+        self.url = url
+        self.password_mgr = password_mgr
+        self.used = False
+
+    def reset(self):
+        self.password_mgr.rb_user = postreview.options.http_username
+        self.password_mgr.rb_pass = postreview.options.http_password
+        self.used = False
+
+    def http_request(self, request):
+        if postreview.options.username and not self.used:
+            # Note that we call password_mgr.find_user_password to get the
+            # username and password we're working with. This allows us to
+            # prompt if, say, --username was specified but --password was not.
+            username, password = \
+                self.password_mgr.find_user_password('Web API', self.url)
+            raw = '%s:%s' % (username, password)
+            request.add_header(
+                urllib2.HTTPBasicAuthHandler.auth_header,
+                'Basic %s' % base64.b64encode(raw).strip())
+            self.used = True
+
+        return request
+
+    https_request = http_request
+
+
+class ReviewBoardHTTPErrorProcessor(urllib2.HTTPErrorProcessor):
+    """Processes HTTP error codes.
+
+    Python 2.6 gets HTTP error code processing right, but 2.4 and 2.5 only
+    accepts HTTP 200 and 206 as success codes. This handler ensures that
+    anything in the 200 range is a success.
+    """
+    def http_response(self, request, response):
+        if not (200 <= response.code < 300):
+            response = self.parent.error('http', request, response,
+                                         response.code, response.msg,
+                                         response.info())
+
+        return response
+
+    https_response = http_response
+
+
+class ProfilingHandler(urllib2.BaseHandler):
+    """Counts the requests made and the data sent and received.
+
+    The counts are added to a postreview.Profiler. Data received is counted
+    as the response is read.
+    """
+    # Before the error processor, which replaces error responses.
+    handler_order = 900
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def http_request(self, request):
+        self.profiler.add_http_request(len(request.get_data() or ''))
+
+        return request
+
+    def http_response(self, request, response):
+        read = response.read
+
+        def _read(*args):
+            data = read(*args)
+            self.profiler.add_http_bytes_received(len(data))
+
+            return data
+
+        response.read = _read
+
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+class ReviewBoardHTTPBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
+    """Custom Basic Auth handler that doesn't retry excessively.
+
+    urllib2's HTTPBasicAuthHandler retries over and over, which is useless.
+    This subclass only retries once to make sure we've attempted with a
+    valid username and password. It will then fail so we can use
+    tempt_fate's retry handler.
+
+    Requests may be made from several threads at once, such as when
+    probing repositories, so retries are made one at a time to keep the
+    retry state consistent. The retried request may itself be retried
+    once, from the same thread.
+    """
+    def __init__(self, *args, **kwargs):
+        urllib2.HTTPBasicAuthHandler.__init__(self, *args, **kwargs)
+        self._retried = False
+        self._lasturl = ""
+        self._lock = threading.RLock()
+
+    def retry_http_basic_auth(self, *args, **kwargs):
+        self._lock.acquire()
+
+        try:
+            return self._retry_http_basic_auth(*args, **kwargs)
+        finally:
+            self._lock.release()
+
+    def _retry_http_basic_auth(self, *args, **kwargs):
+        if self._lasturl != args[0]:
+            self._retried = False
+
+        self._lasturl = args[0]
+
+        if not self._retried:
+            self._retried = True
+            self.retried = 0
+            response = urllib2.HTTPBasicAuthHandler.retry_http_basic_auth(
+                self, *args, **kwargs)
+
+            if response.code != 401:
+                self._retried = False
+
+            return response
+        else:
+            return None
+
+
+class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
+    """
+    Adds HTTP authentication support for URLs.
+
+    Python 2.4's password manager has a bug in http authentication when the
+    target server uses a non-standard port.  This works around that bug on
+    Python 2.4 installs. This also allows post-review to prompt for passwords
+    in a consistent way.
+
+    See: http://bugs.python.org/issue974757
+
+    The user is only prompted once, even if several threads need the
+    password at the same time.
+    """
+    def __init__(self, reviewboard_url, rb_user=None, rb_pass=None):
+        self.passwd  = {}
+        self.rb_url  = reviewboard_url
+        self.rb_user = rb_user
+        self.rb_pass = rb_pass
+        self._lock = threading.Lock()
+
+    def find_user_password(self, realm, uri):
+        if uri.startswith(self.rb_url):
+            self._lock.acquire()
+
+            try:
+                return self._find_rb_user_password(realm, uri)
+            finally:
+                self._lock.release()
+        else:
+            # If this is an auth request for some other domain (since HTTP
+            # handlers are global), fall back to standard password management.
+            return urllib2.HTTPPasswordMgr.find_user_password(self, realm, uri)
+
+    def _find_rb_user_password(self, realm, uri):
+        if self.rb_user is None or self.rb_pass is None:
+            if postreview.options.diff_filename == '-':
+                postreview.die('HTTP authentication is required, but '
+                               'cannot be used with --diff-filename=-')
+
+            print "==> HTTP Authentication Required"
+            print 'Enter authorization information for "%s" at %s' % \
+                (realm, urlparse(uri)[1])
+
+            if not self.rb_user:
+                self.rb_user = raw_input('Username: ')
+
+            if not self.rb_pass:
+                self.rb_pass = getpass.getpass('Password: ')
+
+        return self.rb_user, self.rb_pass
+
+
+class KeepAliveHandlerMixin:
+    """Opens urllib2 requests on pooled, persistent connections.
+
+    urllib2 forces "Connection: close" on every request, since its response
+    objects aren't prepared to deal with a connection that stays open. We
+    work around that by reading the full response body up front, which
+    frees up the connection for the next request right away. API responses
+    are small, so this is cheap.
+    """
+    def do_keepalive_open(self, http_class, req):
+        host = req.get_host()
+
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        tunnel_host = getattr(req, '_tunnel_host', None)
+        key = (req.get_type(), host, tunnel_host)
+
+        def make_connection():
+            conn = http_class(host)
+
+            if tunnel_host:
+                conn.set_tunnel(tunnel_host)
+
+            return conn
+
+        headers = dict(req.unredirected_hdrs)
+
+        for name, value in req.headers.items():
+            if name not in headers:
+                headers[name] = value
+
+        headers = dict([(name.title(), value)
+                        for name, value in headers.items()])
+
+        conn, reused = self.pool.get_connection(key, make_connection)
+
+        try:
+            response, data = self._send_request(conn, req, headers)
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+
+            if not reused:
+                raise urllib2.URLError(e)
+
+            # The server may have closed the idle connection on us. Give it
+            # one more try on a fresh connection before giving up.
+            conn = self.pool.new_connection(key, make_connection)
+
+            try:
+                response, data = self._send_request(conn, req, headers)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.release_connection(key, conn)
+
+        resp = urllib2.addinfourl(StringIO(data), response.msg,
+                                  req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+
+        return resp
+
+    def _send_request(self, conn, req, headers):
+        data = req.get_data()
+
+        if data is None or isinstance(data, basestring):
+            conn.request(req.get_method(), req.get_selector(), data, headers)
+        else:
+            # This is a streaming body (such as MultipartFormData), which
+            # we write to the socket one chunk at a time.
+            header_names = [name.lower() for name in headers]
+            kwargs = {}
+
+            if 'host' in header_names:
+                kwargs['skip_host'] = True
+
+            if 'accept-encoding' in header_names:
+                kwargs['skip_accept_encoding'] = True
+
+            conn.putrequest(req.get_method(), req.get_selector(), **kwargs)
+
+            for name, value in headers.iteritems():
+                conn.putheader(name, value)
+
+            conn.endheaders()
+
+            for chunk in data:
+                conn.send(chunk)
+
+        response = conn.getresponse()
+
+        return response, response.read()
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+    """urllib2 handler for HTTP that reuses connections from a pool."""
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_keepalive_open(httplib.HTTPConnection, req)
+
+
+if hasattr(httplib, 'HTTPS'):
+    class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+        """urllib2 handler for HTTPS that reuses connections from a pool."""
+        def __init__(self, pool):
+            urllib2.HTTPSHandler.__init__(self)
+            self.pool = pool
+
+        def https_open(self, req):
+            return self.do_keepalive_open(httplib.HTTPSConnection, req)
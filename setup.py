@@ -19,6 +19,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import sys
+
 from ez_setup import use_setuptools
 use_setuptools()
 
@@ -40,6 +42,24 @@ else:
 install_requires = []
 
 
+# Console script entry points are wrapped in a loader that imports
+# pkg_resources on every run, which can take longer than the rest of
+# post-review's startup. A plain script is installed instead, except on
+# Windows, where the entry point is needed to generate the .exe launcher.
+if sys.platform.startswith('win'):
+    script_args = {
+        'entry_points': {
+            'console_scripts': [
+                'post-review = rbtools.postreview:main',
+            ],
+        },
+    }
+else:
+    script_args = {
+        'scripts': ['scripts/post-review'],
+    }
+
+
 try:
     import json
 except ImportError:
@@ -50,11 +70,6 @@ setup(name=PACKAGE_NAME,
       version=get_package_version(),
       license="MIT",
       description="Command line tools for use with Review Board",
-      entry_points = {
-          'console_scripts': [
-              'post-review = rbtools.postreview:main',
-          ],
-      },
       install_requires=install_requires,
       dependency_links = [
           download_url,
@@ -73,5 +88,6 @@ setup(name=PACKAGE_NAME,
           "Operating System :: OS Independent",
           "Programming Language :: Python",
           "Topic :: Software Development",
-      ]
+      ],
+      **script_args
 )